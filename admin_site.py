@@ -9,6 +9,9 @@
 Flask routes for the admin member management site.
 """
 
+import csv
+import datetime
+import io
 import logging
 import flask
 import flask_login
@@ -16,11 +19,30 @@ import flask_login
 import config
 import helpers
 import gapps
+import sheetdata
 import main
 
 
 admin = flask.Blueprint('admin', __name__)
 
+# The sheets that can be exported as CSV, by the name used in the export URL
+_EXPORT_SHEETS = {
+    'members': config.SHEETS.member,
+    'volunteers': config.SHEETS.volunteer,
+}
+
+# CSV export output is sent in pieces of about this size
+_EXPORT_FLUSH_BYTES = 64 * 1024
+
+# The most offline-queued form submissions accepted in one batch sync. This matches
+# MAX_BATCH in static/js/admin-sw.js.
+_BATCH_SYNC_MAX_SUBMISSIONS = 50
+
+# The most members accepted in one CSV import. Their addresses are geocoded during the
+# request, at config.GEOCODE_BACKFILL_MAX_PER_SECOND, so this keeps it well within the
+# request deadline.
+_IMPORT_MEMBERS_MAX_ROWS = 300
+
 admin.before_request(main.additional_csrf_checks)
 
 
@@ -69,6 +91,51 @@ def submit_new_member():
 
     return f'success: {join_or_renew}'
 
+@admin.route('/import-members', methods=['GET'])
+@flask_login.login_required
+def import_members():
+    """Show the page for importing many members from a CSV file.
+    """
+    resp = flask.make_response(flask.render_template(
+        'import-members.jinja',
+        app_config=config,
+        max_rows=_IMPORT_MEMBERS_MAX_ROWS))
+
+    return resp
+
+@admin.route('/import-members', methods=['POST'])
+@flask_login.login_required
+def submit_import_members():
+    """Join or renew the members in the uploaded CSV file. Its headings must be member
+    field names. If any rows are invalid, nothing is imported and '400 Bad Request' is
+    returned with a line per problem.
+    """
+    user_email = flask_login.current_user.id
+
+    csv_file = flask.request.files.get('csv')
+    if not csv_file:
+        flask.abort(400, description='missing CSV file')
+
+    try:
+        # utf-8-sig, because spreadsheet programs like to start CSVs with a byte order mark
+        records = list(csv.DictReader(io.StringIO(csv_file.read().decode('utf-8-sig'))))
+    except (UnicodeDecodeError, csv.Error) as e:
+        flask.abort(400, description=f'unreadable CSV file: {e}')
+
+    if not records:
+        flask.abort(400, description='no members in CSV file')
+
+    if len(records) > _IMPORT_MEMBERS_MAX_ROWS:
+        flask.abort(400, description=f'too many members in CSV file; the most is {_IMPORT_MEMBERS_MAX_ROWS}')
+
+    logging.info('admin.submit_import_members: %s importing %d members', user_email, len(records))
+
+    summary, errors = gapps.import_members(records, user_email)
+    if errors:
+        return flask.make_response('\n'.join(errors), 400)
+
+    return f'success: {summary["joined"]} joined, {summary["renewed"]} renewed, {summary["geocode_failed"]} addresses not found'
+
 @admin.route('/renew-member', methods=['GET'])
 @flask_login.login_required
 def renew_member():
@@ -103,6 +170,42 @@ def submit_renew_member():
 
     return 'success'
 
+@admin.route('/batch-sync', methods=['POST'])
+@flask_login.login_required
+def batch_sync():
+    """Process a batch of new-member and renew-member form submissions that were queued
+    while the admin site was offline. This is called by the admin service worker.
+    The body is JSON like `{"submissions": [{"id": ..., "uuid": ..., "form": "new-member", "values": {...}, "queued": ...}, ...]}`.
+    Submissions that have been synced before (by UUID) aren't applied again.
+    The response is JSON with a result for each submission, so that the client can drop
+    the ones that have been processed: `{"results": [{"id": ..., "result": "join"|"renew"|"error", "error": ...}, ...]}`.
+    """
+    user_email = flask_login.current_user.id
+
+    body = flask.request.get_json(silent=True)
+    submissions = body.get('submissions') if isinstance(body, dict) else None
+    if not isinstance(submissions, list) or not all(isinstance(s, dict) for s in submissions):
+        flask.abort(400, description='invalid batch')
+    if len(submissions) > _BATCH_SYNC_MAX_SUBMISSIONS:
+        flask.abort(400, description='batch too large')
+
+    logging.info('admin.batch_sync: %s syncing %d submissions', user_email, len(submissions))
+
+    results = gapps.sync_member_submissions(submissions, user_email)
+
+    return flask.jsonify({'results': results})
+
+@admin.route('/admin-sw.js', methods=['GET'])
+def admin_service_worker():
+    """The service worker script for the admin site, which queues form submissions while
+    offline. It's served from the root, rather than /js, so that its scope covers the
+    admin pages.
+    """
+    resp = flask.send_from_directory('static/js', 'admin-sw.js', mimetype='application/javascript')
+    # Browsers check for service worker updates, but let's not make them wait on a cache
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
 @admin.route('/all-members-json', methods=['GET'])
 @flask_login.login_required
 def all_members_json():
@@ -114,6 +217,65 @@ def all_members_json():
 
     return flask.make_response(flask.jsonify(res))
 
+@admin.route('/export/<sheet_name>.csv', methods=['GET'])
+@flask_login.login_required
+def export_csv(sheet_name):
+    """Download the members or volunteers sheet as CSV. The `columns` query parameter
+    optionally gives a comma-separated list of the fields to include (by default, all).
+    The response is streamed: the sheet is read in chunks as the CSV is sent, so memory
+    use doesn't grow with the size of the sheet.
+    """
+    sheet = _EXPORT_SHEETS.get(sheet_name)
+    if not sheet:
+        flask.abort(404)
+
+    field_names = [f.name for f in sheet.fields]
+    columns = flask.request.args.get('columns')
+    if columns:
+        columns = [c.strip() for c in columns.split(',') if c.strip()]
+        unknown = [c for c in columns if c not in field_names]
+        if unknown:
+            flask.abort(400, description=f'unknown columns: {unknown}')
+    else:
+        columns = field_names
+
+    logging.info('admin.export_csv: %s exporting %s: %s', flask_login.current_user.id, sheet_name, columns)
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        # Send the headings right away, before any rows have been read
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+        for row in sheetdata.iter_rows(sheet):
+            writer.writerow(['' if row.dict.get(c) is None else row.dict.get(c) for c in columns])
+            if buf.tell() >= _EXPORT_FLUSH_BYTES:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+
+        yield buf.getvalue()
+
+    filename = f'{sheet_name}-{datetime.date.today().isoformat()}.csv'
+    return flask.Response(
+        flask.stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@admin.route('/members-snapshot', methods=['POST'])
+@flask_login.login_required
+def submit_members_snapshot():
+    """Request a snapshot of the members sheet, for analysis. It's written to Drive,
+    beside the sheet, by a task. This is to be called via XHR from the admin site pages.
+    """
+    logging.info('admin.submit_members_snapshot: requested by %s', flask_login.current_user.id)
+    gapps.enqueue_task('/tasks/member-sheet-snapshot', {})
+
+    return 'success'
+
 @admin.route('/authorize-user', methods=['GET'])
 @flask_login.login_required
 def authorize_user():
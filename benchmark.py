@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright Adam Pritchard 2020
+# MIT License : https://adampritchard.mit-license.org/
+#
+
+"""
+Micro-benchmarks for hot paths that don't need network access.
+Usage:
+    python benchmark.py validation
+    python benchmark.py templates
+    python benchmark.py email [--latency SECS] [--outbox]
+"""
+
+import argparse
+import time
+import timeit
+
+import config
+
+
+def _unplanned_validate_form(values, fields):
+    """How form validation was done before validation plans: the field info is re-derived
+    on every call. Kept here only for comparison.
+    """
+    for name, field in fields._asdict().items():
+        if not field.form_field and values.get(name) is not None:
+            return False, 'invalid field'
+        if field.values is not None and values.get(name) is not None \
+            and not set(values.get(name).split(config.MULTIVALUE_DIVIDER)).issubset(field.values):
+            return False, 'invalid field value'
+
+    result = {}
+    for field in fields._asdict().values():
+        result[field.name] = values.get(field.name, None)
+        if not field.validator(result[field.name], field.required):
+            return False, 'invalid input'
+
+    return result, None
+
+
+def bench_validation(iterations: int):
+    fields = config.SHEETS.member.fields
+    values = {
+        fields.first_name.name: 'Jill',
+        fields.last_name.name: 'Smith',
+        fields.email.name: 'jsmith@example.com',
+        fields.phone_num.name: '416-555-1234',
+        fields.street_num.name: '123',
+        fields.street_name.name: 'Danforth Ave',
+        fields.city.name: 'Toronto',
+        fields.postal_code.name: 'M4C 1A1',
+        fields.volunteer_interests.name: 'Pop-ups; Trees',
+        fields.skills.name: 'Carpentry',
+    }
+
+    plan = config.SHEETS.member.validation_plan
+    assert plan.validate_form(values) == _unplanned_validate_form(values, fields)
+
+    for label, fn in (
+            ('per-request derivation', lambda: _unplanned_validate_form(values, fields)),
+            ('validation plan', lambda: plan.validate_form(values))):
+        secs = min(timeit.repeat(fn, number=iterations, repeat=5))
+        print(f'{label:>24}: {secs / iterations * 1e6:.2f} µs per request')
+
+
+def _unregistered_render(first_name):
+    """How renewal reminder emails were rendered before the template registry: the subject
+    is read from disk and the plaintext converted for every message. Kept here only for
+    comparison.
+    """
+    import flask
+    import html2text
+
+    with open('templates/tasks/email-renewal-reminder-subject.txt', 'r') as subject_file:
+        subject = subject_file.read().strip()
+    body_html = flask.render_template(
+        'tasks/email-renewal-reminder.jinja',
+        app_config=config,
+        member_first_name=first_name)
+    h2t = html2text.HTML2Text()
+    h2t.body_width = 0
+    body_text = h2t.handle(body_html)
+    return subject, body_html, body_text
+
+
+def bench_templates(iterations: int):
+    # Importing main sets up the Flask app; it needs the usual config and credentials.
+    import main
+    import email_templates
+
+    # A renewal batch, where many members share common first names
+    first_names = [f'Name{i % 200}' for i in range(iterations)]
+
+    with main.app.app_context():
+        assert email_templates.render(email_templates.RENEWAL_REMINDER, member_first_name='Jill') \
+            == _unregistered_render('Jill')
+
+        for label, fn in (
+                ('per-message render', lambda: [_unregistered_render(n) for n in first_names]),
+                ('template registry', lambda: [email_templates.render(email_templates.RENEWAL_REMINDER, member_first_name=n) for n in first_names])):
+            secs = min(timeit.repeat(fn, number=1, repeat=3))
+            print(f'{label:>24}: {iterations / secs:,.0f} messages per second')
+
+    print(f'{"render cache":>24}: {email_templates.cache_info()}')
+
+
+def bench_email(iterations: int, latency: float, outbox: bool):
+    """Time the email flows -- rendering and SMTP delivery -- against a local SMTP sink.
+    `latency` simulates the provider's per-message processing time.
+    The reminder transport cases only measure `emailer.send_many()`. If `outbox` is
+    set, renewal reminders are also timed through the flow they actually take: the
+    shard task enqueuing them in the outbox, then `emailer.drain_outbox()` sending them,
+    limited to config.EMAIL_OUTBOX_MAX_PER_SECOND. That needs a datastore, like the
+    emulator (with DATASTORE_EMULATOR_HOST set).
+    """
+    import main
+    import email_templates
+    import emailer
+    import gapps
+    import smtp_sink
+
+    with smtp_sink.SMTPSink(latency=latency) as sink, main.app.app_context():
+        config.SMTP_HOST, config.SMTP_PORT, config.SMTP_CA_FILE = sink.host, sink.port, sink.cert_path
+
+        def welcome_mail():
+            # Welcome emails are sent one at a time, each over a new connection
+            for i in range(iterations):
+                subject, body_html, body_text = email_templates.render(
+                    email_templates.NEW_MEMBER, member_first_name=f'Name{i % 200}')
+                emailer.send((f'member{i}@example.com', f'Name{i % 200}'), subject, body_html, body_text)
+
+        def reminder_transport(max_connections):
+            # Just the sending, in shard-sized groups, over reused connections
+            shard_size = config.RENEWAL_REMINDER_SHARD_SIZE
+            for start in range(0, iterations, shard_size):
+                messages = []
+                for i in range(start, min(start + shard_size, iterations)):
+                    subject, body_html, body_text = email_templates.render(
+                        email_templates.RENEWAL_REMINDER, member_first_name=f'Name{i % 200}')
+                    messages.append(((f'member{i}@example.com', f'Name{i % 200}'), subject, body_html, body_text))
+                emailer.send_many(messages, max_connections=max_connections)
+
+        def reminders_via_outbox():
+            # The shard tasks enqueue the reminders, then the outbox drain sends them.
+            # The members are unique to this run, so earlier runs don't de-duplicate them.
+            fields = config.SHEETS.member.fields
+            run_id = time.time_ns()
+            client = main.app.test_client()
+            shard_size = config.RENEWAL_REMINDER_SHARD_SIZE
+            for start in range(0, iterations, shard_size):
+                members = [{fields.id.name: f'bench-{run_id}-{i}',
+                            fields.renewed.name: '2000-01-01',
+                            fields.first_name.name: f'Name{i % 200}',
+                            fields.last_name.name: 'Bench',
+                            fields.email.name: f'member{i}@example.com',
+                            fields.paypal_auto_renewing.name: 'N'}
+                           for i in range(start, min(start + shard_size, iterations))]
+                resp = client.post('/tasks/renewal-reminder-shard',
+                                   query_string={gapps._TASK_QUEUE_SECRET_PARAM: config.FLASK_SECRET_KEY},
+                                   headers={'X-AppEngine-QueueName': 'benchmark'},
+                                   json={'members': members})
+                assert resp.status_code == 200, resp.status_code
+            while not emailer.drain_outbox(time.monotonic() + config.EMAIL_OUTBOX_DRAIN_TIME_BUDGET_SECS):
+                pass
+
+        cases = [
+            ('welcome mail', welcome_mail),
+            ('reminder transport, 1 connection', lambda: reminder_transport(1)),
+            (f'reminder transport, {config.EMAIL_SEND_MAX_CONNECTIONS} connections', lambda: reminder_transport(config.EMAIL_SEND_MAX_CONNECTIONS)),
+        ]
+        if outbox:
+            cases.append(('reminders via outbox', reminders_via_outbox))
+
+        for label, fn in cases:
+            before = sink.stats()
+            started = time.monotonic()
+            fn()
+            secs = time.monotonic() - started
+            after = sink.stats()
+            print(f'{label:>36}: {iterations / secs:,.1f} messages per second; '
+                  f'{after["accepted"] - before["accepted"]} delivered; '
+                  f'{after["connections"] - before["connections"]} connections')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=['validation', 'templates', 'email'])
+    parser.add_argument('--latency', type=float, default=0, help='simulated SMTP latency per message, for email')
+    parser.add_argument('--outbox', action='store_true', help='also time reminders through the outbox, for email (needs a datastore)')
+    parser.add_argument('--iterations', type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.benchmark == 'validation':
+        bench_validation(args.iterations)
+    elif args.benchmark == 'templates':
+        bench_templates(args.iterations)
+    elif args.benchmark == 'email':
+        bench_email(args.iterations, args.latency, args.outbox)
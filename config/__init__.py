@@ -5,7 +5,7 @@
 # MIT License : https://adampritchard.mit-license.org/
 #
 
-from typing import NamedTuple
+from typing import NamedTuple, Optional, Tuple, Union
 from collections import namedtuple
 import logging
 import types
@@ -43,6 +43,14 @@ PROJECT_REGION = 'us-central1'
 # (AFAIK, the name isn't important, so you don't actually need to change it.)
 TASK_QUEUE_NAME = 'mmbrmgmt-task-queue'
 
+# Where queued tasks are sent. 'cloud' uses Cloud Tasks. 'local' runs them in this
+# process, by dispatching to the app's own routes from a thread pool (see local_tasks.py).
+# 'local' is only for development and load testing -- queued tasks are lost if the
+# process exits.
+TASK_QUEUE_BACKEND = 'cloud'
+LOCAL_TASK_QUEUE_MAX_WORKERS = 4
+LOCAL_TASK_QUEUE_MAX_ATTEMPTS = 5
+
 TIMEZONE = 'America/Toronto'
 
 # This is repeated in static/js/common.js
@@ -73,6 +81,115 @@ if DEMO:
 MEMBER_SHEET_ARCHIVE_MONTH = 11
 MEMBER_SHEET_ARCHIVE_DAY = 1
 
+# Whether the daily maintenance job culls defunct members (who haven't renewed in over
+# two years) from the members sheet.
+MEMBER_SHEET_CULL_ENABLED = False
+
+# When the members sheet is archived (and when an admin asks for one), a gzipped CSV
+# snapshot of it is also written to Drive, for analysis. The sheet is read for this in
+# chunks of this many rows, so it's never entirely in memory.
+SHEET_READ_CHUNK_ROWS = 500
+
+# Form submissions that the admin site queued while offline are recorded when they're
+# synced, so that resending one doesn't apply it twice. The records are kept this long.
+SYNCED_SUBMISSION_RETENTION_DAYS = 30
+
+
+#
+# Geocoding
+#
+
+# When True, the address of a new or renewed member/volunteer (and the location where
+# they were signed up) is not geocoded while handling the form submission. The row is
+# written with those fields empty, and a queued task fills them in afterward. This
+# keeps geocoder response times out of join and renew latency. (When a member is
+# renewed, their Address LatLong is only cleared to be refilled if their address changed.)
+GEOCODE_DEFERRED = False
+
+# Settings for the job that geocodes existing rows that are missing Address LatLong.
+# The Geocoding API allows 50 requests per second; we stay well under that.
+GEOCODE_BACKFILL_MAX_WORKERS = 4
+GEOCODE_BACKFILL_MAX_PER_SECOND = 10
+# Results are written to the sheet after each chunk of this many rows, so that work
+# done before a timeout isn't lost.
+GEOCODE_BACKFILL_CHUNK_SIZE = 50
+# When a run has taken this long it stops and enqueues a task to continue. This must be
+# comfortably less than the request deadline (10 minutes for cron and tasks).
+GEOCODE_BACKFILL_TIME_BUDGET_SECS = 7 * 60
+
+# Optional path to a CSV table of postal code (or FSA) centroids. See postal_centroids.py
+# for the format. When set, it's used for approximate coordinates when the geocoder fails
+# or times out. None disables it.
+POSTAL_CENTROIDS_FILE_PATH = None
+# When True (and the table above is set), addresses are given the coordinates of their
+# postal code from the table and the geocoder is only used if that lookup misses. This is
+# much faster but only approximate, which is fine if the coordinates are only used for
+# the members map.
+GEOCODE_POSTAL_CENTROIDS_FIRST = False
+
+
+#
+# MailChimp
+#
+
+# Overrides the MailChimp API URL, like 'http://localhost:8081/3.0/'. This is for testing
+# against a fake MailChimp server like fake_mailchimp.py. None uses the real API.
+MAILCHIMP_API_URL_ROOT = None
+# When at least this many rows of a sheet need syncing, they're sent using MailChimp
+# batch operations rather than a request per row.
+MAILCHIMP_BATCH_THRESHOLD = 50
+MAILCHIMP_BATCH_MAX_OPERATIONS = 500
+MAILCHIMP_BATCH_POLL_SECS = 5
+MAILCHIMP_BATCH_TIMEOUT_SECS = 5 * 60
+# Below the batch threshold, rows are upserted concurrently by this many workers.
+# This shouldn't exceed the size of the MailChimp connection pool (mailchimp._POOL_SIZE).
+MAILCHIMP_SYNC_MAX_WORKERS = 8
+# The "MailChimp Updated" stamps are written to the sheet after each chunk of this many
+# rows, so that a run that stops partway doesn't lose its progress.
+MAILCHIMP_SYNC_CHUNK_SIZE = 50
+# No new chunk is started after this much time in a sync run; a task is enqueued to
+# continue instead. Cron and task requests have a 10 minute deadline, and a batch
+# chunk can take up to MAILCHIMP_BATCH_TIMEOUT_SECS, so this must leave room for that.
+# In the daily maintenance job it's measured from the start of the request, and the
+# remaining minute is for the stages after the sync (the cull and datastore cleanups).
+MAILCHIMP_SYNC_TIME_BUDGET_SECS = 4 * 60
+
+
+#
+# Email
+#
+
+# A CA certificate file to trust for the SMTP server's certificate, in addition to the
+# system's. This is for testing against a local server like smtp_sink.py. None is normal.
+SMTP_CA_FILE = None
+
+# Large batches of email (like renewal reminders) are sent over up to this many
+# parallel SMTP connections. Check the SMTP provider's limits before raising it.
+EMAIL_SEND_MAX_CONNECTIONS = 3
+# Emails are queued in an outbox in the datastore and sent by a cron job
+# (/tasks/email-outbox-drain). These should be within the SMTP provider's limits.
+EMAIL_OUTBOX_MAX_PER_SECOND = 2
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_DRAIN_CHUNK_SIZE = 50
+EMAIL_OUTBOX_DRAIN_TIME_BUDGET_SECS = 5 * 60
+# Sent messages are kept this long, for de-duplication.
+EMAIL_OUTBOX_RETENTION_DAYS = 30
+# Renewal reminders are enqueued in the outbox by queued tasks, each handling a shard
+# of this many members.
+RENEWAL_REMINDER_SHARD_SIZE = 50
+# Records of sent renewal reminders are kept this long, to prevent duplicates. A member
+# is only in the reminder window for a day, so this needn't be long.
+RENEWAL_REMINDER_SENT_RETENTION_DAYS = 7
+
+
+#
+# Caching
+#
+
+# The mapping of volunteer interests to reps is cached, and rebuilt when the Volunteer
+# Interests spreadsheet changes. This is how often (at most) we check for a change.
+VOLUNTEER_INTEREST_REPS_CHECK_SECS = 10 * 60
+
 
 #
 # Spreadsheet field info
@@ -87,7 +204,8 @@ class Field(object):
                  form_field=True,
                  mutable=True,
                  values=None,
-                 mailchimp_merge_tag=None):
+                 mailchimp_merge_tag=None,
+                 is_date=False):
         self.name = name
         self.is_id = is_id
         self.required = required
@@ -96,6 +214,7 @@ class Field(object):
         self.mutable = mutable
         self.values = values
         self.mailchimp_merge_tag = mailchimp_merge_tag
+        self.is_date = is_date
 
     def as_dict(self, json_safe):
         res = {}
@@ -106,6 +225,64 @@ class Field(object):
         return res
 
 
+class ValidationPlan(object):
+    """The information needed to validate input against a set of fields, worked out
+    once (at import time, for our sheets) rather than on every request.
+    """
+    def __init__(self, fields: NamedTuple):
+        # Form submissions use the field names, but we also check the field attribute
+        # names (like 'address_latlong') in case something tries to sneak those in.
+        named_fields = fields._asdict().items()
+        self.non_form_keys = frozenset(
+            key for attr, field in named_fields if not field.form_field
+                for key in (attr, field.name))
+        self.allowed_values = tuple(
+            (key, frozenset(field.values)) for attr, field in named_fields if field.values is not None
+                for key in (attr, field.name))
+        self.checks = tuple((field.name, field.validator, field.required) for field in fields)
+
+    def validate(self, obj: dict) -> Union[dict, bool]:
+        """Validates the object, possibly with partial fields.
+        Returns a dict with the proper fields on success, or False on failure.
+        """
+        result = {}
+
+        for name, validator, required in self.checks:
+            # It's important to default to None here. When we update a row in the spreadsheet,
+            # None (null) is interpreted as "leave the existing value". If we defaulted to '',
+            # the value in the sheet would be replaced.
+            val = obj.get(name, None)
+
+            if not validator(val, required):
+                logging.warning('Bad input: %s : %s' % (name, val))
+                return False
+
+            result[name] = val
+
+        return result
+
+    def validate_form(self, values: dict) -> Tuple[Union[dict, bool], Optional[str]]:
+        """Validates form values, including checking that the form isn't trying to set
+        fields it shouldn't be, or to give restricted fields values that aren't allowed.
+        (That can be done by an attacker by modifying the page elements.)
+        Returns a tuple of (the result of `validate()`, None) on success, or
+        (False, description of the problem) on failure.
+        """
+        if not self.non_form_keys.isdisjoint(values.keys()):
+            return False, 'invalid field'
+
+        for key, allowed in self.allowed_values:
+            val = values.get(key)
+            if val is not None and not allowed.issuperset(val.split(MULTIVALUE_DIVIDER)):
+                return False, 'invalid field value'
+
+        result = self.validate(values)
+        if not result:
+            return False, 'invalid input'
+
+        return result, None
+
+
 class Spreadsheet(object):
     def __init__(self,
                  spreadsheet_id: str,
@@ -116,12 +293,13 @@ class Spreadsheet(object):
         self.worksheet_title = worksheet_title
         self.worksheet_id = worksheet_id
         self.fields = fields
+        self.validation_plan = ValidationPlan(fields)
+        self._id_field = next((f for f in fields if f.is_id), None)
 
     def id_field(self):
-        f = [f for f in self.fields if f.is_id]
-        if not f:
+        if not self._id_field:
             raise Exception('Spreadsheet has no ID field')
-        return f[0]
+        return self._id_field
 
 
 AUTHORIZED_SHEET = Spreadsheet(AUTHORIZED_SPREADSHEET_ID,
@@ -134,7 +312,7 @@ AUTHORIZED_SHEET = Spreadsheet(AUTHORIZED_SPREADSHEET_ID,
                                 'email',
                                 'name'])(
     Field('ID', is_id=True, validator=lambda *args: True, form_field=False, mutable=False),
-    Field('Created', validator=lambda *args: True, form_field=False, mutable=False),
+    Field('Created', validator=lambda *args: True, form_field=False, mutable=False, is_date=True),
     Field('Created By', validator=lambda *args: True, form_field=False, mutable=False),
     Field('Email', required=True, validator=utils.email_validator),
     Field('Name', required=True)
@@ -176,9 +354,9 @@ MEMBER_SHEET = Spreadsheet(MEMBERS_SPREADSHEET_ID,
                                 'mailchimp_updated',
                             ])(
     Field('ID', is_id=True, validator=lambda *args: True, form_field=True, mutable=False),
-    Field('Joined', validator=lambda *args: True, form_field=False, mutable=False),
+    Field('Joined', validator=lambda *args: True, form_field=False, mutable=False, is_date=True),
     Field('Joined By', validator=lambda *args: True, form_field=False, mutable=False),
-    Field('Renewed', validator=lambda *args: True, form_field=False),
+    Field('Renewed', validator=lambda *args: True, form_field=False, is_date=True),
     Field('Renewed By', validator=lambda *args: True, form_field=False),
     Field('Paid?'),  # This is a form field in managment interface, but not self-serve
     Field('First Name', required=True, mailchimp_merge_tag='FNAME'),
@@ -204,7 +382,7 @@ MEMBER_SHEET = Spreadsheet(MEMBERS_SPREADSHEET_ID,
     Field('Paypal Payer ID', form_field=False),
     Field('Paypal Auto-Renewing', form_field=False),
     Field('Paid Amount', form_field=False),
-    Field('MailChimp Updated', form_field=False),
+    Field('MailChimp Updated', form_field=False, is_date=True),
 ))
 
 
@@ -233,7 +411,7 @@ VOLUNTEER_SHEET = Spreadsheet(VOLUNTEERS_SPREADSHEET_ID,
                                 'mailchimp_updated',
                                ])(
     Field('ID', is_id=True, validator=lambda *args: True, form_field=True, mutable=False),
-    Field('Joined', validator=lambda *args: True, form_field=False, mutable=False),
+    Field('Joined', validator=lambda *args: True, form_field=False, mutable=False, is_date=True),
     Field('Joined By', validator=lambda *args: True, form_field=False, mutable=False),
     Field('First Name', required=True, mailchimp_merge_tag='FNAME'),
     Field('Last Name', required=True, mailchimp_merge_tag='LNAME'),
@@ -250,7 +428,7 @@ VOLUNTEER_SHEET = Spreadsheet(VOLUNTEERS_SPREADSHEET_ID,
     Field('Skills', mailchimp_merge_tag='SKILLS'),
     Field('Joined LatLong', form_field=False),
     Field('Joined Address', form_field=False),
-    Field('MailChimp Updated', form_field=False),
+    Field('MailChimp Updated', form_field=False, is_date=True),
 ))
 
 
@@ -288,34 +466,27 @@ SHEETS = namedtuple('SHEETS', ['authorized', 'member',
 def validate_obj_against_fields(obj: dict, fields: NamedTuple) -> dict:
     """Validates the object, possibly with partial fields, against the field data.
     Returns a dict with the proper fields on success, or False on failure.
+    Prefer using the `validation_plan` of the sheet directly.
     """
-    result = {}
-
-    for field in fields._asdict().values():
-        # It's important to default to None here. When we update a row in the spreadsheet,
-        # None (null) is interpreted as "leave the existing value". If we defaulted to '',
-        # the value in the sheet would be replaced.
-        result[field.name] = obj.get(field.name, None)
-
-        if not field.validator(result[field.name], field.required):
-            logging.warn('Bad input: %s : %s' % (field.name, result[field.name]))
-            return False
+    for sheet in SHEETS:
+        if sheet.fields is fields:
+            return sheet.validation_plan.validate(obj)
 
-    return result
+    return ValidationPlan(fields).validate(obj)
 
 
 def validate_member(member: dict) -> dict:
     """Validates the given member dict, possibly with partial fields.
     Returns a dict with the proper fields on success, or False on failure.
     """
-    return validate_obj_against_fields(member, SHEETS.member.fields)
+    return SHEETS.member.validation_plan.validate(member)
 
 
 def validate_volunteer(member: dict) -> dict:
     """Validates the given volunteer dict, possibly with partial fields.
     Returns a dict with the proper fields on success, or False on failure.
     """
-    return validate_obj_against_fields(member, SHEETS.volunteer.fields)
+    return SHEETS.volunteer.validation_plan.validate(member)
 
 
 def fields_to_dict(fields: NamedTuple) -> dict:
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright Adam Pritchard 2020
+# MIT License : https://adampritchard.mit-license.org/
+#
+
+"""
+Registry of the email templates sent by tasks.
+
+Each email has a subject file (`templates/tasks/email-{name}-subject.txt`, or `.jinja`
+if it has parameters) and an HTML body template (`templates/tasks/email-{name}.jinja`).
+The subjects are read and compiled once, at import. Body templates are compiled once by
+Flask's Jinja environment. Complete renders -- subject, HTML and plaintext -- are cached
+by template and parameters, so sending the same email to many people (like renewal
+reminders, which only vary by first name) mostly doesn't re-render or re-convert.
+"""
+
+from typing import Tuple
+import functools
+import logging
+import os
+
+import flask
+import jinja2
+
+import config
+import emailer
+
+
+NEW_MEMBER = 'new-member'
+RENEW_MEMBER = 'renew-member'
+NEW_VOLUNTEER = 'new-volunteer'
+RENEWAL_REMINDER = 'renewal-reminder'
+RENEWAL_REMINDER_AUTO = 'renewal-reminder-auto'
+VOLUNTEER_INTEREST_REP = 'volunteer-interest-rep'
+
+_TEMPLATE_NAMES = (NEW_MEMBER, RENEW_MEMBER, NEW_VOLUNTEER,
+                   RENEWAL_REMINDER, RENEWAL_REMINDER_AUTO, VOLUNTEER_INTEREST_REP)
+
+_TEMPLATES_DIR = 'templates'
+
+# Count of cached renders to keep. Renewal reminders vary by first name, so this
+# should comfortably exceed the number of distinct first names in a batch.
+_RENDER_CACHE_SIZE = 2048
+
+
+def _load_subjects():
+    """Read and compile all of the subject templates.
+    """
+    # Like Flask's environment, no autoescaping for .jinja files. Subjects are plain text.
+    env = jinja2.Environment()
+    subjects = {}
+    for name in _TEMPLATE_NAMES:
+        for ext in ('txt', 'jinja'):
+            path = os.path.join(_TEMPLATES_DIR, 'tasks', f'email-{name}-subject.{ext}')
+            if os.path.exists(path):
+                with open(path, 'r') as subject_file:
+                    subjects[name] = env.from_string(subject_file.read())
+                break
+        else:
+            raise Exception(f'email_templates: missing subject for {name}')
+    return subjects
+
+
+_subjects = _load_subjects()
+
+
+def render(name: str, **params) -> Tuple[str, str, str]:
+    """Render the email template with the given name (one of the constants in this
+    module). `app_config` is supplied to the templates; the rest of the parameters
+    must be hashable (they're the cache key).
+    Must be called within a Flask app context (which tasks are).
+    Returns a tuple of (subject, body_html, body_text).
+    """
+    return _render(name, tuple(sorted(params.items())))
+
+
+@functools.lru_cache(maxsize=_RENDER_CACHE_SIZE)
+def _render(name: str, params: Tuple[Tuple[str, str]]) -> Tuple[str, str, str]:
+    params = dict(params, app_config=config)
+
+    subject = _subjects[name].render(**params).strip()
+
+    template = flask.current_app.jinja_env.get_template(f'tasks/email-{name}.jinja')
+    body_html = template.render(**params)
+
+    body_text = emailer.html_to_text(body_html)
+
+    logging.debug('email_templates._render: rendered %s', name)
+    return subject, body_html, body_text
+
+
+def cache_info():
+    """Returns the render cache statistics (hits, misses, etc.).
+    """
+    return _render.cache_info()
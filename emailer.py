@@ -11,17 +11,192 @@ Functions for sending email. Uses SMTP.
 
 import smtplib
 import ssl
+import functools
+import time
+import datetime
+import concurrent.futures
 from email.message import EmailMessage
 from email.headerregistry import Address
 
 import html2text
 import logging
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
+from google.cloud import ndb
 import config
+import instrumentation
+import utils
+
+
+# Recipients is a list of tuples like `[(address, name),...]` or just a single tuple
+# like `(address, name)`.
+Recipients = Union[Tuple[Tuple[str, str]], Tuple[str, str]]
+
+# A message for `send_many()`: (recipients, subject, body_html, body_text)
+Message = Tuple[Recipients, str, Optional[str], Optional[str]]
+
+# When sending over parallel connections, each connection gets at least this many
+# messages. Otherwise the handshakes cost more than the parallelism saves.
+_MIN_MESSAGES_PER_CONNECTION = 10
+
+# Backoff between attempts to send an outbox message doubles, up to this.
+_OUTBOX_MAX_BACKOFF_SECS = 6 * 60 * 60
+
+# These errors are about a particular message; the connection is still good.
+_MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class OutboxMessage(ndb.Model):
+    """An email waiting to be sent (or that has been sent) by `drain_outbox()`.
+    Messages enqueued with a key use it as their datastore ID, so that the same
+    message isn't sent twice.
+    """
+    recipients = ndb.JsonProperty(verbose_name='List of [address, name]')
+    subject = ndb.TextProperty()
+    body_html = ndb.TextProperty()
+    body_text = ndb.TextProperty()
+    # Only pending messages are considered for sending. (This is a single-property
+    # query, so doesn't need a composite index.)
+    pending = ndb.BooleanProperty(default=True)
+    attempts = ndb.IntegerProperty(default=0, indexed=False)
+    next_attempt = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    sent = ndb.DateTimeProperty(indexed=False)
+
+    _ndb_client = ndb.Client()
+
+
+def enqueue(
+        recipients: Recipients,
+        subject: str,
+        body_html: Optional[str],
+        body_text: Optional[str],
+        key: Optional[str] = None) -> bool:
+    """Add an email to the outbox, to be sent by `drain_outbox()`. The arguments are
+    the same as for `send()`. If `key` is given and a message with that key has
+    already been enqueued (within config.EMAIL_OUTBOX_RETENTION_DAYS), this one isn't.
+    Returns True if the message was enqueued, False if it was a duplicate. Raises
+    exception if the outbox can't be written to.
+    """
+
+    if config.DEMO:
+        # Emails to users are disabled to prevent abuse.
+        return True
+
+    if not recipients:
+        return True
+
+    if isinstance(recipients[0], str):
+        # We were passed just `(address, name)`.
+        recipients = [recipients]
+
+    if not body_text and not body_html:
+        raise Exception('emailer.enqueue: body_text or body_html must be provided')
+
+    with instrumentation.ndb_context(OutboxMessage._ndb_client):
+        message = OutboxMessage(
+            recipients=[list(r) for r in recipients],
+            subject=subject,
+            body_html=body_html,
+            body_text=body_text)
+
+        if not key:
+            message.put()
+            return True
+
+        @ndb.transactional()
+        def insert_if_new():
+            message.key = ndb.Key(OutboxMessage, key)
+            if message.key.get():
+                return False
+            message.put()
+            return True
+
+        if not insert_if_new():
+            logging.info('emailer.enqueue: already enqueued: %s', key)
+            return False
+
+    return True
+
+
+def drain_outbox(deadline: float) -> bool:
+    """Send due messages from the outbox, limited to config.EMAIL_OUTBOX_MAX_PER_SECOND.
+    Messages that fail are retried with exponential backoff, up to
+    config.EMAIL_OUTBOX_MAX_ATTEMPTS times. Also removes old messages.
+    `deadline` is a `time.monotonic()` value; no new chunk of messages is started
+    after it.
+    Returns True if all due messages were attempted.
+    Must not be run concurrently with itself, or messages may be sent twice.
+    """
+
+    now = datetime.datetime.now()
+    with instrumentation.ndb_context(OutboxMessage._ndb_client):
+        pending = OutboxMessage.query(OutboxMessage.pending == True).fetch()
+    due = sorted((m for m in pending if m.next_attempt <= now), key=lambda m: m.next_attempt)
+
+    sent_count, retry_count, failed_count = 0, 0, 0
+    latencies = []
+    complete = True
+
+    for i in range(0, len(due), config.EMAIL_OUTBOX_DRAIN_CHUNK_SIZE):
+        if time.monotonic() > deadline:
+            logging.info('emailer.drain_outbox: out of time')
+            complete = False
+            break
+
+        chunk = due[i:i+config.EMAIL_OUTBOX_DRAIN_CHUNK_SIZE]
+        results = send_many(
+            [([tuple(r) for r in m.recipients], m.subject, m.body_html, m.body_text) for m in chunk],
+            max_connections=config.EMAIL_SEND_MAX_CONNECTIONS,
+            max_per_second=config.EMAIL_OUTBOX_MAX_PER_SECOND)
+
+        now = datetime.datetime.now()
+        for message, ok in zip(chunk, results):
+            message.attempts += 1
+            if ok:
+                message.pending = False
+                message.sent = now
+                sent_count += 1
+                latencies.append((now - message.created).total_seconds())
+            elif message.attempts >= config.EMAIL_OUTBOX_MAX_ATTEMPTS:
+                message.pending = False
+                failed_count += 1
+                logging.error('emailer.drain_outbox: giving up on message after %d attempts: %s : %s',
+                              message.attempts, message.key, message.subject)
+            else:
+                backoff_secs = min(60 * 2 ** (message.attempts - 1), _OUTBOX_MAX_BACKOFF_SECS)
+                message.next_attempt = now + datetime.timedelta(seconds=backoff_secs)
+                retry_count += 1
+
+        with instrumentation.ndb_context(OutboxMessage._ndb_client):
+            ndb.put_multi(chunk)
+
+    _clear_old_outbox_messages()
+
+    latencies.sort()
+    logging.info('emailer.drain_outbox: %d due of %d pending; sent %d, retrying %d, failed %d; '
+                 'enqueue-to-send median %.1fs, max %.1fs',
+                 len(due), len(pending), sent_count, retry_count, failed_count,
+                 latencies[len(latencies) // 2] if latencies else 0,
+                 latencies[-1] if latencies else 0)
+
+    return complete
+
+
+def _clear_old_outbox_messages():
+    """Remove sent and failed messages that are older than
+    config.EMAIL_OUTBOX_RETENTION_DAYS. Until then, they're kept for de-duplication.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=config.EMAIL_OUTBOX_RETENTION_DAYS)
+    with instrumentation.ndb_context(OutboxMessage._ndb_client):
+        olds = OutboxMessage.query(OutboxMessage.created < cutoff).fetch(500)
+        olds = [m.key for m in olds if not m.pending]
+        if olds:
+            ndb.delete_multi(olds)
+    logging.info('emailer._clear_old_outbox_messages: removed %d messages', len(olds))
 
 
 def send(
-        recipients: Union[Tuple[Tuple[str, str]], Tuple[str, str]],
+        recipients: Recipients,
         subject: str,
         body_html: Optional[str],
         body_text: str) -> bool:
@@ -38,9 +213,100 @@ def send(
         # Emails to users are disabled to prevent abuse.
         return True
 
-    if not recipients:
+    msg = _build_message(recipients, subject, body_html, body_text)
+    if not msg:
         return True
 
+    ok = _send_over_connection([msg])[0]
+    if ok:
+        logging.info(f"emailer.send success")
+    return ok
+
+
+def send_many(messages: List[Message], max_connections: int = 1, max_per_second: float = None) -> List[bool]:
+    """Send many emails, reusing SMTP connections rather than setting one up for
+    each message. If a connection fails, a new one is made.
+    `messages` is a list of tuples of the arguments to `send()`.
+    If `max_connections` is more than 1, large batches are spread over that many
+    parallel connections. If `max_per_second` is given, the overall send rate is
+    limited to it.
+    Returns a list of the success of each message. Does not throw exception.
+    """
+
+    if config.DEMO:
+        # Emails to users are disabled to prevent abuse.
+        return [True] * len(messages)
+
+    started = time.monotonic()
+
+    results = [True] * len(messages)
+    msgs = []
+    msg_indexes = []
+    for i, message in enumerate(messages):
+        msg = _build_message(*message)
+        if msg:
+            msgs.append(msg)
+            msg_indexes.append(i)
+
+    rate_limiter = utils.RateLimiter(max_per_second) if max_per_second else None
+
+    connections = max(1, min(max_connections, len(msgs) // _MIN_MESSAGES_PER_CONNECTION))
+    if connections == 1:
+        sent = _send_over_connection(msgs, rate_limiter)
+    else:
+        # Deal the messages out to the connections
+        sent = [False] * len(msgs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(_send_over_connection, msgs[c::connections], rate_limiter) for c in range(connections)]
+            for c, future in enumerate(futures):
+                sent[c::connections] = future.result()
+
+    for i, ok in zip(msg_indexes, sent):
+        results[i] = ok
+
+    duration = time.monotonic() - started
+    logging.info('emailer.send_many: sent %d of %d messages in %.2fs (%.1f/s) over %d connection(s)',
+                 sum(results), len(results), duration, len(results) / duration if duration else 0, connections)
+
+    return results
+
+
+def send_to_admins(subject: str, body_text: str) -> bool:
+    """Send an email to the configured admin(s), via the outbox. If the outbox can't be
+    written to, it's sent directly instead.
+    Returns True on success, false otherwise. Does not throw exception.
+    """
+    recipients = (config.MASTER_EMAIL_ADDRESS, config.MASTER_EMAIL_SEND_NAME)
+    try:
+        return enqueue(recipients, subject, None, body_text)
+    except Exception:
+        # This is called on error paths, which mustn't fail because of it
+        logging.exception('emailer.send_to_admins: enqueue failed; sending directly')
+        return send(recipients, subject, None, body_text)
+
+
+@functools.lru_cache(maxsize=256)
+def html_to_text(body_html: str) -> str:
+    """Derive the plaintext alternative of an HTML email body.
+    Cached, since batches of email often share a body.
+    """
+    h2t = html2text.HTML2Text()
+    h2t.body_width = 0
+    return h2t.handle(body_html)
+
+
+def _build_message(
+        recipients: Recipients,
+        subject: str,
+        body_html: Optional[str],
+        body_text: Optional[str]) -> Optional[EmailMessage]:
+    """Build the email message. See `send()` for the arguments.
+    Returns None if there are no recipients.
+    """
+
+    if not recipients:
+        return None
+
     if isinstance(recipients[0], str):
         # We were passed just `(address, name)`.s
         recipients = [recipients]
@@ -48,9 +314,7 @@ def send(
     if not body_text and not body_html:
         raise Exception('emailer.send: body_text or body_html must be provided')
     elif body_html and not body_text:
-        h2t = html2text.HTML2Text()
-        h2t.body_width = 0
-        body_text = h2t.handle(body_html)
+        body_text = html_to_text(body_html)
 
     msg = EmailMessage()
     msg['Subject'] = subject
@@ -61,23 +325,65 @@ def send(
     if body_html:
         msg.add_alternative(body_html, subtype='html')
 
+    return msg
+
+
+@instrumentation.instrumented('smtp')
+def _connect() -> smtplib.SMTP:
+    """Open an authenticated connection to the SMTP server.
+    """
     context = ssl.create_default_context()
+    if config.SMTP_CA_FILE:
+        context.load_verify_locations(cafile=config.SMTP_CA_FILE)
+    # Note that using SMTP_SSL here, rather than SMTP+starttls, results in an error: `ssl.SSLError: [SSL: WRONG_VERSION_NUMBER] wrong version number (_ssl.c:1131)`
+    server = smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT)
     try:
-        # Note that using SMTP_SSL here, rather than SMTP+starttls, results in an error: `ssl.SSLError: [SSL: WRONG_VERSION_NUMBER] wrong version number (_ssl.c:1131)`
-        with smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT) as server:
-            server.starttls(context=context)
-            server.login(config.MASTER_EMAIL_ADDRESS, config.SMTP_PASSWORD)
-            server.send_message(msg)
-    except Exception as e:
-        logging.error(f"emailer.send fail: {e}")
-        return False
-
-    logging.info(f"emailer.send success")
-    return True
+        server.starttls(context=context)
+        server.login(config.MASTER_EMAIL_ADDRESS, config.SMTP_PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    return server
 
 
-def send_to_admins(subject: str, body_text: str) -> bool:
-    """Send an email to the configured admin(s).
+def _disconnect(server: Optional[smtplib.SMTP]):
+    if not server:
+        return
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+def _send_over_connection(msgs: List[EmailMessage], rate_limiter: utils.RateLimiter = None) -> List[bool]:
+    """Send the messages in order over a single connection. If the connection fails,
+    it's reopened and the message is tried once more.
+    Returns a list of the success of each message.
     """
-    return send((config.MASTER_EMAIL_ADDRESS, config.MASTER_EMAIL_SEND_NAME),
-                subject, None, body_text)
+    results = []
+    server = None
+    try:
+        for msg in msgs:
+            if rate_limiter:
+                rate_limiter.wait()
+            ok = False
+            for attempt in range(2):
+                try:
+                    if not server:
+                        server = _connect()
+                    with instrumentation.timed('smtp'):
+                        server.send_message(msg)
+                    ok = True
+                    break
+                except _MESSAGE_ERRORS as e:
+                    logging.error(f"emailer.send fail: {e}")
+                    break
+                except Exception as e:
+                    logging.error(f"emailer.send fail: {e}")
+                    _disconnect(server)
+                    server = None
+            results.append(ok)
+    finally:
+        _disconnect(server)
+
+    return results
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright Adam Pritchard 2020
+# MIT License : https://adampritchard.mit-license.org/
+#
+
+"""
+A local, in-memory fake of the parts of the MailChimp API that `mailchimp` uses, for
+exercising MailChimp syncs without a real account.
+
+It implements:
+    GET  /3.0/lists/{list}/members             (paged with count and offset)
+    GET  /3.0/lists/{list}/members/{hash}
+    PUT  /3.0/lists/{list}/members/{hash}      (upsert)
+    POST /3.0/batches
+    GET  /3.0/batches/{id}
+    GET  /batch-results/{id}.tar.gz            (the "pre-signed" results URL)
+
+Batches stay pending for a configurable delay, so the polling is exercised, and their
+results are a gzipped tar archive of JSON files, like MailChimp's. Transient failures
+(500s) and rejected email addresses ("looks fake or invalid" 400s) can be injected.
+
+Usage:
+    python fake_mailchimp.py --port 8081 --batch-delay 2 --reject-email fake
+
+Then, in config, set MAILCHIMP_API_URL_ROOT to 'http://localhost:8081/3.0/'.
+
+This is for development only. It has no security and forgets everything on exit.
+"""
+
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import logging
+import random
+import tarfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit, parse_qs
+
+
+# Operation results are split into files of this many, like MailChimp does, so that
+# reading multi-file archives is exercised.
+_RESULTS_PER_FILE = 100
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Handles one HTTP request.
+    """
+
+    def log_message(self, format, *args):
+        logging.debug('fake_mailchimp: ' + format, *args)
+
+    def reply(self, status: int, body, content_type: str = 'application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_method(self, method: str):
+        fake = self.server.fake
+        fake._count('requests')
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        url = urlsplit(self.path)
+
+        if url.path.startswith('/batch-results/'):
+            batch_id = url.path[len('/batch-results/'):].removesuffix('.tar.gz')
+            archive = fake._batch_archive(batch_id)
+            if archive is None:
+                self.reply(404, _error(404, 'Resource Not Found'))
+            else:
+                self.reply(200, archive, 'application/x-gzip')
+            return
+
+        if not url.path.startswith('/3.0/'):
+            self.reply(404, _error(404, 'Resource Not Found'))
+            return
+
+        if fake.failure_rate and random.random() < fake.failure_rate:
+            fake._count('injected_failures')
+            self.reply(500, _error(500, 'Injected failure'))
+            return
+
+        path = url.path[len('/3.0/'):]
+        if url.query:
+            path += '?' + url.query
+
+        try:
+            body = json.loads(body) if body else None
+        except ValueError:
+            self.reply(400, _error(400, 'Invalid JSON'))
+            return
+
+        if path == 'batches' and method == 'POST':
+            self.reply(200, fake._create_batch(body.get('operations', [])))
+        elif path.startswith('batches/') and method == 'GET':
+            batch = fake._get_batch(path[len('batches/'):], self.server_base_url())
+            self.reply(200 if batch else 404, batch or _error(404, 'Resource Not Found'))
+        else:
+            status, response = fake._apply(method, path, body)
+            self.reply(status, response)
+
+    def server_base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def do_GET(self):
+        self.handle_method('GET')
+
+    def do_PUT(self):
+        self.handle_method('PUT')
+
+    def do_POST(self):
+        self.handle_method('POST')
+
+
+def _error(status: int, detail: str) -> dict:
+    return {'status': status, 'title': http.server.BaseHTTPRequestHandler.responses.get(status, ('',))[0], 'detail': detail}
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeMailChimp(object):
+    """An in-memory fake MailChimp API server, run on a background thread.
+    `batch_delay` is how long, in seconds, a batch stays pending before it's run.
+    `failure_rate` is the fraction of API requests that fail with a 500.
+    `reject_email` is a substring; upserts of email addresses containing it are
+    rejected with MailChimp's permanent "looks fake or invalid" 400.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 0,
+                 batch_delay: float = 0, failure_rate: float = 0, reject_email: str = None):
+        self.batch_delay = batch_delay
+        self.failure_rate = failure_rate
+        self.reject_email = reject_email
+
+        self._lock = threading.Lock()
+        # Maps (list ID, subscriber hash) to list member dicts. Guarded by _lock.
+        self._members = {}
+        # Maps batch ID to {'submitted', 'operations', 'results'}. Guarded by _lock.
+        self._batches = {}
+        self._stats = {'requests': 0, 'injected_failures': 0, 'batches': 0, 'operations': 0}
+
+        self._server = _Server((host, port), _Handler)
+        self._server.fake = self
+        self.host, self.port = self._server.server_address[:2]
+        self.url_root = f'http://{self.host}:{self.port}/3.0/'
+        self._thread = None
+
+    def _count(self, stat: str, n: int = 1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, members=len(self._members))
+
+    def members(self, list_id: str) -> dict:
+        """Returns a dict mapping email address to list member, for the list.
+        """
+        with self._lock:
+            return {m['email_address']: dict(m) for (l, _), m in self._members.items() if l == list_id}
+
+    def _apply(self, method: str, path: str, body):
+        """Perform a list member API request. Used for direct requests and batch
+        operations. Returns a tuple of (status code, response dict).
+        """
+        path, _, query = path.partition('?')
+        parts = path.strip('/').split('/')
+        if len(parts) < 3 or parts[0] != 'lists' or parts[2] != 'members':
+            return 404, _error(404, 'Resource Not Found')
+        list_id = parts[1]
+
+        if len(parts) == 3 and method == 'GET':
+            params = parse_qs(query)
+            count = int(params.get('count', ['10'])[0])
+            offset = int(params.get('offset', ['0'])[0])
+            with self._lock:
+                list_members = sorted((m for (l, _), m in self._members.items() if l == list_id),
+                                      key=lambda m: m['id'])
+            return 200, {'members': list_members[offset:offset+count], 'total_items': len(list_members)}
+
+        if len(parts) != 4:
+            return 404, _error(404, 'Resource Not Found')
+        key = (list_id, parts[3])
+
+        if method == 'GET':
+            with self._lock:
+                list_member = self._members.get(key)
+            if not list_member:
+                return 404, _error(404, 'The requested resource could not be found.')
+            return 200, dict(list_member)
+
+        if method == 'PUT':
+            email = (body or {}).get('email_address', '')
+            if not email or hashlib.md5(email.lower().encode('utf-8')).hexdigest() != key[1]:
+                return 400, _error(400, 'The resource submitted could not be validated.')
+            if self.reject_email and self.reject_email in email:
+                return 400, _error(400, f'{email} looks fake or invalid, please enter a real email address.')
+            with self._lock:
+                list_member = self._members.get(key) or {
+                    'id': key[1],
+                    'status': body.get('status_if_new', 'subscribed'),
+                    'merge_fields': {},
+                }
+                list_member['email_address'] = email
+                list_member['merge_fields'] = dict(list_member['merge_fields'], **body.get('merge_fields', {}))
+                self._members[key] = list_member
+                return 200, dict(list_member)
+
+        return 405, _error(405, 'Method Not Allowed')
+
+    def _create_batch(self, operations: list) -> dict:
+        batch_id = uuid.uuid4().hex[:10]
+        with self._lock:
+            self._batches[batch_id] = {'submitted': time.monotonic(), 'operations': operations, 'results': None}
+        self._count('batches')
+        self._count('operations', len(operations))
+        return {'id': batch_id, 'status': 'pending', 'total_operations': len(operations),
+                'finished_operations': 0, 'errored_operations': 0, 'response_body_url': ''}
+
+    def _get_batch(self, batch_id: str, base_url: str):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if not batch:
+            return None
+
+        if time.monotonic() - batch['submitted'] < self.batch_delay:
+            return {'id': batch_id, 'status': 'started', 'total_operations': len(batch['operations']),
+                    'finished_operations': 0, 'errored_operations': 0, 'response_body_url': ''}
+
+        if batch['results'] is None:
+            results = []
+            for op in batch['operations']:
+                op_body = json.loads(op['body']) if op.get('body') else None
+                status, response = self._apply(op['method'], op['path'], op_body)
+                results.append({'status_code': status, 'operation_id': op.get('operation_id'),
+                                'response': json.dumps(response)})
+            with self._lock:
+                batch['results'] = results
+
+        return {'id': batch_id, 'status': 'finished',
+                'total_operations': len(batch['results']),
+                'finished_operations': len(batch['results']),
+                'errored_operations': sum(1 for r in batch['results'] if r['status_code'] >= 400),
+                'response_body_url': f'{base_url}/batch-results/{batch_id}.tar.gz'}
+
+    def _batch_archive(self, batch_id: str):
+        """Returns the gzipped tar archive of a finished batch's results, or None.
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if not batch or batch['results'] is None:
+            return None
+
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+            results = batch['results']
+            for i in range(0, max(len(results), 1), _RESULTS_PER_FILE):
+                data = json.dumps(results[i:i+_RESULTS_PER_FILE]).encode('utf-8')
+                info = tarfile.TarInfo(f'{batch_id}/{i // _RESULTS_PER_FILE}.json')
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        return buf.getvalue()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--batch-delay', type=float, default=0, help='seconds before a batch finishes')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of requests that fail with a 500')
+    parser.add_argument('--reject-email', default=None, help='reject upserts of email addresses containing this')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    fake = FakeMailChimp(port=args.port, batch_delay=args.batch_delay,
+                         failure_rate=args.failure_rate, reject_email=args.reject_email)
+    fake.start()
+    print(f'fake_mailchimp listening on {fake.host}:{fake.port}')
+    print(f'MAILCHIMP_API_URL_ROOT = {fake.url_root!r}')
+    try:
+        while True:
+            time.sleep(10)
+            logging.info('fake_mailchimp: %s', fake.stats())
+    except KeyboardInterrupt:
+        fake.stop()
@@ -5,21 +5,32 @@
 # MIT License : https://adampritchard.mit-license.org/
 #
 
-from typing import Optional, List
+from typing import Dict, Optional, List, Tuple
 import os
 import logging
 import uuid
+import time
 import datetime
+import csv
+import gzip
+import io
+import tempfile
+import threading
+import concurrent.futures
 import flask
 import dateutil
 from dateutil.relativedelta import relativedelta
+from google.api_core import exceptions as google_exceptions
 from google.cloud import tasks_v2
+from google.cloud import ndb
 
 import config
+import instrumentation
 import utils
 import helpers
 import mailchimp
 import sheetdata
+import local_tasks
 
 
 # This will make our life a little easier in this file.
@@ -61,56 +72,73 @@ def member_dict_from_request(request: flask.Request, actor: str, join_or_renew:
     logging.info('member_dict_from_request')
     logging.info(list(request.values.items()))
 
-    # Make sure the user/form/request isn't trying to mess with fields that it
-    # shouldn't be.
-    for name, field in _S.member.fields._asdict().items():
-        if not field.form_field and request.values.get(name) is not None:
-            # There is a field provided in the request that isn't one that's allowed to be
-            # set via the form. This can be achieved by an attacker by modifying the page
-            # elements. This causes the request processing to stop.
-            flask.abort(400, description='invalid field')
+    member, error = member_dict_from_values(
+        request.values,
+        request.values.get(_GEOPOSITION_VALUE_KEY, ''),
+        actor,
+        join_or_renew)
+
+    if not member:
+        # This causes the request processing to stop
+        flask.abort(400, description=error)
+
+    return member
 
-        if field.values is not None and request.values.get(name) is not None \
-            and not set(request.values.get(name).split(config.MULTIVALUE_DIVIDER)).issubset(field.values):
-            # This field has a restricted set of allowed values, and the form has provided
-            # one that isn't allowed. This causes the request processing to stop.
-            flask.abort(400, description='invalid field value')
 
-    member = config.validate_member(request.values)
+def member_dict_from_values(
+        values: dict, geoposition: str, actor: str, join_or_renew: str,
+        geocode: bool = True, date: str = None) -> Tuple[Optional[dict], Optional[str]]:
+    """Creates a dict of member info from form values (a dict of field name to value).
+    `geoposition` is the position the member was signed up at, or empty. The other
+    arguments are as for `member_dict_from_request()`.
+    If `geocode` is False, the address isn't geocoded and Address LatLong is left empty,
+    for callers that geocode many members at once.
+    `date` is the Joined/Renewed date, like `utils.current_datetime()`, if the form wasn't
+    submitted today.
+    Returns a tuple of (member dict, None) on success, or (None, description of the
+    problem) if the values are invalid.
+    """
+
+    # Validate, and make sure the user/form/request isn't trying to mess with fields that
+    # it shouldn't be.
+    member, error = _S.member.validation_plan.validate_form(values)
 
     if not member:
-        logging.warning('gapps.member_dict_from_request: config.validate_member failed')
-        # This causes the request processing to stop
-        flask.abort(400, description='invalid input')
+        logging.warning('gapps.member_dict_from_values: validation failed: %s', error)
+        return None, error
 
     # We didn't validate the geoposition above, so do it now
-    geoposition = request.values.get(_GEOPOSITION_VALUE_KEY, '')
     geoposition_required = _S.member.fields.joined_latlong.required \
                             if join_or_renew == 'join' else \
                             _S.member.fields.renewed_latlong.required
     if not utils.latlong_validator(geoposition, geoposition_required):
-        logging.warning('gapps.member_dict_from_request: utils.latlong_validator failed')
-        flask.abort(400, description='invalid input')
-    geoaddress = helpers.address_from_latlong(geoposition)
+        logging.warning('gapps.member_dict_from_values: utils.latlong_validator failed')
+        return None, 'invalid input'
+    geoaddress = _geoaddress_for_request(geoposition)
+    date = date or utils.current_datetime()
 
     if join_or_renew == 'join':
         # Set the GUID field
         member[_S.member.fields.id.name] = str(uuid.uuid4())
         # Set the timestamps
-        member[_S.member.fields.joined.name] = utils.current_datetime()
+        member[_S.member.fields.joined.name] = date
         member[_S.member.fields.joined_by.name] = actor
         member[_S.member.fields.joined_latlong.name] = geoposition
         member[_S.member.fields.joined_address.name] = geoaddress
 
     # These get set regardless of mode
-    member[_S.member.fields.renewed.name] = utils.current_datetime()
+    member[_S.member.fields.renewed.name] = date
     member[_S.member.fields.renewed_by.name] = actor
     member[_S.member.fields.renewed_latlong.name] = geoposition
     member[_S.member.fields.renewed_address.name] = geoaddress
 
-    member[_S.member.fields.address_latlong.name] = helpers.latlong_for_record(
-                                                            _S.member.fields,
-                                                            member)
+    # If geocoding is deferred, Address LatLong is left as None, so a renewal doesn't
+    # clear it. When the row is written it's cleared if the address has changed; see
+    # `_clear_latlong_if_address_changed()`.
+    member[_S.member.fields.address_latlong.name] = None if config.GEOCODE_DEFERRED or not geocode else \
+                                                    helpers.latlong_for_record(
+                                                        _S.member.fields,
+                                                        member)
 
     # We want the "MailChimp Updated" field to be cleared, regardless of mode
     member[_S.member.fields.mailchimp_updated.name] = ''
@@ -124,7 +152,7 @@ def member_dict_from_request(request: flask.Request, actor: str, join_or_renew:
         member[_S.member.fields.renewed_latlong.name] = ''
         member[_S.member.fields.renewed_address.name] = 'Demo'
 
-    return member
+    return member, None
 
 
 def volunteer_dict_from_request(request: flask.Request, actor: str) -> dict:
@@ -134,24 +162,14 @@ def volunteer_dict_from_request(request: flask.Request, actor: str) -> dict:
 
     logging.debug('gapps.volunteer_dict_from_request: %s', list(request.values.items()))
 
-    # Make sure the user/form/request isn't trying to mess with fields that it
-    # shouldn't be.
-    for name, field in _S.volunteer.fields._asdict().items():
-        if not field.form_field and request.values.get(name) is not None:
-            # This causes the request processing to stop
-            flask.abort(400, description='invalid field')
-
-        if field.values is not None and request.values.get(name) is not None \
-           and not set(request.values.get(name).split(config.MULTIVALUE_DIVIDER)).issubset(field.values):
-            # This causes the request processing to stop
-            flask.abort(400, description='invalid field value')
-
-    volunteer = config.validate_volunteer(request.values)
+    # Validate, and make sure the user/form/request isn't trying to mess with fields that
+    # it shouldn't be.
+    volunteer, error = _S.volunteer.validation_plan.validate_form(request.values)
 
     if not volunteer:
-        logging.warning('gapps.volunteer_dict_from_request: config.validate_volunteer failed')
+        logging.warning('gapps.volunteer_dict_from_request: validation failed: %s', error)
         # This causes the request processing to stop
-        flask.abort(400, description='invalid input')
+        flask.abort(400, description=error)
 
     # We didn't validate the geoposition above, so do it now
     geoposition = request.values.get(_GEOPOSITION_VALUE_KEY, '')
@@ -159,7 +177,7 @@ def volunteer_dict_from_request(request: flask.Request, actor: str) -> dict:
     if not utils.latlong_validator(geoposition, geoposition_required):
         logging.warning('gapps.volunteer_dict_from_request: utils.latlong_validator failed')
         flask.abort(400, description='invalid input')
-    geoaddress = helpers.address_from_latlong(geoposition)
+    geoaddress = _geoaddress_for_request(geoposition)
 
     # Set the GUID field
     volunteer[_S.volunteer.fields.id.name] = str(uuid.uuid4())
@@ -169,12 +187,22 @@ def volunteer_dict_from_request(request: flask.Request, actor: str) -> dict:
     volunteer[_S.volunteer.fields.joined_latlong.name] = geoposition
     volunteer[_S.volunteer.fields.joined_address.name] = geoaddress
 
-    volunteer[_S.volunteer.fields.address_latlong.name] = \
+    volunteer[_S.volunteer.fields.address_latlong.name] = '' if config.GEOCODE_DEFERRED else \
         helpers.latlong_for_record(_S.volunteer.fields, volunteer)
 
     return volunteer
 
 
+def _geoaddress_for_request(geoposition: str) -> str:
+    """Reverse geocodes the position a form was submitted from. If geocoding is
+    deferred, returns empty string; the address will be filled in by
+    `enrich_record_geocoding()` later.
+    """
+    if config.GEOCODE_DEFERRED:
+        return ''
+    return helpers.address_from_latlong(geoposition)
+
+
 def join_or_renew_member_from_dict(member_dict: dict) -> str:
     """Renews the member if the email address already exists, otherwise joins
     the member as brand new. Returns 'renew' in the former case, 'join' in the
@@ -192,25 +220,363 @@ def join_or_renew_member_from_dict(member_dict: dict) -> str:
     if conflict_row:
         logging.debug('found conflicting entry; updating')
 
-        # Clear the fields that should not be set when renewing.
-        # TODO: This is a hack. It would be better to not fill in the fields in the first
-        # place. Instead we need to make sure the fields set in member_dict_from_request()
-        # are the same ones we clear here. We should find a better way.
-        member_dict[_S.member.fields.id.name] = None
-        member_dict[_S.member.fields.joined.name] = None
-        member_dict[_S.member.fields.joined_by.name] = None
-        member_dict[_S.member.fields.joined_latlong.name] = None
-        member_dict[_S.member.fields.joined_address.name] = None
+        _clear_join_fields(member_dict)
+        _clear_latlong_if_address_changed(member_dict, conflict_row)
 
+        # The ID in member_dict was just cleared, so take it from the row before updating
+        record_id = conflict_row.dict.get(_S.member.fields.id.name)
         conflict_row.dict.update(member_dict)
         conflict_row.update()
+        # Callers (like the renewal email task) need to know which member this is
+        member_dict[_S.member.fields.id.name] = record_id
+        _enqueue_geocode_enrichment('member', record_id)
         return 'renew'
     else:
         logging.debug('no conflict found; creating')
         sheetdata.Row(member_dict, sheet=_S.member).append()
+        _enqueue_geocode_enrichment('member', member_dict.get(_S.member.fields.id.name))
         return 'join'
 
 
+def _clear_join_fields(member_dict: dict):
+    """Clear the fields that should not be set when renewing, in a member dict that was
+    created for joining.
+    """
+    # TODO: This is a hack. It would be better to not fill in the fields in the first
+    # place. Instead we need to make sure the fields set in member_dict_from_values()
+    # are the same ones we clear here. We should find a better way.
+    member_dict[_S.member.fields.id.name] = None
+    member_dict[_S.member.fields.joined.name] = None
+    member_dict[_S.member.fields.joined_by.name] = None
+    member_dict[_S.member.fields.joined_latlong.name] = None
+    member_dict[_S.member.fields.joined_address.name] = None
+
+
+def _clear_latlong_if_address_changed(member_dict: dict, row: sheetdata.Row):
+    """If the Address LatLong of a member dict that's going to update `row` is to be
+    filled in later (it's None), set it to empty if the address is changing, so that the
+    stale coordinates are replaced. Otherwise the row's coordinates are kept.
+    """
+    fields = _S.member.fields
+    if member_dict.get(fields.address_latlong.name) is not None:
+        return
+
+    for field in (fields.street_num, fields.street_name, fields.city, fields.postal_code):
+        new_value = member_dict.get(field.name)
+        # Cells can come back from the sheet as numbers
+        old_value = row.dict.get(field.name)
+        old_value = '' if old_value is None else str(old_value)
+        if new_value is not None and new_value != old_value:
+            member_dict[fields.address_latlong.name] = ''
+            return
+
+
+def import_members(records: List[dict], actor: str) -> Tuple[Optional[dict], List[str]]:
+    """Joins or renews many members at once, like from a CSV of members signed up on
+    paper. Each record is a dict of field name to value, like a form submission. Blank
+    values are dropped, so that they don't clear existing values when renewing.
+    Every record is validated before anything is written. If any are invalid (or repeat
+    an email address), nothing is written.
+    Members are renewed if their email address already exists, otherwise joined. The
+    writes are batched; see `_join_or_renew_members()`.
+    `actor` is the ID/email of the person doing the import.
+    Returns a tuple of (dict of counts, []) on success, or (None, list of problems).
+    """
+
+    fields = _S.member.fields
+    form_field_names = {f.name for f in fields if f.form_field}
+
+    errors = []
+    members = []
+    seen_emails = set()
+    for i, record in enumerate(records):
+        line_num = i + 2 # 1-based, after the headings
+
+        values = {k.strip(): v.strip() for k, v in record.items()
+                  if k and isinstance(v, str) and v.strip()}
+
+        unknown = sorted(set(values) - form_field_names)
+        if unknown:
+            errors.append(f'line {line_num}: unknown fields: {", ".join(unknown)}')
+            continue
+
+        member, error = member_dict_from_values(values, '', actor, 'join', geocode=False)
+        if not member:
+            invalid = [f.name for f in fields if not f.validator(values.get(f.name), f.required)]
+            errors.append(f'line {line_num}: {error}: {", ".join(invalid)}' if invalid else f'line {line_num}: {error}')
+            continue
+
+        email = member[fields.email.name]
+        if email in seen_emails:
+            errors.append(f'line {line_num}: email address repeated: {email}')
+            continue
+        seen_emails.add(email)
+
+        members.append(member)
+
+    if errors:
+        logging.warning('gapps.import_members: %d invalid records', len(errors))
+        return None, errors
+
+    results = _join_or_renew_members([('join', member) for member in members])
+
+    summary = {
+        'joined': sum(1 for outcome, _ in results if outcome == 'join'),
+        'renewed': sum(1 for outcome, _ in results if outcome == 'renew'),
+        'geocode_failed': sum(1 for member in members
+                              if _has_geocodable_address(member) and not member[fields.address_latlong.name]),
+    }
+    logging.info('gapps.import_members: %s', summary)
+    return summary, []
+
+
+class SyncedSubmission(ndb.Model):
+    """Records the outcome of an offline-queued form submission that has been applied, so
+    that if it's sent again (like when the response to a batch sync was lost), it isn't
+    applied again. Keyed by the UUID the client gave the submission.
+    """
+    result = ndb.TextProperty()
+    error = ndb.TextProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    _ndb_client = ndb.Client()
+
+    @classmethod
+    def clear_olds(cls) -> int:
+        """Remove records older than config.SYNCED_SUBMISSION_RETENTION_DAYS.
+        Returns the count of records removed.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=config.SYNCED_SUBMISSION_RETENTION_DAYS)
+        with instrumentation.ndb_context(cls._ndb_client):
+            olds = cls.query(cls.created < cutoff).fetch(keys_only=True)
+            if not olds:
+                return 0
+            ndb.delete_multi(olds)
+            return len(olds)
+
+
+def sync_member_submissions(submissions: List[dict], actor: str) -> List[dict]:
+    """Processes a batch of new-member and renew-member form submissions that were
+    queued by the admin site while it was offline.
+    Each submission is a dict with 'id' (the client's ID for it), 'uuid' (a unique ID
+    the client generated for it), 'form' ('new-member' or 'renew-member'), 'values' (the
+    form values) and 'queued' (when it was submitted, in milliseconds since the epoch).
+    They're handled like the forms would handle them, but dated when they were queued,
+    and the writes are batched; see `_join_or_renew_members()`. Submissions whose UUID
+    has been synced before get their earlier result, and aren't applied again.
+    `actor` is the ID/email of the person syncing.
+    Returns a list with a dict for each submission, with 'id', and 'result' ('join',
+    'renew' or 'error') and 'error' (a description of the problem, or None).
+    """
+
+    uuids = [_submission_uuid(submission) for submission in submissions]
+    with instrumentation.ndb_context(SyncedSubmission._ndb_client):
+        synced = ndb.get_multi([ndb.Key(SyncedSubmission, u) for u in uuids if u])
+    synced = {record.key.id(): record for record in synced if record}
+
+    results = [None] * len(submissions)
+    pending = [] # tuples of (index into submissions, mode, member dict)
+    first_index = {} # by UUID, the index of the submission that's processed
+    for i, (submission, submission_uuid) in enumerate(zip(submissions, uuids)):
+        if submission_uuid in synced:
+            results[i] = (synced[submission_uuid].result, synced[submission_uuid].error)
+            continue
+        if submission_uuid in first_index:
+            # Repeated within this batch; it gets the first one's result below
+            continue
+        if submission_uuid:
+            first_index[submission_uuid] = i
+
+        form = submission.get('form')
+        mode = _SUBMISSION_FORM_MODES.get(form) if isinstance(form, str) else None
+        values = submission.get('values')
+        # This comes from the client's JSON, so it could be anything
+        if not mode or not isinstance(values, dict) or \
+                not all(isinstance(k, str) and isinstance(v, str) for k, v in values.items()):
+            results[i] = ('error', 'invalid submission')
+            continue
+
+        member, error = member_dict_from_values(
+            values, values.get(_GEOPOSITION_VALUE_KEY, ''), actor, mode, geocode=False,
+            date=_submission_date(submission.get('queued')))
+        if not member:
+            results[i] = ('error', error)
+            continue
+
+        pending.append((i, mode, member))
+
+    written = _join_or_renew_members([(mode, member) for _, mode, member in pending])
+    for (i, _, _), (outcome, error) in zip(pending, written):
+        results[i] = (outcome or 'error', error)
+
+    for i, submission_uuid in enumerate(uuids):
+        if results[i] is None:
+            results[i] = results[first_index[submission_uuid]]
+
+    # Only the submissions that were applied are recorded. Those that failed wrote
+    # nothing, so if one is sent again (perhaps after the problem is fixed), it should
+    # be processed again.
+    with instrumentation.ndb_context(SyncedSubmission._ndb_client):
+        ndb.put_multi([SyncedSubmission(id=submission_uuid, result=results[i][0], error=results[i][1])
+                       for submission_uuid, i in first_index.items() if results[i][0] != 'error'])
+
+    logging.info('gapps.sync_member_submissions: %d submissions; %d already synced; %d errors',
+                 len(submissions), sum(1 for u in uuids if u in synced),
+                 sum(1 for result, _ in results if result == 'error'))
+
+    return [{'id': submission.get('id'), 'result': result, 'error': error}
+            for submission, (result, error) in zip(submissions, results)]
+
+
+def _submission_uuid(submission: dict) -> Optional[str]:
+    """The client's UUID for an offline-queued submission, or None if it doesn't have a
+    valid one.
+    """
+    submission_uuid = submission.get('uuid')
+    try:
+        return str(uuid.UUID(submission_uuid))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def _submission_date(queued) -> Optional[str]:
+    """The date that an offline-queued submission was made, given when it was queued
+    (in milliseconds since the epoch), or None if that isn't valid. Times in the future
+    (according to the client's clock) are taken as today.
+    """
+    if not isinstance(queued, (int, float)) or isinstance(queued, bool) or queued <= 0:
+        return None
+    return utils.date_from_timestamp(min(queued / 1000, time.time()))
+
+
+# Maps the admin forms that can be submitted offline to `member_dict_from_values()` modes
+_SUBMISSION_FORM_MODES = {
+    'new-member': 'join',
+    'renew-member': 'renew',
+}
+
+
+def _has_geocodable_address(member_dict: dict) -> bool:
+    """Whether a member dict has enough of an address to geocode: a street name, or at
+    least a postal code.
+    """
+    return bool(member_dict.get(_S.member.fields.street_name.name) or
+                member_dict.get(_S.member.fields.postal_code.name))
+
+
+def _join_or_renew_members(submissions: List[Tuple[str, dict]]) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Joins and renews many members, with one snapshot of the members sheet and batched
+    writes. Each submission is a tuple of (mode, member dict from
+    `member_dict_from_values()` with `geocode=False`).
+    In 'join' mode the member is joined, or renewed if their email address already exists,
+    like `join_or_renew_member_from_dict()`. In 'renew' mode the member with the dict's ID
+    is renewed, like `renew_member_from_dict()`.
+    Addresses are geocoded concurrently (but rate-limited); addresses that fail are left
+    for the geocode backfill job, and renewals keep their existing coordinates unless the
+    address changed. Then the renewals are written in one batched update, of only the
+    cells they supply, and the new members in one batched append, and the emails (as the
+    admin forms would send) and geocode enrichment tasks are enqueued together.
+    Returns a list with a tuple for each submission of ('join' or 'renew', None), or
+    (None, description of the problem).
+    """
+
+    if not submissions:
+        return []
+
+    fields = _S.member.fields
+
+    # One snapshot of the sheet for all of the lookups. Where an email address appears
+    # more than once, the first row is used, like `Row.find()`.
+    all_rows = sheetdata.find_rows(_S.member, matcher=None)
+    rows_by_email = {}
+    rows_by_id = {}
+    for row in all_rows:
+        if row.dict.get(fields.email.name):
+            rows_by_email.setdefault(row.dict[fields.email.name], row)
+        if row.dict.get(fields.id.name):
+            rows_by_id.setdefault(row.dict[fields.id.name], row)
+    headings = all_rows[0].headings if all_rows else None
+
+    rate_limiter = utils.RateLimiter(config.GEOCODE_BACKFILL_MAX_PER_SECOND)
+
+    def geocode(member):
+        if not _has_geocodable_address(member):
+            # Don't spend a rate-limited request on it
+            return None
+        rate_limiter.wait()
+        # None, rather than empty, so that a renewal keeps the existing value
+        return helpers.latlong_for_record(fields, member) or None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.GEOCODE_BACKFILL_MAX_WORKERS) as executor:
+        latlongs = list(executor.map(geocode, [member for _, member in submissions]))
+
+    results = []
+    join_rows = []
+    join_row_ids = set()
+    renew_rows = {} # by id(), so each row is written once
+    renew_fields = {} # by id() of the row, the names of the fields supplied for it
+    tasks = []
+    for (mode, member), latlong in zip(submissions, latlongs):
+        member[fields.address_latlong.name] = latlong
+
+        if mode == 'renew':
+            row = rows_by_id.get(member[fields.id.name])
+            if not row:
+                results.append((None, 'user lookup failed'))
+                continue
+            tasks.append(('/tasks/renew-member-mail', member))
+        else:
+            row = rows_by_email.get(member[fields.email.name])
+            if row:
+                _clear_join_fields(member)
+
+        if row:
+            if not member.get(fields.renewed_latlong.name):
+                # There's no position for this renewal, so don't blank the last one's
+                member[fields.renewed_latlong.name] = None
+                member[fields.renewed_address.name] = None
+            _clear_latlong_if_address_changed(member, row)
+
+            record_id = row.dict.get(fields.id.name)
+            # None means "leave the existing value", which for a row that's still to be
+            # appended (joined earlier in this batch) means not changing its dict
+            supplied = {k: v for k, v in member.items() if v is not None}
+            row.dict.update(supplied)
+            if id(row) not in join_row_ids:
+                renew_rows[id(row)] = row
+                renew_fields.setdefault(id(row), set()).update(supplied)
+            results.append(('renew', None))
+        else:
+            record_id = member[fields.id.name]
+            row = sheetdata.Row(member, sheet=_S.member, headings=headings)
+            join_rows.append(row)
+            join_row_ids.add(id(row))
+            rows_by_email[member[fields.email.name]] = row
+            rows_by_id[record_id] = row
+            tasks.append(('/tasks/new-member-mail', member))
+            results.append(('join', None))
+
+        # Fill in the addresses of the positions it was joined or renewed at later
+        if config.GEOCODE_DEFERRED and not config.DEMO and \
+                (member.get(fields.joined_latlong.name) or member.get(fields.renewed_latlong.name)):
+            tasks.append(('/tasks/geocode-enrichment', {'sheet': 'member', 'id': record_id}))
+
+    # Only the supplied cells are written, so a renewal doesn't overwrite the rest of
+    # the row with what was read. A row's unsupplied cells in `update_fields` are None,
+    # which leaves them as they are.
+    update_fields = [h for h in headings or [] if any(h in f for f in renew_fields.values())]
+    sheetdata.update_rows(
+        _S.member,
+        [sheetdata.Row({k: row.dict.get(k) for k in renew_fields[key]}, sheet=_S.member, num=row.num, headings=headings)
+         for key, row in renew_rows.items()],
+        fields=update_fields)
+    sheetdata.append_rows(_S.member, join_rows)
+
+    enqueue_tasks(tasks)
+
+    return results
+
+
 def renew_member_from_dict(member_dict: dict):
     """Renew the membership of an existing member, while updating any info
     about them.
@@ -224,8 +590,11 @@ def renew_member_from_dict(member_dict: dict):
     if not row:
         flask.abort(400, description='user lookup failed')
 
+    _clear_latlong_if_address_changed(member_dict, row)
+
     row.dict.update(member_dict)
     row.update()
+    _enqueue_geocode_enrichment('member', member_dict[_S.member.id_field().name])
 
 
 def renew_member_by_email_or_paypal_id(email: str, paypal_payer_id: str, member_dict: dict) -> bool:
@@ -265,6 +634,8 @@ def renew_member_by_email_or_paypal_id(email: str, paypal_payer_id: str, member_
 
     row.dict.update(member_dict)
     row.update()
+    # Callers (like the renewal email task) need to know which member this is
+    member_dict[_S.member.fields.id.name] = row.dict.get(_S.member.fields.id.name)
     return True
 
 
@@ -291,11 +662,130 @@ def join_volunteer_from_dict(volunteer_dict: dict):
         volunteer_dict[_S.volunteer.fields.joined_latlong.name] = None
         volunteer_dict[_S.volunteer.fields.joined_address.name] = None
 
+        record_id = conflict_row.dict.get(_S.volunteer.fields.id.name)
         conflict_row.dict.update(volunteer_dict)
         conflict_row.update()
+        _enqueue_geocode_enrichment('volunteer', record_id)
     else:
         logging.debug('no conflict found; creating')
         sheetdata.Row(volunteer_dict, sheet=_S.volunteer).append()
+        _enqueue_geocode_enrichment('volunteer', volunteer_dict.get(_S.volunteer.fields.id.name))
+
+
+# Maps the sheet names used in geocode enrichment task params to the sheets.
+_GEOCODE_ENRICHMENT_SHEETS = {
+    'member': _S.member,
+    'volunteer': _S.volunteer,
+}
+
+def _enqueue_geocode_enrichment(sheet_name: str, record_id: str):
+    """Enqueues the task that fills in the geocoded fields of the given record, if
+    geocoding is deferred. The row must already have been written to the sheet.
+    """
+    if not config.GEOCODE_DEFERRED or config.DEMO:
+        return
+
+    if not record_id:
+        logging.error('gapps._enqueue_geocode_enrichment: missing record ID for %s', sheet_name)
+        return
+
+    enqueue_task('/tasks/geocode-enrichment', {'sheet': sheet_name, 'id': record_id})
+
+
+def enrich_record_geocoding(sheet_name: str, record_id: str):
+    """Fills in the empty geocoded fields of the member or volunteer row with ID
+    `record_id`: the address lat/long, and the addresses of the positions it was joined
+    and renewed at. Only those cells are written, so any changes made to the rest of the
+    row since it was created aren't clobbered.
+    """
+
+    sheet = _GEOCODE_ENRICHMENT_SHEETS.get(sheet_name)
+    if not sheet:
+        logging.error('gapps.enrich_record_geocoding: bad sheet name: %s', sheet_name)
+        return
+
+    row = sheetdata.Row.find(sheet, lambda d: d[sheet.id_field().name] == record_id)
+    if not row:
+        # Possibly deleted in the meantime. Nothing we can do.
+        logging.warning('gapps.enrich_record_geocoding: record not found: %s::%s', sheet_name, record_id)
+        return
+
+    updated_fields = []
+
+    if not row.dict.get(sheet.fields.address_latlong.name):
+        latlong = helpers.latlong_for_record(sheet.fields, row.dict)
+        if latlong:
+            row.dict[sheet.fields.address_latlong.name] = latlong
+            updated_fields.append(sheet.fields.address_latlong.name)
+
+    # Pairs of (position lat/long, address at that position)
+    latlong_address_fields = [(sheet.fields.joined_latlong, sheet.fields.joined_address)]
+    if sheet is _S.member:
+        latlong_address_fields.append((sheet.fields.renewed_latlong, sheet.fields.renewed_address))
+
+    for latlong_field, address_field in latlong_address_fields:
+        if not row.dict.get(latlong_field.name) or row.dict.get(address_field.name):
+            continue
+        address = helpers.address_from_latlong(row.dict[latlong_field.name])
+        if address:
+            row.dict[address_field.name] = address
+            updated_fields.append(address_field.name)
+
+    if not updated_fields:
+        logging.info('gapps.enrich_record_geocoding: nothing to update for %s::%s', sheet_name, record_id)
+        return
+
+    sheetdata.update_rows(sheet, [row], fields=updated_fields)
+
+
+def backfill_geocoding(skip_ids: List[str], deadline: float) -> Tuple[bool, List[str]]:
+    """Geocodes the member and volunteer rows that have an address but no Address
+    LatLong. Rows whose IDs are in `skip_ids` (because geocoding them failed in an
+    earlier run) are not attempted.
+    The rows are geocoded concurrently, but rate-limited. The results are written to
+    the sheet after each chunk of rows, so if a run stops partway, the next will pick up
+    from where it left off.
+    `deadline` is a `time.monotonic()` value; no new chunk is started after it.
+    Returns a tuple of (whether all rows were attempted, IDs of rows that failed).
+    """
+
+    skip_ids = set(skip_ids)
+    failed_ids = []
+    rate_limiter = utils.RateLimiter(config.GEOCODE_BACKFILL_MAX_PER_SECOND)
+
+    def geocode(sheet, row):
+        rate_limiter.wait()
+        return helpers.latlong_for_record(sheet.fields, row.dict)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.GEOCODE_BACKFILL_MAX_WORKERS) as executor:
+        for sheet in (_S.member, _S.volunteer):
+            rows = sheetdata.find_rows(
+                sheet,
+                lambda d: not d[sheet.fields.address_latlong.name]
+                            and d[sheet.fields.street_name.name]
+                            and d[sheet.fields.id.name] not in skip_ids)
+
+            logging.info('gapps.backfill_geocoding: %s: %d rows to geocode', type(sheet.fields).__name__, len(rows))
+
+            for i in range(0, len(rows), config.GEOCODE_BACKFILL_CHUNK_SIZE):
+                if time.monotonic() > deadline:
+                    logging.info('gapps.backfill_geocoding: out of time')
+                    return False, failed_ids
+
+                chunk = rows[i:i+config.GEOCODE_BACKFILL_CHUNK_SIZE]
+                latlongs = executor.map(lambda row: geocode(sheet, row), chunk)
+
+                rows_to_update = []
+                for row, latlong in zip(chunk, latlongs):
+                    if not latlong:
+                        failed_ids.append(row.dict[sheet.fields.id.name])
+                        continue
+                    row.dict[sheet.fields.address_latlong.name] = latlong
+                    rows_to_update.append(row)
+
+                sheetdata.update_rows(sheet, rows_to_update, fields=[sheet.fields.address_latlong.name])
+
+    return True, failed_ids
 
 
 def get_volunteer_interests() -> List[str]:
@@ -329,10 +819,10 @@ def authorize_new_user(request: flask.Request, current_user_email: str):
     logging.info('authorize_new_user')
     logging.info(list(request.values.items()))
 
-    new_user = config.validate_obj_against_fields(request.values, _S.authorized.fields)
+    new_user = _S.authorized.validation_plan.validate(request.values)
 
     if not new_user:
-        logging.warning('gapps.authorize_new_user: config.validate_obj_against_fields failed')
+        logging.warning('gapps.authorize_new_user: validation failed')
         # This causes the request processing to stop
         flask.abort(400, description='invalid input')
 
@@ -369,26 +859,77 @@ def get_volunteer_interest_reps_for_member(member_data: dict) -> dict:
     Returns {} if no reps found.
     """
 
-    all_reps = get_volunteer_interests()
+    reps_index = _get_volunteer_interest_reps_index()
 
     member_interests = member_data.get(_S.member.fields.volunteer_interests.name, '').split(config.MULTIVALUE_DIVIDER)
 
     interest_reps = {}
     for member_interest in member_interests:
-        reps = [rep for rep in all_reps if rep.get(_S.volunteer_interest.fields.interest.name) == member_interest and rep.get(_S.volunteer_interest.fields.email.name)]
+        reps = reps_index.get(member_interest)
         if reps:
-            interest_reps[member_interest] = reps
+            interest_reps[member_interest] = list(reps)
 
     return interest_reps
 
 
-def cull_members_sheet():
-    """Deletes defunct members from the members sheet.
+_volunteer_interest_reps_cache = {
+    'version': None,
+    'checked': 0.0,
+    'index': None,
+}
+_volunteer_interest_reps_lock = threading.Lock()
+
+def _get_volunteer_interest_reps_index() -> dict:
+    """Returns a dict mapping each volunteer interest to the list of reps (with email
+    addresses) for it. This is built from the Volunteer Interests sheet and cached; it's
+    only rebuilt when the sheet's version changes, and that is only checked every
+    config.VOLUNTEER_INTEREST_REPS_CHECK_SECS.
+    The returned dict must not be modified.
+    """
+    cache = _volunteer_interest_reps_cache
+
+    with _volunteer_interest_reps_lock:
+        now = time.monotonic()
+        if cache['index'] is not None and now - cache['checked'] < config.VOLUNTEER_INTEREST_REPS_CHECK_SECS:
+            return cache['index']
+
+        version = sheetdata.get_file_version(_S.volunteer_interest.spreadsheet_id)
+        cache['checked'] = now
+
+        if cache['index'] is not None and version == cache['version']:
+            return cache['index']
+
+        logging.info('gapps._get_volunteer_interest_reps_index: rebuilding for version %s', version)
+
+        index = {}
+        for rep in get_volunteer_interests():
+            if not rep.get(_S.volunteer_interest.fields.email.name):
+                continue
+            index.setdefault(rep.get(_S.volunteer_interest.fields.interest.name), []).append(rep)
+
+        cache['version'] = version
+        cache['index'] = index
+        return index
+
+
+def get_members_to_cull(member_rows: List[sheetdata.Row] = None) -> List[sheetdata.Row]:
+    """Returns a list of rows of defunct members, who should be culled.
+    If `member_rows` (all of the rows of the members sheet) is given, they are used
+    rather than fetching the sheet.
     """
 
     older_than = datetime.datetime.now() - relativedelta(years=2, months=1)
 
-    cull_rows = _get_members_renewed_ago(None, older_than)
+    return _get_members_renewed_ago(None, older_than, member_rows)
+
+
+def cull_members_sheet(cull_rows: List[sheetdata.Row] = None):
+    """Deletes defunct members from the members sheet.
+    If `cull_rows` is given, they are deleted rather than looking up the defunct members.
+    """
+
+    if cull_rows is None:
+        cull_rows = get_members_to_cull()
 
     if not cull_rows:
         return
@@ -424,11 +965,75 @@ def archive_members_sheet(member_sheet_year: int) -> Optional[int]:
         'Archive: Members %d' % member_sheet_year,
         'Archive of the Members spreadsheet at the end of %d' % member_sheet_year)
 
+    # The archive copy is what matters, so a failed snapshot shouldn't prevent the year
+    # from advancing. One can be made later from the admin site.
+    try:
+        snapshot_members_sheet(
+            'Snapshot: Members %d.csv.gz' % member_sheet_year,
+            'Snapshot of the Members spreadsheet at the end of %d' % member_sheet_year)
+    except Exception as e:
+        logging.exception('archive_member_sheet: snapshot failed: %s', e)
+
     return year_now
 
 
-def get_members_expiring_soon() -> List[sheetdata.Row]:
+def snapshot_members_sheet(title: str, description: str) -> Tuple[str, int]:
+    """Writes a gzipped CSV snapshot of the members sheet to Drive, beside the sheet.
+    This is for quick analysis (like year-over-year membership) with local tools, which
+    the Drive archive copies aren't good for. The columns are the member fields, and the
+    date columns are normalized to ISO 8601 (YYYY-MM-DD), so they can be parsed as dates.
+    The sheet is read, compressed and uploaded in chunks, so it's never entirely in memory.
+    Returns a tuple of (Drive file ID, count of rows).
+    """
+    fields = list(_S.member.fields)
+    date_columns = [f.name for f in fields if f.is_date]
+
+    row_count = 0
+    unparseable_count = 0
+    with tempfile.TemporaryFile() as snapshot_file:
+        with gzip.GzipFile(fileobj=snapshot_file, mode='wb') as gz, \
+             io.TextIOWrapper(gz, encoding='utf-8', newline='') as text:
+            writer = csv.writer(text)
+            writer.writerow([f.name for f in fields])
+
+            for row in sheetdata.iter_rows(_S.member):
+                values = []
+                for f in fields:
+                    value = row.dict.get(f.name)
+                    if f.is_date:
+                        value, ok = _snapshot_date(value)
+                        unparseable_count += not ok
+                    values.append('' if value is None else value)
+                writer.writerow(values)
+                row_count += 1
+
+        snapshot_file.seek(0)
+        file_id = sheetdata.upload_drive_file(
+            snapshot_file, 'application/gzip', _S.member.spreadsheet_id, title,
+            f'{description}. Date columns (YYYY-MM-DD): {", ".join(date_columns)}')
+
+    logging.info('snapshot_members_sheet: wrote %d rows to %s; %d unparseable dates blanked',
+                 row_count, file_id, unparseable_count)
+    return file_id, row_count
+
+
+def _snapshot_date(value) -> Tuple[str, bool]:
+    """Normalize a date cell value to YYYY-MM-DD.
+    Returns a tuple of (normalized value, whether the value was parseable). Empty and
+    unparseable values are normalized to an empty string.
+    """
+    if value is None or value == '':
+        return '', True
+    try:
+        return dateutil.parser.parse(str(value)).strftime('%Y-%m-%d'), True
+    except (ValueError, OverflowError):
+        return '', False
+
+
+def get_members_expiring_soon(member_rows: List[sheetdata.Row] = None) -> List[sheetdata.Row]:
     """Returns a list of rows of members expiring soon.
+    If `member_rows` (all of the rows of the members sheet) is given, they are used
+    rather than fetching the sheet.
     """
 
     # We want members whose membership will be expiring in a week. This means
@@ -437,70 +1042,215 @@ def get_members_expiring_soon() -> List[sheetdata.Row]:
     after_datetime = datetime.datetime.now() + relativedelta(years=-1, days=6)
     before_datetime = datetime.datetime.now() + relativedelta(years=-1, days=7)
 
-    expiring_rows = _get_members_renewed_ago(after_datetime, before_datetime)
+    expiring_rows = _get_members_renewed_ago(after_datetime, before_datetime, member_rows)
 
     return expiring_rows or []
 
 
-def process_mailchimp_updates():
+def process_mailchimp_updates(deadline: float, sheet_rows: Dict[config.Spreadsheet, List[sheetdata.Row]] = None) -> Tuple[bool, int]:
     """Checks Members and Volunteers spreadsheets for records that need updating
     in MailChimp.
+    If `sheet_rows` is given, it maps the Members and Volunteers sheets to rows of them
+    to consider, rather than fetching the sheets.
+    Rows whose MailChimp record hasn't changed since it was last upserted are just
+    stamped, with no MailChimp requests.
+    Rows are processed in chunks. Small backlogs are upserted concurrently, large ones
+    with MailChimp batch operations. The "MailChimp Updated" stamps are written to the
+    sheet after each chunk, so if a run stops partway, the next will pick up from where
+    it left off.
+    `deadline` is a `time.monotonic()` value; no new chunk is started after it.
+    Returns a tuple of (whether all rows were attempted, count of rows that failed).
     """
 
-    for sheet, mailchimp_upsert in (
-            (_S.member, mailchimp.upsert_member_info),
-            (_S.volunteer, mailchimp.upsert_volunteer_info),
-        ):
+    mailchimp.reset_request_count()
+    rows_updated = 0
+    rows_unchanged = 0
+    failed_count = 0
+    complete = True
 
-        rows = sheetdata.find_rows(
-            sheet,
-            lambda d: not d[sheet.fields.mailchimp_updated.name])
+    # A snapshot of the MailChimp audience, so that upserts don't each need to look up
+    # the existing entry. It's only fetched if there's something to sync.
+    audience = None
 
-        rows_to_update = []
+    def upsert(mailchimp_upsert, row):
+        try:
+            # Update MailChimp. Note that this involves a network call.
+            mailchimp_upsert(row.dict, audience)
+            return True
+        except Exception as e:
+            logging.error('gapps.process_mailchimp_updates: upsert failed: %s', row.dict, exc_info=e)
+            return False
 
+    def stamp(sheet, rows):
+        # Set the MailChimp update datetime
         for row in rows:
-            if not row.dict.get(sheet.fields.id.name):
-                logging.error('Member or Volunteer missing ID value: %s', row.dict)
-                continue
-
-            if not row.dict.get(sheet.fields.email.name):
-                # If there's no email, we don't add to MailChimp
-                continue
-
-            # Set the MailChimp update datetime
             row.dict[sheet.fields.mailchimp_updated.name] = utils.current_datetime()
+        sheetdata.update_rows(sheet, rows, fields=[sheet.fields.mailchimp_updated.name])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.MAILCHIMP_SYNC_MAX_WORKERS) as executor:
+        for sheet, mailchimp_upsert, mailchimp_batch_upsert, get_unchanged_ids, record_digests in (
+                (_S.member, mailchimp.upsert_member_info, mailchimp.batch_upsert_member_info,
+                    mailchimp.get_unchanged_member_ids, mailchimp.record_member_digests),
+                (_S.volunteer, mailchimp.upsert_volunteer_info, mailchimp.batch_upsert_volunteer_info,
+                    mailchimp.get_unchanged_volunteer_ids, mailchimp.record_volunteer_digests),
+            ):
+
+            if sheet_rows is not None:
+                rows = [row for row in sheet_rows[sheet] if not row.dict[sheet.fields.mailchimp_updated.name]]
+            else:
+                rows = sheetdata.find_rows(
+                    sheet,
+                    lambda d: not d[sheet.fields.mailchimp_updated.name])
+
+            rows_to_sync = []
+
+            for row in rows:
+                if not row.dict.get(sheet.fields.id.name):
+                    logging.error('Member or Volunteer missing ID value: %s', row.dict)
+                    continue
+
+                if not row.dict.get(sheet.fields.email.name):
+                    # If there's no email, we don't add to MailChimp
+                    continue
+
+                rows_to_sync.append(row)
+
+            # Rows get un-stamped whenever they're changed (like on renewal), but often
+            # none of the fields that go to MailChimp have changed.
+            unchanged_ids = get_unchanged_ids([row.dict for row in rows_to_sync])
+            unchanged_rows = [row for row in rows_to_sync if row.dict[sheet.fields.id.name] in unchanged_ids]
+            rows_to_sync = [row for row in rows_to_sync if row.dict[sheet.fields.id.name] not in unchanged_ids]
+            stamp(sheet, unchanged_rows)
+            rows_unchanged += len(unchanged_rows)
+
+            use_batch = len(rows_to_sync) >= config.MAILCHIMP_BATCH_THRESHOLD
+            chunk_size = config.MAILCHIMP_BATCH_MAX_OPERATIONS if use_batch else config.MAILCHIMP_SYNC_CHUNK_SIZE
+
+            logging.info('gapps.process_mailchimp_updates: %s: %d rows to sync, %d unchanged; batch: %s',
+                         type(sheet.fields).__name__, len(rows_to_sync), len(unchanged_rows), use_batch)
+
+            for i in range(0, len(rows_to_sync), chunk_size):
+                if time.monotonic() > deadline:
+                    logging.info('gapps.process_mailchimp_updates: out of time')
+                    complete = False
+                    break
+
+                chunk = rows_to_sync[i:i+chunk_size]
+
+                if audience is None:
+                    audience = mailchimp.get_audience_snapshot()
+
+                if use_batch:
+                    # Use MailChimp batch operations. The row number is a unique operation ID.
+                    try:
+                        succeeded = mailchimp_batch_upsert({str(row.num): row.dict for row in chunk}, audience)
+                    except Exception as e:
+                        # Like the batch timing out, or its results not being fetchable.
+                        # The chunk is left unstamped, to be retried; upserts are idempotent.
+                        logging.error('gapps.process_mailchimp_updates: batch upsert of %d rows failed', len(chunk), exc_info=e)
+                        succeeded = set()
+                    results = [str(row.num) in succeeded for row in chunk]
+                else:
+                    results = executor.map(lambda row: upsert(mailchimp_upsert, row), chunk)
+
+                rows_to_update = [row for row, success in zip(chunk, results) if success]
+                failed_count += len(chunk) - len(rows_to_update)
+
+                record_digests([row.dict for row in rows_to_update])
+                stamp(sheet, rows_to_update)
+                rows_updated += len(rows_to_update)
+
+            if not complete:
+                break
+
+    logging.info('gapps.process_mailchimp_updates: synced %d rows, %d unchanged, %d failed, with %d MailChimp requests',
+                 rows_updated, rows_unchanged, failed_count, mailchimp.get_request_count())
+    logging.info('gapps.process_mailchimp_updates: MailChimp request latencies:\n%s',
+                 mailchimp.get_latency_summary())
+
+    return complete, failed_count
 
-            # Update MailChimp. Note that this involves a network call.
-            # TODO: Is there a bulk upsert for Mailchimp?
-            mailchimp_upsert(row.dict)
 
-            rows_to_update.append(row)
+_TASK_QUEUE_SECRET_PARAM = 'secret'
+
+# Upper bound on concurrent task creation requests made by `enqueue_tasks()`.
+_ENQUEUE_TASKS_MAX_WORKERS = 8
 
-        sheetdata.update_rows(sheet, rows_to_update)
+_cloud_tasks_client = None
+_cloud_tasks_client_lock = threading.Lock()
 
+def _get_cloud_tasks_client() -> tasks_v2.CloudTasksClient:
+    """Returns the process-wide Cloud Tasks client, creating it if necessary.
+    Creating a client sets up a new gRPC channel, so we only want to do it once. The
+    client is thread-safe.
+    """
+    global _cloud_tasks_client
+    with _cloud_tasks_client_lock:
+        if _cloud_tasks_client is None:
+            _cloud_tasks_client = tasks_v2.CloudTasksClient()
+        return _cloud_tasks_client
 
-_TASK_QUEUE_SECRET_PARAM = 'secret'
 
-def enqueue_task(url: str, params: dict):
+@instrumentation.instrumented('cloud_tasks')
+def enqueue_task(url: str, params: dict, name: Optional[str] = None, delay_secs: int = 0):
     """Enqueue an App Engine task.
     `url` is relative. It must have no query params. The request will use the POST method.
     `params` must be something that can be JSON-encoded.
+    `name` is optional. If given, it must be unique among recent tasks in the queue (and
+    consist of letters, numbers, hyphens and underscores); a task with the same name as
+    an existing or recently-run one will not be enqueued again. Use this to prevent
+    duplicate work when the caller might be retried.
+    The task will not be run until at least `delay_secs` from now.
     """
-    client = tasks_v2.CloudTasksClient()
+    relative_uri = f'{url}?{_TASK_QUEUE_SECRET_PARAM}={config.FLASK_SECRET_KEY}'
+    body = flask.json.dumps(params).encode()
+
+    if config.TASK_QUEUE_BACKEND == 'local':
+        local_tasks.enqueue(relative_uri, body, name, delay_secs)
+        logging.info(f'enqueued local task to {url}')
+        return
+
+    client = _get_cloud_tasks_client()
     parent = client.queue_path(config.PROJECT_NAME, config.PROJECT_REGION, config.TASK_QUEUE_NAME)
 
     task = tasks_v2.Task()
+    if name:
+        task.name = client.task_path(config.PROJECT_NAME, config.PROJECT_REGION, config.TASK_QUEUE_NAME, name)
     task.app_engine_http_request = tasks_v2.AppEngineHttpRequest()
     task.app_engine_http_request.http_method = tasks_v2.HttpMethod.POST
-    task.app_engine_http_request.relative_uri = f'{url}?{_TASK_QUEUE_SECRET_PARAM}={config.FLASK_SECRET_KEY}'
-    task.app_engine_http_request.body = flask.json.dumps(params).encode()
+    if delay_secs:
+        task.schedule_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=delay_secs)
+    task.app_engine_http_request.relative_uri = relative_uri
+    task.app_engine_http_request.body = body
     task.app_engine_http_request.app_engine_routing = tasks_v2.AppEngineRouting()
     task.app_engine_http_request.app_engine_routing.version = os.getenv('GAE_VERSION')
 
-    response = client.create_task(parent=parent, task=task)
+    try:
+        response = client.create_task(parent=parent, task=task)
+    except google_exceptions.AlreadyExists:
+        logging.info(f'task already exists; not enqueuing: {name}')
+        return
+
     logging.info(f'enqueued task to {url}')
     logging.info(response.name)
 
+
+def enqueue_tasks(tasks: List[Tuple]):
+    """Enqueue many App Engine tasks concurrently, over the shared client.
+    `tasks` is a list of tuples of the arguments to `enqueue_task()`, like
+    `[(url, params), (url, params, name), (url, params, name, delay_secs), ...]`.
+    Raises the first error encountered, after all of the tasks have been attempted.
+    """
+    if not tasks:
+        return
+
+    max_workers = min(len(tasks), _ENQUEUE_TASKS_MAX_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(enqueue_task, *task_args) for task_args in tasks]
+
+    for future in futures:
+        future.result()
+
 def validate_queue_task(request: flask.Request) -> dict:
     """Check that the incoming request is a legitimate queue task.
     Calls flask.abort(401) if it's not valid.
@@ -540,13 +1290,15 @@ def validate_cron_task(request: flask.Request):
 
 def _get_members_renewed_ago(
     after_datetime: Optional[datetime.datetime],
-    before_datetime: Optional[datetime.datetime]) -> List[sheetdata.Row]:
+    before_datetime: Optional[datetime.datetime],
+    member_rows: List[sheetdata.Row] = None) -> List[sheetdata.Row]:
     """Get the members who were last renewed within the given window.
     Args:
         after_datetime (datetime): Members must have been renewed *after* this
             date. Optional.
         before_datetime (datetime): Members must have been renewed *before*
             this date. Optional.
+        member_rows (list): All rows of the members sheet. Fetched if not given.
     Returns:
         List of member rows.
     """
@@ -558,7 +1310,7 @@ def _get_members_renewed_ago(
 
     assert after_datetime or before_datetime
 
-    all_rows = sheetdata.find_rows(_S.member, matcher=None)
+    all_rows = member_rows if member_rows is not None else sheetdata.find_rows(_S.member, matcher=None)
 
     results = []
 
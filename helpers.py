@@ -17,6 +17,8 @@ import flask
 import geopy
 
 import config
+import instrumentation
+import postal_centroids
 
 
 def latlong_for_record(fields, record_dict):
@@ -24,18 +26,27 @@ def latlong_for_record(fields, record_dict):
     `fields` should be SHEETS.member.fields or SHEETS.volunteer.fields -- i.e.,
     something with appropriate address components.
     Returns empty string if geocoding is not possible.
+    If a postal code centroids table is configured, it's used as a fallback when the
+    geocoder fails (or first, if config.GEOCODE_POSTAL_CENTROIDS_FIRST is set).
     """
 
+    postal_code = record_dict.get(fields.postal_code.name)
+
+    if config.GEOCODE_POSTAL_CENTROIDS_FIRST:
+        latlong = postal_centroids.latlong_for_postal_code(postal_code)
+        if latlong:
+            return latlong
+
     if not record_dict.get(fields.street_name.name):
-        # If we don't have a street name, just give up
-        return ''
+        # If we don't have a street name, we can't geocode. Settle for the postal code.
+        return postal_centroids.latlong_for_postal_code(postal_code)
 
     address_components = [
         record_dict.get(fields.street_num.name),
         record_dict.get(fields.street_name.name),
         record_dict.get(fields.city.name) or 'Toronto',
         'Ontario',
-        record_dict.get(fields.postal_code.name),
+        postal_code,
         'Canada',
     ]
 
@@ -47,13 +58,14 @@ def latlong_for_record(fields, record_dict):
     geocoder = geopy.geocoders.GoogleV3(config.GOOGLE_SERVER_API_KEY)
 
     try:
-        location = geocoder.geocode(address_string, region='CA')
+        with instrumentation.timed('geocoder'):
+            location = geocoder.geocode(address_string, region='CA')
     except Exception as e:
         logging.error('geocode failed: %s', exc_info=e)
-        return ''
+        return postal_centroids.latlong_for_postal_code(postal_code)
 
     if not location:
-        return ''
+        return postal_centroids.latlong_for_postal_code(postal_code)
 
     return '%s, %s' % (location.latitude, location.longitude)
 
@@ -77,7 +89,8 @@ def address_from_latlong(latlong: str):
 
     res = None
     try:
-        res = geocoder.reverse(point, exactly_one=True)
+        with instrumentation.timed('geocoder'):
+            res = geocoder.reverse(point, exactly_one=True)
     except Exception as e:
         logging.error('Geocoder exception', exc_info=e)
 
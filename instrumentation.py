@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright Adam Pritchard 2020
+# MIT License : https://adampritchard.mit-license.org/
+#
+
+"""
+Lightweight timing of calls to external dependencies (Sheets, Drive, geocoding,
+MailChimp, SMTP, Cloud Tasks, NDB, PayPal).
+
+Call sites are wrapped with `timed()` (or the `instrumented()` decorator, or
+`ndb_context()` for NDB). For each request, the count and total duration of calls to
+each dependency are gathered on `flask.g`, and when the request finishes they're emitted
+as a `Server-Timing` response header and a structured log line. Every call is also added
+to process-wide histograms, from which approximate percentiles are periodically logged.
+
+Calls made on worker threads (like the MailChimp and geocoding pools) have no request
+context, so they're only counted in the process-wide histograms.
+"""
+
+from typing import Dict
+import bisect
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+import flask
+
+
+# Upper bounds, in milliseconds, of the histogram buckets. The last bucket is unbounded.
+_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+# How often the process-wide percentiles are logged.
+_SUMMARY_INTERVAL_SECS = 10 * 60
+
+_lock = threading.Lock()
+# Maps dependency name to a list of bucket counts. Guarded by _lock.
+_histograms = {}
+_last_summary = time.monotonic()
+
+
+@contextlib.contextmanager
+def timed(dependency: str):
+    """Context manager that times the enclosed call to the named dependency.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(dependency, time.perf_counter() - started)
+
+
+def instrumented(dependency: str):
+    """Decorator that times calls to the function as calls to the named dependency.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(dependency):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def ndb_context(client):
+    """Use in place of `client.context()` to time the NDB operations in the context.
+    """
+    with timed('ndb'), client.context():
+        yield
+
+
+def _record(dependency: str, duration: float):
+    duration_ms = duration * 1000
+
+    with _lock:
+        histogram = _histograms.get(dependency)
+        if histogram is None:
+            histogram = _histograms[dependency] = [0] * (len(_BUCKETS_MS) + 1)
+        histogram[bisect.bisect_left(_BUCKETS_MS, duration_ms)] += 1
+
+    if flask.has_app_context() and 'instrumentation_started' in flask.g:
+        timings = flask.g.instrumentation_timings
+        count, total_ms = timings.get(dependency, (0, 0.0))
+        timings[dependency] = (count + 1, total_ms + duration_ms)
+
+
+def before_request():
+    """To be called before every request. Starts gathering timings for it.
+    """
+    flask.g.instrumentation_started = time.perf_counter()
+    flask.g.instrumentation_timings = {}
+
+
+def after_request(response: flask.Response) -> flask.Response:
+    """To be called after every request. Adds the Server-Timing header and logs the
+    request's timings.
+    """
+    if 'instrumentation_started' not in flask.g:
+        return response
+
+    total_ms = (time.perf_counter() - flask.g.instrumentation_started) * 1000
+    timings = flask.g.instrumentation_timings
+
+    server_timing = [f'{dependency};dur={total:.1f};desc="{count} calls"'
+                     for dependency, (count, total) in sorted(timings.items())]
+    server_timing.append(f'total;dur={total_ms:.1f}')
+    response.headers['Server-Timing'] = ', '.join(server_timing)
+
+    logging.info('instrumentation: %s', json.dumps({
+        'path': flask.request.path,
+        'status': response.status_code,
+        'total_ms': round(total_ms, 1),
+        'dependencies': {dependency: {'count': count, 'ms': round(total, 1)}
+                         for dependency, (count, total) in timings.items()},
+    }))
+
+    _maybe_log_summary()
+
+    return response
+
+
+def percentiles() -> Dict[str, dict]:
+    """Returns approximate percentiles, in milliseconds, of the durations of calls to
+    each dependency, since the process started. These are the upper bounds of the
+    histogram buckets the percentiles fall in (None for the unbounded last bucket).
+    """
+    with _lock:
+        histograms = {dependency: list(counts) for dependency, counts in _histograms.items()}
+
+    result = {}
+    for dependency, counts in histograms.items():
+        total = sum(counts)
+        summary = {'count': total}
+        for pct in (50, 90, 99):
+            threshold = total * pct / 100
+            cumulative = 0
+            for i, n in enumerate(counts):
+                cumulative += n
+                if cumulative >= threshold:
+                    summary[f'p{pct}'] = _BUCKETS_MS[i] if i < len(_BUCKETS_MS) else None
+                    break
+        result[dependency] = summary
+    return result
+
+
+def _maybe_log_summary():
+    global _last_summary
+
+    with _lock:
+        now = time.monotonic()
+        if now - _last_summary < _SUMMARY_INTERVAL_SECS:
+            return
+        _last_summary = now
+
+    logging.info('instrumentation: percentiles: %s', json.dumps(percentiles()))
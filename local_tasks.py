@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright Adam Pritchard 2020
+# MIT License : https://adampritchard.mit-license.org/
+#
+
+"""
+An in-process stand-in for Cloud Tasks, used when config.TASK_QUEUE_BACKEND is 'local'.
+
+Tasks are dispatched to the app's own routes, via the Flask test client, from a thread
+pool. The requests carry the same header and secret that `gapps.validate_queue_task()`
+checks for, so the task handlers run exactly as they would with Cloud Tasks. This makes
+it possible to exercise the email, member-processing and MailChimp flows offline and
+to measure their throughput.
+
+This is for development and load testing only. Queued tasks are lost if the process
+exits, and nothing is shared between instances.
+"""
+
+from typing import Optional
+import logging
+import threading
+import time
+import concurrent.futures
+
+import config
+
+
+# Retry backoff doubles with each attempt, up to this.
+_MAX_RETRY_DELAY_SECS = 60
+
+
+class _Task(object):
+    def __init__(self, relative_uri: str, body: bytes, name: Optional[str]):
+        self.relative_uri = relative_uri
+        self.body = body
+        self.name = name
+        self.attempt = 0
+        # When the current attempt became due to run, as a time.monotonic() value
+        self.due = 0.0
+
+
+class _LocalTaskQueue(object):
+    def __init__(self, max_workers: int, max_attempts: int):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=max_workers,
+                            thread_name_prefix='local_tasks')
+        self._max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._names = set()
+        self._stats = {
+            'enqueued': 0,
+            'pending': 0,  # waiting for a delay or a free worker
+            'in_flight': 0,
+            'succeeded': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+        # Over all attempts: time spent waiting for a free worker once due, and running
+        self._attempts = 0
+        self._wait_secs = {'total': 0.0, 'max': 0.0}
+        self._run_secs = {'total': 0.0, 'max': 0.0}
+
+    def enqueue(self, relative_uri: str, body: bytes, name: Optional[str], delay_secs: float):
+        with self._lock:
+            if name:
+                if name in self._names:
+                    logging.info('local_tasks: task already exists; not enqueuing: %s', name)
+                    return
+                self._names.add(name)
+            self._stats['enqueued'] += 1
+            self._stats['pending'] += 1
+
+        self._schedule(_Task(relative_uri, body, name), delay_secs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return self._stats_locked()
+
+    def _stats_locked(self) -> dict:
+        stats = dict(self._stats)
+        for label, secs in (('wait', self._wait_secs), ('run', self._run_secs)):
+            stats[f'mean_{label}_secs'] = round(secs['total'] / self._attempts, 3) if self._attempts else 0
+            stats[f'max_{label}_secs'] = round(secs['max'], 3)
+        return stats
+
+    def _schedule(self, task: _Task, delay_secs: float):
+        task.due = time.monotonic() + max(delay_secs, 0)
+        if delay_secs > 0:
+            timer = threading.Timer(delay_secs, self._executor.submit, [self._run, task])
+            timer.daemon = True
+            timer.start()
+        else:
+            self._executor.submit(self._run, task)
+
+    def _run(self, task: _Task):
+        # Imported here to avoid a circular import; by the time a task runs, the app
+        # has been fully set up.
+        import main
+
+        started = time.monotonic()
+        wait = max(started - task.due, 0)
+
+        with self._lock:
+            self._stats['pending'] -= 1
+            self._stats['in_flight'] += 1
+
+        task.attempt += 1
+        status_code = None
+        try:
+            with main.app.test_client() as client:
+                response = client.post(
+                    task.relative_uri,
+                    data=task.body,
+                    content_type='application/json',
+                    headers={
+                        'X-AppEngine-QueueName': config.TASK_QUEUE_NAME,
+                        'X-AppEngine-TaskName': task.name or '',
+                        'X-AppEngine-TaskRetryCount': str(task.attempt - 1),
+                    })
+                status_code = response.status_code
+        except Exception as e:
+            logging.error('local_tasks: task raised: %s', task.relative_uri.split('?')[0], exc_info=e)
+
+        duration = time.monotonic() - started
+        succeeded = status_code is not None and 200 <= status_code <= 299
+        retry = not succeeded and task.attempt < self._max_attempts
+
+        with self._lock:
+            self._attempts += 1
+            for secs, value in ((self._wait_secs, wait), (self._run_secs, duration)):
+                secs['total'] += value
+                secs['max'] = max(secs['max'], value)
+            self._stats['in_flight'] -= 1
+            if succeeded:
+                self._stats['succeeded'] += 1
+            elif retry:
+                self._stats['retried'] += 1
+                self._stats['pending'] += 1
+            else:
+                self._stats['failed'] += 1
+            stats = self._stats_locked()
+
+        # Don't log the secret that's in the query string
+        path = task.relative_uri.split('?')[0]
+        logging.info('local_tasks: %s attempt %d: status %s in %.3fs after %.3fs wait; queue: %s',
+                     path, task.attempt, status_code, duration, wait, stats)
+
+        if retry:
+            self._schedule(task, min(2 ** task.attempt, _MAX_RETRY_DELAY_SECS))
+        elif not succeeded:
+            logging.error('local_tasks: %s failed after %d attempts', path, task.attempt)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def _get_queue() -> _LocalTaskQueue:
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = _LocalTaskQueue(config.LOCAL_TASK_QUEUE_MAX_WORKERS,
+                                     config.LOCAL_TASK_QUEUE_MAX_ATTEMPTS)
+        return _queue
+
+
+def enqueue(relative_uri: str, body: bytes, name: Optional[str] = None, delay_secs: float = 0):
+    """Queue a POST of `body` to `relative_uri` (which includes the query string) on this
+    app. If `name` is given and a task with that name has already been enqueued in this
+    process, the task is dropped.
+    Failed tasks (non-2xx responses or exceptions) are retried with backoff, up to
+    config.LOCAL_TASK_QUEUE_MAX_ATTEMPTS times.
+    """
+    _get_queue().enqueue(relative_uri, body, name, delay_secs)
+
+
+def stats() -> dict:
+    """Returns counts of tasks in each state, for monitoring queue depth and throughput,
+    and the mean and max time task attempts waited for a worker once due, and ran for.
+    This is served by /tasks/local-queue-stats when DEBUG is on.
+    """
+    return _get_queue().stats()
@@ -5,54 +5,290 @@
 # MIT License : https://adampritchard.mit-license.org/
 #
 
+from typing import Dict, List, Optional, Set
+from collections import namedtuple
 import base64
+import bisect
+import hashlib
+import io
+import re
+import tarfile
+import threading
+import time
 import requests
+import requests.adapters
 import logging
 import json
 import flask
+from google.cloud import ndb
 
 import config
+import instrumentation
 
 
-_TIMEOUT = 45
-_RETRIES = 1  # disabling retries for now
+# Separate (connect, read) timeouts. A connection that can't be established quickly
+# isn't going to be, and we don't want one slow response eating the cron's time budget.
+_TIMEOUT = (5, 20)
+_RETRIES = 4
+# Retry backoff doubles with each attempt, starting from and capped at these.
+_BACKOFF_BASE_SECS = 1
+_BACKOFF_MAX_SECS = 30
+# Size of the keep-alive connection pool. Must be at least the number of threads
+# making concurrent requests, or connections will be discarded rather than reused.
+_POOL_SIZE = 10
 
-_api_url_base = f'https://{config.MAILCHIMP_DATACENTER}.api.mailchimp.com/3.0/lists/{config.MAILCHIMP_MEMBERS_LIST_ID}/'
+_api_url_root = config.MAILCHIMP_API_URL_ROOT or f'https://{config.MAILCHIMP_DATACENTER}.api.mailchimp.com/3.0/'
+_list_path = f'lists/{config.MAILCHIMP_MEMBERS_LIST_ID}/'
+_api_url_base = _api_url_root + _list_path
 
 _headers = {
         'Authorization': 'Basic %s' % base64.b64encode(f'anystring:{config.MAILCHIMP_API_KEY}'.encode('ascii')).decode()
     }
 
+# Page size when fetching the whole audience. 1000 is the most MailChimp allows.
+_AUDIENCE_PAGE_SIZE = 1000
+
 _EMAIL_ADDRESS = 'email_address'
 _MERGE_FIELDS = 'merge_fields'
-_STATUS_FIELD = 'status'
+_STATUS_IF_NEW_FIELD = 'status_if_new'
 _STATUS_VALUE = 'subscribed'
 
+# Count of requests made to MailChimp, so the cost of a sync run can be measured.
+_request_count = 0
+_request_count_lock = threading.Lock()
 
-def upsert_member_info(member_dict):
-    """Create or update the MailChimp record corresponding to the given Member.
+# Upper bounds, in seconds, of the latency histogram buckets. The last bucket is unbounded.
+_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Maps normalized endpoint (like "PUT members/{hash}") to
+# {'count', 'total', 'max', 'buckets'}. Guarded by _request_count_lock.
+_latencies = {}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    """Returns the process-wide requests session, so that connections (and their TLS
+    handshakes) are reused across requests.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=_POOL_SIZE, pool_maxsize=_POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def reset_request_count():
+    """Reset the count of requests made to MailChimp, and the latency histograms.
+    """
+    global _request_count
+    with _request_count_lock:
+        _request_count = 0
+        _latencies.clear()
+
+
+def get_request_count() -> int:
+    """Get the count of requests made to MailChimp since the last reset.
+    """
+    with _request_count_lock:
+        return _request_count
+
+
+def get_latency_summary() -> str:
+    """Get a one-line-per-endpoint summary of request latencies since the last reset,
+    suitable for logging.
+    """
+    with _request_count_lock:
+        latencies = {endpoint: dict(stats) for endpoint, stats in _latencies.items()}
+
+    lines = []
+    bucket_labels = [f'<={b}s' for b in _LATENCY_BUCKETS] + [f'>{_LATENCY_BUCKETS[-1]}s']
+    for endpoint, stats in sorted(latencies.items()):
+        histogram = ' '.join(f'{label}:{n}' for label, n in zip(bucket_labels, stats['buckets']) if n)
+        lines.append('%s: count=%d mean=%.3fs max=%.3fs [%s]' % (
+            endpoint, stats['count'], stats['total'] / stats['count'], stats['max'], histogram))
+    return '\n'.join(lines)
+
+
+def _record_latency(method, url, duration):
+    """Add the request duration to the histogram for its endpoint.
+    """
+    # Collapse subscriber hashes and batch IDs, so that all requests to the same kind
+    # of resource are grouped together.
+    endpoint = re.sub(r'/[0-9a-f]{32}(?=/|$)', '/{hash}', url.split('?')[0])
+    endpoint = re.sub(r'(?<=/batches/)[^/]+', '{id}', endpoint)
+    endpoint = method + ' ' + endpoint.replace(_api_url_root, '', 1)
+
+    with _request_count_lock:
+        stats = _latencies.get(endpoint)
+        if stats is None:
+            stats = _latencies[endpoint] = {
+                'count': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(_LATENCY_BUCKETS) + 1)}
+        stats['count'] += 1
+        stats['total'] += duration
+        stats['max'] = max(stats['max'], duration)
+        stats['buckets'][bisect.bisect_left(_LATENCY_BUCKETS, duration)] += 1
+
+
+# An entry in an audience snapshot. `member_type` is the value of the member type merge tag.
+AudienceEntry = namedtuple('AudienceEntry', ['id', 'member_type', 'merge_fields'])
+
+
+def get_audience_snapshot() -> Dict[str, AudienceEntry]:
+    """Fetch the whole MailChimp audience, a page at a time. This takes one request per
+    thousand list members, versus one per row when looking up entries individually.
+    Returns a dict mapping lowercased email address to AudienceEntry. The dict can be
+    passed to the upsert functions, which will then make their decisions locally, and
+    keep it up to date with what they upsert.
     Will raise with `flask.abort` on error.
     """
 
     if config.DEMO:
         # Mailchimp (and all email) is disabled in demo mode
+        return {}
+
+    audience = {}
+    offset = 0
+    while True:
+        page = _make_request(
+            f'members?count={_AUDIENCE_PAGE_SIZE}&offset={offset}'
+            f'&fields=total_items,members.id,members.{_EMAIL_ADDRESS},members.{_MERGE_FIELDS}',
+            'GET')
+
+        for list_member in page['members']:
+            merge_fields = list_member.get(_MERGE_FIELDS, {})
+            audience[list_member[_EMAIL_ADDRESS].lower()] = AudienceEntry(
+                list_member['id'],
+                merge_fields.get(config.MAILCHIMP_MEMBER_TYPE_MERGE_TAG),
+                merge_fields)
+
+        offset += len(page['members'])
+        if not page['members'] or offset >= page['total_items']:
+            break
+
+    logging.info('mailchimp.get_audience_snapshot: %d entries', len(audience))
+    return audience
+
+
+def _is_in_sync(audience_entry: Optional[AudienceEntry], mailchimp_record) -> bool:
+    """Whether the audience entry already has all of the values in the MailChimp record.
+    """
+    if not audience_entry:
+        return False
+    return all(str(audience_entry.merge_fields.get(tag, '')) == str(value)
+               for tag, value in mailchimp_record[_MERGE_FIELDS].items())
+
+
+def _note_upserted(audience: Optional[Dict[str, AudienceEntry]], mailchimp_record):
+    """Update the audience snapshot (if there is one) with an upserted record, so that
+    later decisions in the same sync take it into account. (For example, a Volunteer
+    with the same email as a just-added Member must not replace it.)
+    """
+    if audience is None:
+        return
+    email = mailchimp_record[_EMAIL_ADDRESS].lower()
+    merge_fields = mailchimp_record[_MERGE_FIELDS]
+    audience[email] = AudienceEntry(
+        _subscriber_hash(email),
+        merge_fields.get(config.MAILCHIMP_MEMBER_TYPE_MERGE_TAG),
+        merge_fields)
+
+
+class MailChimpDigest(ndb.Model):
+    """A digest of the MailChimp record that was last successfully upserted for a sheet
+    row. If the record that would be sent now has the same digest, there's no need to
+    send it. Keyed by member type and row ID.
+    """
+    _ndb_client = ndb.Client()
+
+    digest = ndb.TextProperty(
+        verbose_name='SHA-256 hex digest of the upserted MailChimp record.')
+
+
+def get_unchanged_member_ids(member_dicts: List[dict]) -> Set[str]:
+    """Returns the IDs of the given Members whose MailChimp record is unchanged since
+    it was last upserted (as recorded by `record_member_digests()`).
+    """
+    return _get_unchanged_ids(member_dicts, config.SHEETS.member.fields, config.MAILCHIMP_MEMBER_TYPE_MEMBER)
+
+
+def get_unchanged_volunteer_ids(volunteer_dicts: List[dict]) -> Set[str]:
+    """Returns the IDs of the given Volunteers whose MailChimp record is unchanged since
+    it was last upserted (as recorded by `record_volunteer_digests()`).
+    """
+    return _get_unchanged_ids(volunteer_dicts, config.SHEETS.volunteer.fields, config.MAILCHIMP_MEMBER_TYPE_VOLUNTEER)
+
+
+def record_member_digests(member_dicts: List[dict]):
+    """Record that the given Members have been successfully upserted to MailChimp.
+    """
+    _record_digests(member_dicts, config.SHEETS.member.fields, config.MAILCHIMP_MEMBER_TYPE_MEMBER)
+
+
+def record_volunteer_digests(volunteer_dicts: List[dict]):
+    """Record that the given Volunteers have been successfully upserted to MailChimp.
+    """
+    _record_digests(volunteer_dicts, config.SHEETS.volunteer.fields, config.MAILCHIMP_MEMBER_TYPE_VOLUNTEER)
+
+
+def _digest_key(sheet_dict, fields, typename):
+    return ndb.Key(MailChimpDigest, f'{typename}:{sheet_dict[fields.id.name]}')
+
+
+def _record_digest(sheet_dict, fields, typename):
+    mailchimp_record = _create_mailchimp_record_from_dict(sheet_dict, fields, typename)
+    return hashlib.sha256(json.dumps(mailchimp_record, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _get_unchanged_ids(sheet_dicts, fields, typename):
+    """Helper for `get_unchanged_member_ids()` and `get_unchanged_volunteer_ids()`.
+    """
+    if config.DEMO or not sheet_dicts:
+        return set()
+
+    with instrumentation.ndb_context(MailChimpDigest._ndb_client):
+        stored = ndb.get_multi([_digest_key(d, fields, typename) for d in sheet_dicts])
+
+    return {d[fields.id.name]
+            for d, entity in zip(sheet_dicts, stored)
+            if entity and entity.digest == _record_digest(d, fields, typename)}
+
+
+def _record_digests(sheet_dicts, fields, typename):
+    """Helper for `record_member_digests()` and `record_volunteer_digests()`.
+    """
+    if config.DEMO or not sheet_dicts:
         return
 
-    list_member = _find_list_member(member_dict.get(config.SHEETS.member.fields.email.name), config.SHEETS.member.fields)
+    with instrumentation.ndb_context(MailChimpDigest._ndb_client):
+        ndb.put_multi([
+            MailChimpDigest(key=_digest_key(d, fields, typename), digest=_record_digest(d, fields, typename))
+            for d in sheet_dicts])
 
-    if list_member and \
-       (config.MAILCHIMP_MEMBER_TYPE_MEMBER !=
-        list_member.get(_MERGE_FIELDS, {}).get(config.MAILCHIMP_MEMBER_TYPE_MERGE_TAG)):
-        # The matched list item is not a Member (vs. Volunteer)
-        logging.info('upsert_member_info: member already in MailChimp as volunteer; replacing: %s', member_dict)
-        # Member status takes precedence over Volunteer (because they paid),
-        # so we'll replace the existing entry.
 
-    _upsert_member_or_volunteer_info(list_member, member_dict, config.SHEETS.member.fields, config.MAILCHIMP_MEMBER_TYPE_MEMBER)
+def upsert_member_info(member_dict, audience: Dict[str, AudienceEntry] = None):
+    """Create or update the MailChimp record corresponding to the given Member.
+    If an `audience` snapshot is given, a record that's already up to date is skipped.
+    Will raise with `flask.abort` on error.
+    """
+
+    if config.DEMO:
+        # Mailchimp (and all email) is disabled in demo mode
+        return
+
+    # Member status takes precedence over Volunteer (because they paid), so if the
+    # entry already exists as a Volunteer, we replace it. That means we don't need to
+    # look it up first.
+    _upsert_member_or_volunteer_info(member_dict, config.SHEETS.member.fields, config.MAILCHIMP_MEMBER_TYPE_MEMBER, audience)
 
 
-def upsert_volunteer_info(volunteer_dict):
+def upsert_volunteer_info(volunteer_dict, audience: Dict[str, AudienceEntry] = None):
     """Create or update the MailChimp record corresponding to the given Volunteer.
+    If an `audience` snapshot is given, it's used instead of looking up the existing
+    entry, and a record that's already up to date is skipped.
     Will raise with `flask.abort` on error.
     """
 
@@ -60,7 +296,12 @@ def upsert_volunteer_info(volunteer_dict):
         # Mailchimp (and all email) is disabled in demo mode
         return
 
-    list_member = _find_list_member(volunteer_dict.get(config.SHEETS.volunteer.fields.email.name), config.SHEETS.volunteer.fields)
+    email = volunteer_dict.get(config.SHEETS.volunteer.fields.email.name)
+    if audience is not None:
+        audience_entry = audience.get((email or '').lower())
+        list_member = {_MERGE_FIELDS: audience_entry.merge_fields} if audience_entry else None
+    else:
+        list_member = _find_list_member(email, config.SHEETS.volunteer.fields)
 
     if list_member and \
        (config.MAILCHIMP_MEMBER_TYPE_VOLUNTEER !=
@@ -72,104 +313,315 @@ def upsert_volunteer_info(volunteer_dict):
         # succeeded (so the sheet gets updated).
         return
 
-    _upsert_member_or_volunteer_info(list_member, volunteer_dict, config.SHEETS.volunteer.fields, config.MAILCHIMP_MEMBER_TYPE_VOLUNTEER)
+    _upsert_member_or_volunteer_info(volunteer_dict, config.SHEETS.volunteer.fields, config.MAILCHIMP_MEMBER_TYPE_VOLUNTEER, audience)
 
 
-def _upsert_member_or_volunteer_info(list_member, sheet_dict, fields, typename):
+def _upsert_member_or_volunteer_info(sheet_dict, fields, typename, audience):
     """Helper for `upsert_member_info()` and `upsert_volunteer_info()`.
+    Uses a PUT to the subscriber hash URL, which creates the list member if it doesn't
+    exist and updates it if it does.
+    """
+    mailchimp_record = _create_mailchimp_record_from_dict(sheet_dict, fields, typename)
+    if audience is not None and _is_in_sync(audience.get(mailchimp_record[_EMAIL_ADDRESS].lower()), mailchimp_record):
+        logging.info('MailChimp: already up to date; skipping: %s', sheet_dict)
+        return
+    url = 'members/%s' % _subscriber_hash(mailchimp_record[_EMAIL_ADDRESS])
+    logging.info('MailChimp: upserting %s from %s', mailchimp_record, sheet_dict)
+    _make_request(url, 'PUT', body=json.dumps(mailchimp_record))
+    _note_upserted(audience, mailchimp_record)
+
+
+def batch_upsert_member_info(member_dicts: Dict[str, dict], audience: Dict[str, AudienceEntry] = None) -> Set[str]:
+    """Like `upsert_member_info()`, but for many Members at once, using MailChimp batch
+    operations. This is much faster for large syncs.
+    `member_dicts` maps an ID of the caller's choosing to each Member dict.
+    Returns the set of IDs that were successfully upserted (or skipped because the
+    entry is already up to date).
+    Will raise with `flask.abort` if the batch itself fails.
     """
-    if list_member:
-        # Update existing
-        _update_mailchimp_record_from_dict(list_member, sheet_dict, fields, typename)
-        url = 'members/%s' % list_member['id']
-        logging.info('MailChimp: updating %s from %s', list_member, sheet_dict)
-        _make_request(url, 'PATCH', body=json.dumps(list_member))
+
+    if config.DEMO:
+        # Mailchimp (and all email) is disabled in demo mode
+        return set(member_dicts.keys())
+
+    return _batch_upsert_member_or_volunteer_info(member_dicts, config.SHEETS.member.fields, config.MAILCHIMP_MEMBER_TYPE_MEMBER, audience)
+
+
+def batch_upsert_volunteer_info(volunteer_dicts: Dict[str, dict], audience: Dict[str, AudienceEntry] = None) -> Set[str]:
+    """Like `upsert_volunteer_info()`, but for many Volunteers at once, using MailChimp
+    batch operations. This is much faster for large syncs.
+    `volunteer_dicts` maps an ID of the caller's choosing to each Volunteer dict.
+    Returns the set of IDs that were successfully upserted (or skipped because the
+    entry is already a Member or already up to date).
+    Will raise with `flask.abort` if the batch itself fails.
+    """
+
+    if config.DEMO:
+        # Mailchimp (and all email) is disabled in demo mode
+        return set(volunteer_dicts.keys())
+
+    fields = config.SHEETS.volunteer.fields
+
+    # We need to check which of these are already in MailChimp as Members, since those
+    # take precedence. With an audience snapshot that's local; otherwise the lookups
+    # are batched too.
+    if audience is not None:
+        lookup_results = {}
+        for op_id, volunteer_dict in volunteer_dicts.items():
+            audience_entry = audience.get(volunteer_dict[fields.email.name].lower())
+            if audience_entry:
+                lookup_results[op_id] = (200, {_MERGE_FIELDS: audience_entry.merge_fields})
+            else:
+                lookup_results[op_id] = (404, None)
     else:
-        # Create new
-        list_member = _create_mailchimp_record_from_dict(sheet_dict, fields, typename)
-        url = 'members'
-        logging.info('MailChimp: creating %s from %s', list_member, sheet_dict)
-        _make_request(url, 'POST', body=json.dumps(list_member))
+        lookup_results = _run_batch([
+            {
+                'method': 'GET',
+                'path': _list_path + 'members/' + _subscriber_hash(volunteer_dict[fields.email.name]),
+                'operation_id': op_id,
+            } for op_id, volunteer_dict in volunteer_dicts.items()])
+
+    succeeded = set()
+    to_upsert = {}
+    for op_id, volunteer_dict in volunteer_dicts.items():
+        status_code, list_member = lookup_results.get(op_id, (None, None))
+        if status_code == 404:
+            to_upsert[op_id] = volunteer_dict
+        elif not _is_success(status_code, list_member):
+            logging.error('mailchimp.batch_upsert_volunteer_info: lookup failed: %s : %s : %s', status_code, list_member, volunteer_dict)
+        elif config.MAILCHIMP_MEMBER_TYPE_VOLUNTEER != list_member.get(_MERGE_FIELDS, {}).get(config.MAILCHIMP_MEMBER_TYPE_MERGE_TAG):
+            # Member status takes precedence; see upsert_volunteer_info()
+            logging.info('batch_upsert_volunteer_info: volunteer already in MailChimp as member; skipping: %s', volunteer_dict)
+            succeeded.add(op_id)
+        else:
+            to_upsert[op_id] = volunteer_dict
+
+    return succeeded | _batch_upsert_member_or_volunteer_info(to_upsert, fields, config.MAILCHIMP_MEMBER_TYPE_VOLUNTEER, audience)
+
+
+def _batch_upsert_member_or_volunteer_info(sheet_dicts, fields, typename, audience):
+    """Helper for `batch_upsert_member_info()` and `batch_upsert_volunteer_info()`.
+    Returns the set of IDs that succeeded.
+    """
+    succeeded = set()
+    operations = []
+    mailchimp_records = {}
+    for op_id, sheet_dict in sheet_dicts.items():
+        mailchimp_record = _create_mailchimp_record_from_dict(sheet_dict, fields, typename)
+        if audience is not None and _is_in_sync(audience.get(mailchimp_record[_EMAIL_ADDRESS].lower()), mailchimp_record):
+            succeeded.add(op_id)
+            continue
+        mailchimp_records[op_id] = mailchimp_record
+        operations.append({
+            'method': 'PUT',
+            'path': _list_path + 'members/' + _subscriber_hash(mailchimp_record[_EMAIL_ADDRESS]),
+            'operation_id': op_id,
+            'body': json.dumps(mailchimp_record),
+        })
+
+    results = _run_batch(operations) if operations else {}
+
+    for op_id, mailchimp_record in mailchimp_records.items():
+        status_code, response_info = results.get(op_id, (None, None))
+        if _is_success(status_code, response_info):
+            succeeded.add(op_id)
+            _note_upserted(audience, mailchimp_record)
+        else:
+            logging.error('mailchimp._batch_upsert_member_or_volunteer_info: upsert failed: %s : %s : %s', status_code, response_info, sheet_dicts[op_id])
+
+    logging.info('mailchimp._batch_upsert_member_or_volunteer_info: %d of %d succeeded; %d already up to date',
+                 len(succeeded), len(sheet_dicts), len(sheet_dicts) - len(operations))
+    return succeeded
+
+
+def _run_batch(operations):
+    """Submit the operations to MailChimp's batch endpoint, in chunks, and wait for
+    them to finish.
+    Returns a dict mapping each `operation_id` to a tuple of
+    (status code, decoded response body).
+    """
+    results = {}
+    for i in range(0, len(operations), config.MAILCHIMP_BATCH_MAX_OPERATIONS):
+        chunk = operations[i:i+config.MAILCHIMP_BATCH_MAX_OPERATIONS]
+
+        batch = _make_request('batches', 'POST',
+                              body=json.dumps({'operations': chunk}),
+                              url_base=_api_url_root)
+        logging.info('mailchimp._run_batch: submitted batch %s of %d operations', batch['id'], len(chunk))
+
+        deadline = time.monotonic() + config.MAILCHIMP_BATCH_TIMEOUT_SECS
+        while batch['status'] != 'finished':
+            if time.monotonic() > deadline:
+                flask.abort(504, description=f"MailChimp batch {batch['id']} did not finish in time")
+            time.sleep(config.MAILCHIMP_BATCH_POLL_SECS)
+            batch = _make_request(f"batches/{batch['id']}", 'GET', url_base=_api_url_root)
+
+        logging.info('mailchimp._run_batch: batch %s finished; %d errored operations', batch['id'], batch.get('errored_operations', 0))
+        results.update(_fetch_batch_results(batch['response_body_url']))
+
+    return results
+
+
+def _fetch_batch_results(response_body_url):
+    """Download and decode the results of a finished batch. They're a gzipped tar
+    archive of JSON files, each holding a list of operation results.
+    Returns a dict like `_run_batch()`.
+    """
+    # This is a pre-signed URL, not part of the API, so no auth header.
+    with instrumentation.timed('mailchimp'):
+        response = _get_session().get(response_body_url, timeout=_TIMEOUT)
+    if response.status_code != 200:
+        flask.abort(response.status_code, description='failed to fetch MailChimp batch results')
+
+    results = {}
+    with tarfile.open(fileobj=io.BytesIO(response.content), mode='r:gz') as archive:
+        for archive_member in archive:
+            if not archive_member.isfile() or not archive_member.name.endswith('.json'):
+                continue
+            for op_result in json.load(archive.extractfile(archive_member)):
+                try:
+                    response_info = json.loads(op_result.get('response') or 'null')
+                except ValueError:
+                    response_info = None
+                results[op_result['operation_id']] = (op_result['status_code'], response_info)
+
+    return results
+
+
+def _is_success(status_code, response_info):
+    """Whether the MailChimp response indicates success -- or a permanent error that
+    we treat as success (see `_ignorable_error()`).
+    """
+    if status_code and 200 <= status_code <= 299:
+        return True
+    return bool(response_info) and _ignorable_error(response_info)
+
+
+def _subscriber_hash(email):
+    """MailChimp identifies list members by the MD5 hash of the lowercased email address.
+    """
+    return hashlib.md5(email.lower().encode('utf-8')).hexdigest()
 
 
 def _find_list_member(member_email, fields):
     """Returns the list member dict that matches the given email address.
     Returns None if not found.
     """
-    # TODO: Some day MailChimp will add support for filtering, and this can be
-    # made less brute-force.
 
     if not member_email:
         logging.error('mailchimp._find_list_member called with empty member_email')
         flask.abort(500, description='bad data in sheet')
 
-    # We may need to page through results to find the member we want.
-    offset = 0
-    while True:
-        url = 'members?count=100&offset=%d' % (offset,)
-        res = _make_request(url, 'GET')
+    return _make_request('members/%s' % _subscriber_hash(member_email), 'GET', missing_ok=True)
 
-        for member in res['members']:
-            if member[_EMAIL_ADDRESS] == member_email:
-                return member
 
-        offset += len(res['members'])
-        total = res['total_items']
-
-        if offset >= total or not res['members']:
-            # We paged all the way through
-            break
-
-    return None
+def _make_request(url, method, body=None, missing_ok=False, url_base=_api_url_base):
+    """Make a request to the MailChimp API. `url` is relative to `url_base`, which by
+    default is the list.
+    If `missing_ok` is True, a 404 response results in None being returned, rather than
+    an abort.
+    Rate-limited (429), server error (5xx) and connection failures are retried with
+    exponential backoff, honouring any Retry-After header.
+    """
+    global _request_count
 
+    url = url_base + url
 
-def _make_request(url, method, body=None):
     attempt = 0
-    while attempt < _RETRIES:
+    while True:
         attempt += 1
 
-        url = _api_url_base + url
-        response = requests.request(method, url, headers=_headers, data=body, timeout=_TIMEOUT)
+        with _request_count_lock:
+            _request_count += 1
+
+        response = None
+        started = time.monotonic()
+        try:
+            with instrumentation.timed('mailchimp'):
+                response = _get_session().request(method, url, headers=_headers, data=body, timeout=_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logging.warning('mailchimp._make_request: attempt %d: %s : %s : %s', attempt, method, url, e)
+            if attempt >= _RETRIES:
+                flask.abort(504, description=f'MailChimp request failed: {e}')
+        finally:
+            _record_latency(method, url, time.monotonic() - started)
+
+        if response is not None:
+            if missing_ok and response.status_code == 404:
+                return None
+
+            # This is pretty dirty. But PUT entry-creation reqs give a status
+            # of 201, and basically all 20x statuses are successes, so...
+            if 200 <= response.status_code <= 299:
+                return json.loads(response.content)
 
-        # This is pretty dirty. But PUT entry-creation reqs give a status
-        # of 201, and basically all 20x statuses are successes, so...
-        if response.status_code < 200 or response.status_code > 299:
-            # Fail. Retry.
             logging.debug('mailchimp._make_request: response=%s; content=%s', response, str(response.content))
-            continue
 
-        return json.loads(response.content)
+            if response.status_code != 429 and response.status_code < 500:
+                # Other client errors won't be fixed by retrying
+                break
+
+            if attempt >= _RETRIES:
+                break
 
-    # If we got to here, then the request failed repeatedly.
+        time.sleep(_retry_delay(attempt, response))
 
-    # Hack: For certain email addresses (such as those with "spam" in the name
-    # part), MailChimp will return an error like:
-    #    `"status":400, "detail":" is already a list member. Use PATCH to update existing members."`
-    # That condition will be permanent and unrecoverable if we treat it as an
-    # error (or if we try to PATCH). So we're going to take the dirty route
-    # and just proceed as if the request succeeded. This will result in the
-    # spreadsheet getting updated for this member, allowing us to skip it in
-    # the future.
+    # If we got to here, then the request failed permanently or repeatedly.
 
-    error_info = json.loads(response.content)
+    try:
+        error_info = json.loads(response.content)
+    except ValueError:
+        # Gateway errors and the like may not have a JSON body
+        error_info = {}
 
-    if error_info.get('status') == 400 and error_info.get('detail', '').find('is already a list member') > 0:
-        logging.warning('_make_request: got 400 "is already a member" error: %s : %s : %s', method, url, body)
+    if _ignorable_error(error_info):
+        logging.warning('_make_request: ignoring permanent error: %s : %s : %s : %s', error_info.get('detail'), method, url, body)
         # Pretend success
         return
-    elif error_info.get('status') == 400 and error_info.get('detail', '').find('looks fake or invalid') > 0:
-        # This isn't successful, but it'll never succeed. If a user wants to give a
-        # fake email address, that's up to them. Log a warning and continue.
-        logging.warning('_make_request: got 400 "email address looks fake or invalid" error: %s : %s : %s', method, url, body)
-        return
 
     flask.abort(response.status_code, description=str(response.content))
 
 
-def _update_mailchimp_record_from_dict(mailchimp_record, sheet_dict, fields, typename):
-    """Update a MailChimp list record object from a Member or Volunteer dict.
-    Modifies `mailchimp_record` directly. No return value.
+def _retry_delay(attempt, response):
+    """How long to wait before retrying a failed request. Uses the Retry-After header
+    of the response, if there is one, otherwise exponential backoff. Either way, it's
+    capped at _BACKOFF_MAX_SECS.
+    """
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = _BACKOFF_BASE_SECS * 2 ** (attempt - 1)
+    return min(max(delay, 0), _BACKOFF_MAX_SECS)
+
+
+def _ignorable_error(error_info):
+    """Whether the MailChimp error response is one that we treat as success.
+
+    Hack: For certain email addresses (such as those with "spam" in the name
+    part), MailChimp will return an error like:
+       `"status":400, "detail":" is already a list member. Use PATCH to update existing members."`
+    That condition will be permanent and unrecoverable if we treat it as an
+    error (or if we try to PATCH). So we're going to take the dirty route
+    and just proceed as if the request succeeded. This will result in the
+    spreadsheet getting updated for this member, allowing us to skip it in
+    the future.
+
+    Similarly, "looks fake or invalid" isn't successful, but it'll never succeed. If a
+    user wants to give a fake email address, that's up to them.
+    """
+    if error_info.get('status') != 400:
+        return False
+    detail = error_info.get('detail', '')
+    return detail.find('is already a list member') > 0 or detail.find('looks fake or invalid') > 0
+
+
+def _create_mailchimp_record_from_dict(sheet_dict, fields, typename):
+    """Create a MailChimp list record object from a Member or Volunteer dict, suitable
+    for a PUT upsert.
+    Returns the MailChimp object.
     """
+    mailchimp_record = { _MERGE_FIELDS: {} }
     for field in fields:
         if not field.mailchimp_merge_tag:
             # Not a field for us to update
@@ -177,13 +629,5 @@ def _update_mailchimp_record_from_dict(mailchimp_record, sheet_dict, fields, typ
         mailchimp_record[_MERGE_FIELDS][field.mailchimp_merge_tag] = sheet_dict.get(field.name) or ''
     mailchimp_record[_EMAIL_ADDRESS] = sheet_dict[fields.email.name]
     mailchimp_record[_MERGE_FIELDS][config.MAILCHIMP_MEMBER_TYPE_MERGE_TAG] = typename
-
-
-def _create_mailchimp_record_from_dict(sheet_dict, fields, typename):
-    """Create a MailChimp list record object from a Member or Volunteer dict.
-    Returns the MailChimp object.
-    """
-    mailchimp_record = { _MERGE_FIELDS: {} }
-    _update_mailchimp_record_from_dict(mailchimp_record, sheet_dict, fields, typename)
-    mailchimp_record[_STATUS_FIELD] = _STATUS_VALUE
+    mailchimp_record[_STATUS_IF_NEW_FIELD] = _STATUS_VALUE
     return mailchimp_record
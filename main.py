@@ -16,6 +16,8 @@ from flask_wtf.csrf import CSRFProtect, same_origin
 
 import config
 import emailer
+import instrumentation
+import sheetdata
 
 
 app = flask.Flask(__name__)
@@ -28,6 +30,14 @@ else:
     app.debug = False
 
 
+# Time calls to external dependencies, per request
+app.before_request(instrumentation.before_request)
+app.after_request(instrumentation.after_request)
+
+# Log how many sheet reads were saved by memoization
+app.after_request(sheetdata.after_request)
+
+
 # Add token-based CSRF protection
 csrf = CSRFProtect(app)
 
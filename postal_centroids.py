@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+#
+# Copyright Adam Pritchard 2020
+# MIT License : https://adampritchard.mit-license.org/
+#
+
+"""
+Offline lookup of approximate coordinates for Canadian postal codes.
+
+The lookup table is a CSV file (set in config.POSTAL_CENTROIDS_FILE_PATH) with rows like:
+    M4C 1A1,43.6858,-79.3091
+    M4C,43.6953,-79.3183
+Entries can be full postal codes or FSAs (the first three characters of a postal code).
+A lookup tries the full postal code first and then its FSA, so a table of only FSAs
+is fine for map-only use, and full codes can be added for better precision.
+
+The table is loaded lazily, on first lookup, so it doesn't slow instance start-up.
+It's held as fixed-width keys packed into a single `bytes` object and parallel arrays
+of floats, rather than a dict of strings and tuples, to keep it compact.
+"""
+
+from typing import Optional
+import array
+import bisect
+import csv
+import logging
+import re
+import threading
+
+import config
+
+
+# Full postal codes are 6 characters; FSAs are padded to that width.
+_KEY_WIDTH = 6
+
+
+class _Table(object):
+    """Sorted fixed-width keys with parallel latitude and longitude arrays.
+    Supports `len()` and indexing of keys, so that `bisect` can search it directly.
+    """
+    def __init__(self, keys: bytes, latitudes: array.array, longitudes: array.array):
+        self.keys = keys
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def __getitem__(self, i):
+        return self.keys[i*_KEY_WIDTH:(i+1)*_KEY_WIDTH]
+
+    def find(self, key: bytes) -> Optional[int]:
+        i = bisect.bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return i
+        return None
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def _make_key(code: str) -> Optional[bytes]:
+    """Normalize a postal code or FSA into a table key. Returns None if it doesn't look
+    like either.
+    """
+    code = re.sub(r'\s+', '', code or '').upper()
+    if len(code) not in (3, _KEY_WIDTH) or not code.isalnum() or not code.isascii():
+        return None
+    return code.ljust(_KEY_WIDTH).encode('ascii')
+
+
+def _load_table() -> _Table:
+    """Load the lookup table from disk, if it hasn't been already.
+    If no table is configured or it can't be read, an empty table is used.
+    """
+    global _table
+
+    with _table_lock:
+        if _table is not None:
+            return _table
+
+        entries = []
+        if config.POSTAL_CENTROIDS_FILE_PATH:
+            try:
+                with open(config.POSTAL_CENTROIDS_FILE_PATH, 'r', newline='') as f:
+                    for line_num, record in enumerate(csv.reader(f), start=1):
+                        try:
+                            key = _make_key(record[0])
+                            latitude, longitude = float(record[1]), float(record[2])
+                        except (IndexError, ValueError):
+                            key = None
+                        if not key:
+                            logging.warning('postal_centroids: bad entry at line %d: %s', line_num, record)
+                            continue
+                        entries.append((key, latitude, longitude))
+            except OSError as e:
+                logging.error('postal_centroids: failed to load table', exc_info=e)
+                entries = []
+
+        entries.sort()
+        _table = _Table(
+            b''.join(e[0] for e in entries),
+            array.array('d', (e[1] for e in entries)),
+            array.array('d', (e[2] for e in entries)))
+
+        logging.info('postal_centroids: loaded %d entries', len(_table))
+        return _table
+
+
+def latlong_for_postal_code(postal_code: str) -> str:
+    """Get an approximate "latitude, longitude" string for the given postal code, in the
+    same form as `helpers.latlong_for_record()`. Makes no network calls.
+    Returns empty string if the postal code (or its FSA) isn't in the table.
+    """
+    key = _make_key(postal_code)
+    if not key:
+        return ''
+
+    table = _load_table()
+
+    i = table.find(key)
+    if i is None:
+        # Fall back to the FSA
+        i = table.find(_make_key(key[:3].decode('ascii')))
+    if i is None:
+        return ''
+
+    return '%s, %s' % (table.latitudes[i], table.longitudes[i])
@@ -21,6 +21,7 @@ import flask
 from google.cloud import ndb
 
 import config
+import instrumentation
 import helpers
 import gapps
 import emailer
@@ -124,7 +125,7 @@ class MemberCandidate(ndb.Model):
     def pop(cls, keystring: str) -> MemberCandidate:
         """Fetch and remove from the datastore the member candidate at `keystring.`
         """
-        with cls._ndb_client.context():
+        with instrumentation.ndb_context(cls._ndb_client):
             member_candidate_key = ndb.Key(urlsafe=keystring)
             member_candidate = member_candidate_key.get()
             member_candidate_key.delete()
@@ -136,7 +137,7 @@ class MemberCandidate(ndb.Model):
         Returns the count of records removed.
         """
         now = datetime.datetime.now()
-        with cls._ndb_client.context():
+        with instrumentation.ndb_context(cls._ndb_client):
             expireds = MemberCandidate.query(MemberCandidate.expire <= now).fetch()
             if not expireds:
                 return 0
@@ -146,7 +147,7 @@ class MemberCandidate(ndb.Model):
     def store(self):
         """Store the current member candidate object in the datastore.
         """
-        with self._ndb_client.context():
+        with instrumentation.ndb_context(self._ndb_client):
             return self.put()
 
 
@@ -465,7 +466,8 @@ def paypal_ipn():
 
     # First check with Paypal to see if this notification is legit
     validation_url = config.PAYPAL_IPN_VALIDATION_URL % req_data
-    validation_response = requests.post(validation_url)
+    with instrumentation.timed('paypal'):
+        validation_response = requests.post(validation_url)
     if validation_response.status_code != 200 or validation_response.text != 'VERIFIED':
         # NOT LEGIT
         logging.warning('self_serve_tasks.paypal_ipn: invalid IPN request; %d; %s', validation_response.status_code, validation_response.text)
@@ -20,15 +20,18 @@ deletion occurring, but isn't good enough for a real application.
 """
 
 from __future__ import annotations
-from typing import Tuple, Callable, Optional, Union, List
+from typing import Tuple, Callable, Optional, Union, List, Iterator, BinaryIO
 import itertools
 import json
 import logging
+import flask
 from googleapiclient.discovery import build
 from googleapiclient.discovery_cache.base import Cache
+from googleapiclient.http import MediaIoBaseUpload
 from google.oauth2 import service_account
 
 import config
+import instrumentation
 
 
 # from https://github.com/googleapis/google-api-python-client/issues/325#issuecomment-274349841
@@ -77,12 +80,11 @@ class Row(object):
         """Append the current row to the given sheet.
         WARNING: If you directly construct a list of new Rows -- with no `headings` set --
         and then `append()` them in a loop, you'll be incurring two network operations
-        each -- one to fetch headings, and one to append. We don't do that right now, but
-        one day we might need batch operation that is more efficient.
+        each -- one to fetch headings, and one to append. Use `append_rows()` instead.
         """
-        _add_row(
+        _add_rows(
             self.sheet.spreadsheet_id, self.sheet.worksheet_title,
-            self._to_tuple())
+            [self._to_tuple()])
 
     def update(self):
         """Update the current row in the sheet.
@@ -117,28 +119,84 @@ def _drive_service():
     return build('drive', 'v3', credentials=credentials, cache=MemoryCache())
 
 
-def _add_row(spreadsheet_id: str, worksheet_title: str, row_values: List):
-    """Add a row to the given sheet.
+def _execute(request, dependency: str = 'sheets'):
+    """Execute the API request, timing it as a call to `dependency`.
     """
+    with instrumentation.timed(dependency):
+        return request.execute()
+
+
+def _memo() -> Optional[dict]:
+    """Returns the request-scoped memo of sheet data, or None if there's no request (or
+    app) context, such as on a worker thread.
+    The memo maps the arguments of `_get_sheet_data()` to its result. Entries for a
+    worksheet are dropped whenever it's written to.
+    """
+    if not flask.has_app_context():
+        return None
+    if 'sheet_data_memo' not in flask.g:
+        flask.g.sheet_data_memo = {}
+        flask.g.sheet_data_memo_hits = 0
+    return flask.g.sheet_data_memo
+
+
+def _invalidate_memo(spreadsheet_id: str, worksheet_title: str):
+    """Drop the memoized data for the worksheet, because it's about to be written to.
+    """
+    memo = _memo()
+    if not memo:
+        return
+    for key in [k for k in memo if k[:2] == (spreadsheet_id, worksheet_title)]:
+        del memo[key]
+
+
+def after_request(response: flask.Response) -> flask.Response:
+    """To be called after every request. Logs how many sheet reads the memo saved.
+    """
+    if flask.g.get('sheet_data_memo_hits'):
+        logging.info('sheetdata: request-scoped memo saved %d sheet reads', flask.g.sheet_data_memo_hits)
+    return response
+
+
+def _add_rows(spreadsheet_id: str, worksheet_title: str, rows_values: List[List]):
+    """Add rows to the given sheet.
+    """
+    _invalidate_memo(spreadsheet_id, worksheet_title)
     body = {
-        'values': [row_values]
+        'values': rows_values
     }
     ss = _sheets_service()
-    ss.values().append(spreadsheetId=spreadsheet_id,
-                       range=worksheet_title,
-                       body=body,
-                       insertDataOption='INSERT_ROWS',
-                       valueInputOption='USER_ENTERED').execute()
+    _execute(ss.values().append(spreadsheetId=spreadsheet_id,
+                                range=worksheet_title,
+                                body=body,
+                                insertDataOption='INSERT_ROWS',
+                                valueInputOption='USER_ENTERED'))
 
 
-def update_rows(sheet: config.Spreadsheet, rows: List[Row]):
+def append_rows(sheet: config.Spreadsheet, rows: List[Row]):
+    """Append all of the given rows to the sheet, in one operation.
+    The headings are fetched (once) if the first row doesn't have them.
+    """
+    if not rows:
+        return
+
+    headings = rows[0].headings or _get_sheet_headings(sheet.spreadsheet_id, sheet.worksheet_title)
+    _add_rows(
+        sheet.spreadsheet_id, sheet.worksheet_title,
+        [_row_dict_to_tuple(sheet.spreadsheet_id, sheet.worksheet_title, r.dict, headings) for r in rows])
+
+
+def update_rows(sheet: config.Spreadsheet, rows: List[Row], fields: List[str] = None):
     """Update all of the given rows in the sheet.
     Note that the `num` property of the rows must be populated (so these row objects
     should have retrieved from the sheet).
+    If `fields` (a list of field names) is given, only those cells of each row will be
+    written. This avoids clobbering changes made to the rest of the row since it was read.
     """
     if not rows:
         return
 
+    headings = None
     body = { 'valueInputOption': 'USER_ENTERED', 'data': [] }
     for r in rows:
         if r.num <= 0:
@@ -151,14 +209,30 @@ def update_rows(sheet: config.Spreadsheet, rows: List[Row]):
 
         logging.debug('sheetdata.update_rows: %s::%d', type(sheet.fields), r.num)
 
-        body['data'].append({
-                'range': f'A{r.num}',
-                'majorDimension': 'ROWS',
-                'values': [r._to_tuple()],
-            })
+        if fields is None:
+            body['data'].append({
+                    'range': f'A{r.num}',
+                    'majorDimension': 'ROWS',
+                    'values': [r._to_tuple()],
+                })
+            continue
+
+        if not headings:
+            headings = r.headings or _get_sheet_headings(sheet.spreadsheet_id, sheet.worksheet_title)
+
+        for field_name in fields:
+            if field_name not in headings:
+                raise ValueError(f'sheetdata.update_rows: field not in headings: {field_name}')
+            body['data'].append({
+                    'range': f'{_column_letter(headings.index(field_name))}{r.num}',
+                    'majorDimension': 'ROWS',
+                    'values': [[r.dict.get(field_name)]],
+                })
+
+    _invalidate_memo(sheet.spreadsheet_id, sheet.worksheet_title)
 
     ss = _sheets_service()
-    ss.values().batchUpdate(spreadsheetId=sheet.spreadsheet_id, body=body).execute()
+    _execute(ss.values().batchUpdate(spreadsheetId=sheet.spreadsheet_id, body=body))
 
 
 def delete_rows(sheet: config.Spreadsheet, row_nums: List[int]):
@@ -185,13 +259,37 @@ def delete_rows(sheet: config.Spreadsheet, row_nums: List[int]):
                 }
             })
 
+    _invalidate_memo(sheet.spreadsheet_id, sheet.worksheet_title)
+
     ss = _sheets_service()
-    ss.batchUpdate(spreadsheetId=sheet.spreadsheet_id, body=body).execute()
+    _execute(ss.batchUpdate(spreadsheetId=sheet.spreadsheet_id, body=body))
 
 
 def _get_sheet_data(spreadsheet_id: str, worksheet_title: str, row_num_start: int = None, row_num_end: int = None) -> List[List]:
     """Get data in the sheet, bounded by the given start and end (which are 1-based and inclusive).
     If the start and end are None, the entire sheet will be retrieved (including headings).
+    Results are memoized for the rest of the request, until the worksheet is written to.
+    The returned list must not be modified.
+    """
+    memo = _memo()
+    memo_key = (spreadsheet_id, worksheet_title, row_num_start, row_num_end)
+    if memo is not None and memo_key in memo:
+        flask.g.sheet_data_memo_hits += 1
+        return memo[memo_key]
+
+    values = _fetch_sheet_data(spreadsheet_id, worksheet_title, row_num_start, row_num_end)
+    if not values:
+        # This can happen if the spreadsheet is empty
+        logging.error('_get_sheet_data: not values present')
+
+    if memo is not None:
+        memo[memo_key] = values
+    return values
+
+
+def _fetch_sheet_data(spreadsheet_id: str, worksheet_title: str, row_num_start: int = None, row_num_end: int = None) -> List[List]:
+    """Helper for `_get_sheet_data()` that makes the API request.
+    Returns an empty list if there are no values in the range.
     """
     rng = worksheet_title
     if row_num_start:
@@ -202,16 +300,12 @@ def _get_sheet_data(spreadsheet_id: str, worksheet_title: str, row_num_start: in
         rng += f':{row_num_end}'
 
     ss = _sheets_service()
-    result = ss.values().get(spreadsheetId=spreadsheet_id,
-                             range=rng,
-                             dateTimeRenderOption='FORMATTED_STRING',
-                             majorDimension='ROWS',
-                             valueRenderOption='UNFORMATTED_VALUE').execute()
-    if not result.get('values'):
-        # This can happen if the spreadsheet is empty
-        logging.error('_get_sheet_data: not values present')
-        return []
-    return result['values']
+    result = _execute(ss.values().get(spreadsheetId=spreadsheet_id,
+                                      range=rng,
+                                      dateTimeRenderOption='FORMATTED_STRING',
+                                      majorDimension='ROWS',
+                                      valueRenderOption='UNFORMATTED_VALUE'))
+    return result.get('values') or []
 
 
 def find_rows(sheet: config.Spreadsheet, matcher: Callable[[dict], bool], max_matches: int = None) -> List[Row]:
@@ -242,6 +336,38 @@ def find_rows(sheet: config.Spreadsheet, matcher: Callable[[dict], bool], max_ma
     return matches
 
 
+def iter_rows(sheet: config.Spreadsheet, chunk_size: int = None) -> Iterator[Row]:
+    """Iterate over all of the rows in the sheet. Unlike `find_rows()`, the rows are
+    fetched in chunks of `chunk_size` rows (default `config.SHEET_READ_CHUNK_ROWS`), as
+    they're consumed, so the whole sheet is never held in memory. The chunks aren't
+    memoized. As with `find_rows()`, blank rows are included, except at the end.
+    """
+    chunk_size = chunk_size or config.SHEET_READ_CHUNK_ROWS
+
+    headings = _get_sheet_headings(sheet.spreadsheet_id, sheet.worksheet_title)
+    row_count = _get_worksheet_row_count(sheet.spreadsheet_id, sheet.worksheet_title)
+
+    # Trailing empty rows of a range aren't returned, so a short chunk isn't
+    # necessarily the end of the data; the worksheet's row count bounds the loop.
+    next_row_num = 2 # 1-based, after the headings
+    for row_num_start in range(2, row_count + 1, chunk_size):
+        tuples = _fetch_sheet_data(sheet.spreadsheet_id, sheet.worksheet_title,
+                                   row_num_start, min(row_num_start + chunk_size - 1, row_count))
+        if not tuples:
+            continue
+
+        # Blank rows that were at the end of previous chunks
+        for row_num in range(next_row_num, row_num_start):
+            row_dict = _row_tuple_to_dict(sheet.spreadsheet_id, sheet.worksheet_title, [], headings)
+            yield Row(row_dict, sheet=sheet, num=row_num, headings=headings)
+
+        for i, t in enumerate(tuples):
+            row_dict = _row_tuple_to_dict(sheet.spreadsheet_id, sheet.worksheet_title, t, headings)
+            yield Row(row_dict, sheet=sheet, num=row_num_start + i, headings=headings)
+
+        next_row_num = row_num_start + len(tuples)
+
+
 def copy_drive_file(file_id: str, new_title: str, new_description: str):
     """Copy a Google Drive file, with a new title and description.
     """
@@ -249,17 +375,52 @@ def copy_drive_file(file_id: str, new_title: str, new_description: str):
 
     # Make the copy
     request_body = { 'name': new_title, 'description': new_description }
-    new_file_info = drive.files().copy(fileId=file_id, body=request_body).execute()
+    new_file_info = _execute(drive.files().copy(fileId=file_id, body=request_body), 'drive')
+
+    _transfer_ownership(drive, new_file_info['id'], file_id)
+
+
+def upload_drive_file(fileobj: BinaryIO, mimetype: str, beside_file_id: str, title: str, description: str) -> str:
+    """Upload the contents of `fileobj` (from its current position) as a new Google Drive
+    file, in the same folder as, and owned by the owner of, the file `beside_file_id`.
+    The upload is resumable and chunked, so the contents needn't fit in memory.
+    Returns the ID of the new file.
+    """
+    drive = _drive_service()
+
+    beside_file_info = _execute(drive.files().get(fileId=beside_file_id, fields='parents'), 'drive')
+
+    request_body = { 'name': title, 'description': description, 'parents': beside_file_info.get('parents') }
+    media = MediaIoBaseUpload(fileobj, mimetype=mimetype, resumable=True)
+    new_file_info = _execute(drive.files().create(body=request_body, media_body=media, fields='id'), 'drive')
 
-    # The service account will be the owner of the new file, so we need to transfer it to
-    # the owner of the original file.
-    orig_file_info = drive.files().get(fileId=file_id, fields="owners").execute()
+    _transfer_ownership(drive, new_file_info['id'], beside_file_id)
+
+    return new_file_info['id']
+
+
+def _transfer_ownership(drive, file_id: str, owner_of_file_id: str):
+    """Transfer ownership of `file_id` to the owner of `owner_of_file_id`.
+    The service account will be the owner of files it creates, so we need to transfer
+    them to the owner of the original file.
+    """
+    orig_file_info = _execute(drive.files().get(fileId=owner_of_file_id, fields="owners"), 'drive')
     orig_owner_permission_id = orig_file_info['owners'][0]['permissionId']
-    drive.permissions().update(
-        fileId=new_file_info['id'],
+    _execute(drive.permissions().update(
+        fileId=file_id,
         permissionId=orig_owner_permission_id,
         transferOwnership=True,
-        body={'role': 'owner'}).execute()
+        body={'role': 'owner'}), 'drive')
+
+
+def get_file_version(file_id: str) -> str:
+    """Returns the version of the Google Drive file (such as a spreadsheet). This changes
+    whenever the file is modified, so can be used to tell whether cached data is stale.
+    This is a metadata-only request, much cheaper than fetching the sheet data.
+    """
+    drive = _drive_service()
+    file_info = _execute(drive.files().get(fileId=file_id, fields='version'), 'drive')
+    return file_info['version']
 
 
 def get_first_sheet_properties(spreadsheet_id: str) -> dict:
@@ -268,16 +429,40 @@ def get_first_sheet_properties(spreadsheet_id: str) -> dict:
     Throws exception if not found.
     """
     ss = _sheets_service()
-    result = ss.get(spreadsheetId=spreadsheet_id).execute()
+    result = _execute(ss.get(spreadsheetId=spreadsheet_id))
     return result['sheets'][0]['properties']
 
 
+def _get_worksheet_row_count(spreadsheet_id: str, worksheet_title: str) -> int:
+    """Returns the number of rows in the worksheet's grid, including empty ones.
+    Throws exception if the worksheet isn't found.
+    """
+    ss = _sheets_service()
+    result = _execute(ss.get(spreadsheetId=spreadsheet_id,
+                             fields='sheets.properties(title,gridProperties.rowCount)'))
+    for worksheet in result['sheets']:
+        if worksheet['properties']['title'] == worksheet_title:
+            return worksheet['properties']['gridProperties']['rowCount']
+    raise Exception(f'sheetdata._get_worksheet_row_count: worksheet not found: {spreadsheet_id}::{worksheet_title}')
+
+
 def _get_sheet_headings(spreadsheet_id: str, worksheet_title: str) -> List:
     """Get the headings from the given sheet.
     """
     return _get_sheet_data(spreadsheet_id, worksheet_title, 1, 1)[0]
 
 
+def _column_letter(col_idx: int) -> str:
+    """Convert a 0-based column index into its A1-notation letters (0 -> 'A', 26 -> 'AA').
+    """
+    letters = ''
+    col_idx += 1
+    while col_idx > 0:
+        col_idx, remainder = divmod(col_idx - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
 def _row_dict_to_tuple(spreadsheet_id: str, worksheet_title: str, row_dict: dict, headings: List) -> List:
     """Convert a dict with a row of sheet data into a tuple suitable for API operations.
     If none, `headings` will be fetched, but results in an additional network operation.
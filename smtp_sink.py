@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# Copyright Adam Pritchard 2020
+# MIT License : https://adampritchard.mit-license.org/
+#
+
+"""
+A local SMTP server that accepts and discards mail, for exercising and measuring
+`emailer` without a real SMTP provider.
+
+It implements just enough of SMTP for `emailer`: EHLO, STARTTLS (with a self-signed
+certificate, generated with `openssl`), AUTH (any credentials are accepted), and
+message submission. Latency and failures can be injected.
+
+Usage:
+    python smtp_sink.py --port 2525 --latency 0.05 --failure-rate 0.01
+
+Then, in config, set SMTP_HOST to 'localhost', SMTP_PORT to the port, and
+SMTP_CA_FILE to the certificate path that gets printed.
+
+This is for development only. It has no real security and stores nothing.
+"""
+
+import argparse
+import base64
+import os
+import random
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+
+
+def make_self_signed_cert(directory: str):
+    """Generate a self-signed certificate and key for localhost in the directory.
+    Returns a tuple of (cert path, key path).
+    """
+    cert_path = os.path.join(directory, 'smtp_sink_cert.pem')
+    key_path = os.path.join(directory, 'smtp_sink_key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=localhost',
+         '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+         '-keyout', key_path, '-out', cert_path],
+        check=True, capture_output=True)
+    return cert_path, key_path
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Handles one SMTP connection.
+    """
+
+    def setup(self):
+        super().setup()
+        self.tls = False
+        self.authed = False
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def readline(self) -> str:
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError('client disconnected')
+        return line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+    def handle(self):
+        sink = self.server.sink
+        sink._count('connections')
+        self.reply('220 localhost smtp_sink ready')
+
+        try:
+            while True:
+                line = self.readline()
+                verb = line.split(' ', 1)[0].upper()
+
+                if verb in ('EHLO', 'HELO'):
+                    extensions = ['250-localhost']
+                    if not self.tls:
+                        extensions.append('250-STARTTLS')
+                    else:
+                        extensions.append('250-AUTH PLAIN LOGIN')
+                    extensions.append('250 8BITMIME')
+                    for ext in extensions:
+                        self.reply(ext)
+
+                elif verb == 'STARTTLS':
+                    self.reply('220 go ahead')
+                    self.request = sink.ssl_context.wrap_socket(self.request, server_side=True)
+                    self.rfile = self.request.makefile('rb')
+                    self.wfile = self.request.makefile('wb')
+                    self.tls = True
+
+                elif verb == 'AUTH':
+                    if not self.tls:
+                        self.reply('530 must issue STARTTLS first')
+                        continue
+                    mechanism = line.split(' ')[1].upper()
+                    if mechanism == 'LOGIN':
+                        self.reply('334 ' + base64.b64encode(b'Username:').decode())
+                        self.readline()
+                        self.reply('334 ' + base64.b64encode(b'Password:').decode())
+                        self.readline()
+                    elif mechanism == 'PLAIN' and len(line.split(' ')) < 3:
+                        self.reply('334 ')
+                        self.readline()
+                    self.authed = True
+                    self.reply('235 authenticated')
+
+                elif verb == 'MAIL' or verb == 'RCPT':
+                    if not self.authed:
+                        self.reply('530 authentication required')
+                        continue
+                    self.reply('250 ok')
+
+                elif verb == 'DATA':
+                    self.reply('354 end data with <CR><LF>.<CR><LF>')
+                    while self.readline() != '.':
+                        pass
+                    if sink.latency:
+                        time.sleep(sink.latency)
+                    if sink.disconnect_rate and random.random() < sink.disconnect_rate:
+                        sink._count('disconnected')
+                        return
+                    if sink.failure_rate and random.random() < sink.failure_rate:
+                        sink._count('rejected')
+                        self.reply('451 injected failure')
+                        continue
+                    sink._count('accepted')
+                    self.reply('250 queued')
+
+                elif verb in ('RSET', 'NOOP'):
+                    self.reply('250 ok')
+
+                elif verb == 'QUIT':
+                    self.reply('221 bye')
+                    return
+
+                else:
+                    self.reply('502 command not implemented')
+
+        except (ConnectionError, ssl.SSLError, OSError):
+            # The client went away
+            return
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink(object):
+    """A local SMTP server, run on a background thread.
+    `latency` is the delay, in seconds, before each message is accepted.
+    `failure_rate` is the fraction of messages that are rejected with a transient error.
+    `disconnect_rate` is the fraction of messages after which the connection is dropped.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 0,
+                 latency: float = 0, failure_rate: float = 0, disconnect_rate: float = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.disconnect_rate = disconnect_rate
+
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.cert_path, key_path = make_self_signed_cert(self._tempdir.name)
+        self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.ssl_context.load_cert_chain(self.cert_path, key_path)
+
+        self._lock = threading.Lock()
+        self._stats = {'connections': 0, 'accepted': 0, 'rejected': 0, 'disconnected': 0}
+
+        self._server = _Server((host, port), _Handler)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def _count(self, stat: str):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._tempdir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency', type=float, default=0, help='seconds before each message is accepted')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of messages rejected')
+    parser.add_argument('--disconnect-rate', type=float, default=0, help='fraction of messages that drop the connection')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    sink = SMTPSink(port=args.port, latency=args.latency,
+                    failure_rate=args.failure_rate, disconnect_rate=args.disconnect_rate)
+    sink.start()
+    print(f'smtp_sink listening on {sink.host}:{sink.port}')
+    print(f'SMTP_CA_FILE = {sink.cert_path!r}')
+    try:
+        while True:
+            time.sleep(10)
+            logging.info('smtp_sink: %s', sink.stats())
+    except KeyboardInterrupt:
+        sink.stop()
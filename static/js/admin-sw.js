@@ -0,0 +1,234 @@
+/*
+ * Copyright Adam Pritchard 2020
+ * MIT License: https: //adampritchard.mit-license.org/
+ */
+
+/*
+ * Service worker for the admin site, for use at events with flaky connections.
+ *
+ * When a new-member or renew-member form submission can't get to the server (because
+ * the network request fails), it's saved in IndexedDB and a '202 Accepted' response is
+ * given, so the volunteer can carry on. The queued submissions are sent later, in
+ * batches, to /batch-sync. That's requested by the pages (see offline-queue.js), which
+ * supply a current CSRF token. Each queued submission has a UUID, so the server can
+ * tell if it's sent twice, and the time it was queued, which it's dated with.
+ *
+ * The form pages and static files are also cached, so the forms can be reloaded while
+ * offline.
+ */
+
+/* jshint worker:true */
+
+(function() {
+  "use strict";
+
+  var DB_NAME = 'deca-offline-queue';
+  var STORE_NAME = 'submissions';
+  var CACHE_NAME = 'deca-admin-v1';
+
+  // The forms whose submissions are queued when they can't be sent
+  var QUEUED_FORMS = ['new-member', 'renew-member'];
+  // The pages and static files that are cached for use offline
+  var CACHED_PATH_PREFIXES = ['/new-member', '/renew-member', '/js/', '/css/', '/vendor/'];
+
+  // This matches _BATCH_SYNC_MAX_SUBMISSIONS in admin_site.py
+  var MAX_BATCH = 50;
+
+  self.addEventListener('install', function() {
+    self.skipWaiting();
+  });
+
+  self.addEventListener('activate', function(event) {
+    event.waitUntil(self.clients.claim());
+  });
+
+  self.addEventListener('fetch', function(event) {
+    var url = new URL(event.request.url);
+    if (url.origin !== self.location.origin) {
+      return;
+    }
+
+    var form = url.pathname.slice(1);
+    if (event.request.method === 'POST' && QUEUED_FORMS.indexOf(form) >= 0) {
+      event.respondWith(submitOrQueue(event.request, form));
+    }
+    else if (event.request.method === 'GET' && isCachedPath(url.pathname)) {
+      event.respondWith(networkFirst(event.request));
+    }
+  });
+
+  self.addEventListener('message', function(event) {
+    if (event.data && event.data.type === 'flush') {
+      event.waitUntil(flush(event.data.csrfToken));
+    }
+  });
+
+  function isCachedPath(path) {
+    return CACHED_PATH_PREFIXES.some(function(prefix) {
+      return path.indexOf(prefix) === 0;
+    });
+  }
+
+  function networkFirst(request) {
+    return fetch(request)
+      .then(function(response) {
+        if (response.ok) {
+          var copy = response.clone();
+          caches.open(CACHE_NAME).then(function(cache) {
+            cache.put(request, copy);
+          });
+        }
+        return response;
+      })
+      .catch(function(err) {
+        return caches.match(request).then(function(cached) {
+          if (!cached) {
+            throw err;
+          }
+          return cached;
+        });
+      });
+  }
+
+  function submitOrQueue(request, form) {
+    var queueCopy = request.clone();
+
+    // A slow response isn't given up on, as the server may still be processing the
+    // submission, and queueing it too would apply it twice. Only a failed request
+    // (which fetch rejects with a TypeError) is queued.
+    return fetch(request)
+      .catch(function(err) {
+        if (!(err instanceof TypeError)) {
+          throw err;
+        }
+        return queueCopy.text()
+          .then(function(body) {
+            return dbRequest('readwrite', function(store) {
+              return store.add({ form: form, body: body, uuid: self.crypto.randomUUID(), queued: Date.now() });
+            });
+          })
+          .then(notifyPending)
+          .then(function() {
+            return new Response('queued', { status: 202, headers: { 'Content-Type': 'text/plain' } });
+          });
+      });
+  }
+
+  var _flushing = null;
+
+  function flush(csrfToken) {
+    // Only one flush at a time, so submissions aren't sent twice
+    if (!_flushing) {
+      _flushing = flushBatches(csrfToken, { synced: 0, errors: [] })
+        .then(function(summary) {
+          _flushing = null;
+          return notifyPending(summary);
+        }, function(err) {
+          _flushing = null;
+          console.log('admin-sw: flush failed; will retry', err);
+          return notifyPending({ failed: true });
+        });
+    }
+    return _flushing;
+  }
+
+  function flushBatches(csrfToken, summary) {
+    return dbRequest('readonly', function(store) { return store.getAll(null, MAX_BATCH); })
+      .then(function(items) {
+        if (!items.length) {
+          return summary;
+        }
+
+        return fetch('/batch-sync', {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: {
+              'Content-Type': 'application/json',
+              // Custom headers to help with CSRF mitigation.
+              'X-Requested-With': 'XMLHttpRequest',
+              'X-CSRFToken': csrfToken
+            },
+            body: JSON.stringify({
+              submissions: items.map(function(item) {
+                return {
+                  id: item.id,
+                  uuid: item.uuid,
+                  form: item.form,
+                  values: Object.fromEntries(new URLSearchParams(item.body)),
+                  queued: item.queued
+                };
+              })
+            })
+          })
+          .then(function(response) {
+            if (!response.ok) {
+              throw new Error('batch sync failed: ' + response.status);
+            }
+            return response.json();
+          })
+          .then(function(data) {
+            // Every submission that got a result is done with. Those that failed
+            // validation won't succeed by being sent again, so they're reported instead.
+            data.results.forEach(function(result) {
+              if (result.result === 'error') {
+                var item = items.find(function(item) { return item.id === result.id; });
+                summary.errors.push({ form: item && item.form, error: result.error,
+                                      values: item && Object.fromEntries(new URLSearchParams(item.body)) });
+              }
+              else {
+                summary.synced += 1;
+              }
+            });
+
+            return dbRequest('readwrite', function(store) {
+              data.results.forEach(function(result) { store.delete(result.id); });
+            });
+          })
+          .then(function() {
+            return flushBatches(csrfToken, summary);
+          });
+      });
+  }
+
+  // Tell the pages how many submissions are waiting, and the outcome of a flush
+  function notifyPending(summary) {
+    return dbRequest('readonly', function(store) { return store.count(); })
+      .then(function(pending) {
+        return self.clients.matchAll().then(function(clients) {
+          clients.forEach(function(client) {
+            client.postMessage({ type: 'offline-queue', pending: pending, summary: summary || null });
+          });
+        });
+      });
+  }
+
+  function openDB() {
+    return new Promise(function(resolve, reject) {
+      var req = indexedDB.open(DB_NAME, 1);
+      req.onupgradeneeded = function() {
+        req.result.createObjectStore(STORE_NAME, { keyPath: 'id', autoIncrement: true });
+      };
+      req.onsuccess = function() { resolve(req.result); };
+      req.onerror = function() { reject(req.error); };
+    });
+  }
+
+  // Run `fn` with the object store, in a transaction. Resolves with the result of the
+  // request `fn` returns (if any) when the transaction completes.
+  function dbRequest(mode, fn) {
+    return openDB().then(function(db) {
+      return new Promise(function(resolve, reject) {
+        var tx = db.transaction(STORE_NAME, mode);
+        var req = fn(tx.objectStore(STORE_NAME));
+        tx.oncomplete = function() {
+          db.close();
+          resolve(req ? req.result : undefined);
+        };
+        tx.onerror = tx.onabort = function() {
+          db.close();
+          reject(tx.error);
+        };
+      });
+    });
+  }
+})();
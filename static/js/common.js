@@ -222,6 +222,10 @@
             });
           }
 
+          // The admin service worker (admin-sw.js) responds with 202 when it has queued
+          // the submission to send later.
+          $modal.find('.waitModalQueued').toggleClass('hidden', jqxhr.status !== 202);
+
           // Show the correct buttons.
           _this.waitModalSuccess($modal);
         })
@@ -0,0 +1,61 @@
+/*
+ * Copyright Adam Pritchard 2020
+ * MIT License: https: //adampritchard.mit-license.org/
+ */
+
+$(function() {
+  "use strict";
+
+  $('#importMembers button[type="submit"]').click(onSubmitImportMembers);
+
+  DECA.setupWaitModal($('#importMembers .waitModal'), onSubmitImportMembers);
+
+  function onSubmitImportMembers(event) {
+    if (event) {
+      event.preventDefault();
+    }
+
+    var $form = $('#importMembers form');
+    var $file = $form.find('input[type="file"]');
+
+    if (!$file[0].files.length) {
+      $file.focus();
+      return false;
+    }
+
+    // The file has to be sent as multipart form data
+    var data = new FormData($form[0]);
+
+    DECA.waitModalShow($('#importMembers .waitModal'));
+
+    var jqxhr = $.ajax({
+          url: '',
+          type: 'POST',
+          data: data,
+          processData: false,
+          contentType: false,
+          // Add a custom header to help with CSRF mitigation.
+          headers: {
+            'X-Requested-With': 'XMLHttpRequest',
+            'X-CSRFToken': data.get(DECA.CSRF_TOKEN_KEY)
+          }
+        })
+        .done(function(responseText) {
+          console.log('success', arguments);
+          $('#importMembers .importSummary').text(responseText);
+          DECA.waitModalSuccess($('#importMembers .waitModal'));
+        })
+        .fail(function() {
+          console.log('fail', arguments);
+
+          // Retry on server errors.
+          var retry = (jqxhr.status >= 500 && jqxhr.status < 600);
+
+          DECA.waitModalError($('#importMembers .waitModal'), jqxhr.statusText,
+                              jqxhr.responseText, retry);
+        });
+    console.log('jqxhr', jqxhr);
+
+    return false;
+  }
+});
@@ -0,0 +1,59 @@
+/*
+ * Copyright Adam Pritchard 2020
+ * MIT License: https: //adampritchard.mit-license.org/
+ */
+
+/*
+ * Sets up the admin service worker (admin-sw.js), which queues form submissions made
+ * while offline, and asks it to send the queue when we're online. Shows how many
+ * submissions are waiting.
+ */
+
+$(function() {
+  "use strict";
+
+  if (!('serviceWorker' in navigator)) {
+    return;
+  }
+
+  var $status = $('<div class="alert alert-warning hidden" role="alert"></div>').insertAfter('.page-header');
+
+  navigator.serviceWorker.register('/admin-sw.js');
+
+  navigator.serviceWorker.addEventListener('message', function(event) {
+    if (!event.data || event.data.type !== 'offline-queue') {
+      return;
+    }
+
+    var summary = event.data.summary || {};
+    var lines = [];
+    if (event.data.pending) {
+      lines.push(event.data.pending + ' submission(s) saved on this device, waiting to be sent.');
+    }
+    if (summary.synced) {
+      lines.push(summary.synced + ' saved submission(s) sent.');
+    }
+    _.forEach(summary.errors, function(err) {
+      var values = err.values || {};
+      lines.push('Could not save ' + (values['First Name'] || '') + ' ' + (values['Last Name'] || '') +
+                 ' <' + (values['Email'] || '') + '> (' + err.form + '): ' + err.error + '. Please enter them again.');
+    });
+
+    $status.text(lines.join('\n'))
+           .css('white-space', 'pre-line')
+           .toggleClass('hidden', !lines.length)
+           .toggleClass('alert-danger', !!(summary.errors && summary.errors.length));
+  });
+
+  function requestFlush() {
+    navigator.serviceWorker.ready.then(function(registration) {
+      registration.active.postMessage({
+        type: 'flush',
+        csrfToken: $('input[name="' + DECA.CSRF_TOKEN_KEY + '"]').first().val()
+      });
+    });
+  }
+
+  window.addEventListener('online', requestFlush);
+  requestFlush();
+});
@@ -9,13 +9,22 @@
 Flask routes used by tasks queues and cron jobs
 """
 
+from typing import List, Set
 import logging
+import contextlib
+import time
+import datetime
 import flask
 from google.cloud import ndb
 
 import config
+import instrumentation
+import sheetdata
 import gapps
 import emailer
+import email_templates
+import self_serve
+import local_tasks
 import main
 
 
@@ -44,19 +53,19 @@ def new_member_mail():
                                 member_dict[config.SHEETS.member.fields.last_name.name])
     member_email = member_dict[config.SHEETS.member.fields.email.name]
 
-    with open('templates/tasks/email-new-member-subject.txt', 'r') as subject_file:
-        subject = subject_file.read().strip()
-
-    body_html = flask.render_template(
-        'tasks/email-new-member.jinja',
-        app_config=config,
+    subject, body_html, body_text = email_templates.render(
+        email_templates.NEW_MEMBER,
         member_first_name=member_dict[config.SHEETS.member.fields.first_name.name])
 
-    if not emailer.send((member_email, member_name), subject, body_html, None):
-        # Log and carry on
-        logging.error(f'failed to send new-member email to {member_email}')
-    else:
-        logging.info(f'sent new-member email to {member_email}')
+    member_id = member_dict.get(config.SHEETS.member.fields.id.name)
+    if not member_id:
+        logging.warning('tasks.new_member_mail: member has no ID; email will not be de-duplicated')
+
+    # Sent via the outbox. If this fails, the task will be retried, and the message
+    # keys prevent duplicates.
+    emailer.enqueue((member_email, member_name), subject, body_html, body_text,
+                    key=f'new-member:{member_id}' if member_id else None)
+    logging.info(f'enqueued new-member email to {member_email}')
 
     #
     # Send email to volunteer-interest-area reps
@@ -65,16 +74,9 @@ def new_member_mail():
     interest_reps = gapps.get_volunteer_interest_reps_for_member(member_dict)
 
     if interest_reps:
-        subject = flask.render_template(
-            'tasks/email-volunteer-interest-rep-subject.jinja',
-            app_config=config,
-            join_type='member',
-            member_first_name=member_dict[config.SHEETS.member.fields.first_name.name]).strip()
-
         for interest, reps in interest_reps.items():
-            body_html = flask.render_template(
-                'tasks/email-volunteer-interest-rep.jinja',
-                app_config=config,
+            subject, body_html, body_text = email_templates.render(
+                email_templates.VOLUNTEER_INTEREST_REP,
                 join_type='member',
                 interest=interest,
                 member_name=member_name,
@@ -83,14 +85,9 @@ def new_member_mail():
             for rep in reps:
                 rep_email = rep.get(config.SHEETS.volunteer_interest.fields.email.name)
                 rep_name = rep.get(config.SHEETS.volunteer_interest.fields.name.name)
-                ok = emailer.send(
-                        (rep_email, rep_name),
-                        subject,
-                        body_html, None)
-                if not ok:
-                    logging.error(f'failed to send new-member-volunteer-interest email to {rep_email}')
-                else:
-                    logging.info(f'sent new-member-volunteer-interest email to {rep_email}')
+                emailer.enqueue((rep_email, rep_name), subject, body_html, body_text,
+                                key=f'new-member-volunteer-interest:{member_id}:{interest}:{rep_email}' if member_id else None)
+                logging.info(f'enqueued new-member-volunteer-interest email to {rep_email}')
 
     return flask.make_response('', 200)
 
@@ -113,20 +110,22 @@ def renew_member_mail():
                                 member_dict[config.SHEETS.member.fields.last_name.name])
     member_email = member_dict[config.SHEETS.member.fields.email.name]
 
-    with open('templates/tasks/email-renew-member-subject.txt', 'r') as subject_file:
-        subject = subject_file.read().strip()
-
-    body_html = flask.render_template(
-        'tasks/email-renew-member.jinja',
-        app_config=config,
+    subject, body_html, body_text = email_templates.render(
+        email_templates.RENEW_MEMBER,
         member_first_name=member_dict[config.SHEETS.member.fields.first_name.name])
 
-    if not emailer.send((member_email, member_name), subject, body_html, None):
-        # Log and carry on
-        # TODO: Should we instead return non-200 and let the task retry?
-        logging.error(f'failed to send renew-member email to {member_email}')
-    else:
-        logging.info(f'sent renew-member email to {member_email}')
+    # The Renewed date is only the day, so the key also needs a stable identifier for
+    # the member. Without one, same-day renewals would be taken as duplicates.
+    member_key = member_dict.get(config.SHEETS.member.fields.id.name) or (member_email or '').lower()
+    member_renewed = member_dict.get(config.SHEETS.member.fields.renewed.name)
+    key = f'renew-member:{member_key}:{member_renewed}' if member_key else None
+    if not key:
+        logging.warning('tasks.renew_member_mail: member has no ID or email; email will not be de-duplicated')
+
+    # Sent via the outbox. If this fails, the task will be retried, and the message
+    # key prevents duplicates.
+    emailer.enqueue((member_email, member_name), subject, body_html, body_text, key=key)
+    logging.info(f'enqueued renew-member email to {member_email}')
 
     return flask.make_response('', 200)
 
@@ -150,20 +149,19 @@ def new_volunteer_mail():
                                 volunteer_dict[config.SHEETS.volunteer.fields.last_name.name])
     volunteer_email = volunteer_dict[config.SHEETS.volunteer.fields.email.name]
 
-    with open('templates/tasks/email-new-volunteer-subject.txt', 'r') as subject_file:
-        subject = subject_file.read().strip()
-
-    body_html = flask.render_template(
-        'tasks/email-new-volunteer.jinja',
-        app_config=config,
+    subject, body_html, body_text = email_templates.render(
+        email_templates.NEW_VOLUNTEER,
         volunteer_first_name=volunteer_dict[config.SHEETS.volunteer.fields.first_name.name])
 
-    if not emailer.send((volunteer_email, volunteer_name), subject, body_html, None):
-        # Log and carry on
-        # TODO: Should we instead return non-200 and let the task retry?
-        logging.error(f'failed to send new-volunteer email to {volunteer_email}')
-    else:
-        logging.info(f'sent new-volunteer email to {volunteer_email}')
+    volunteer_id = volunteer_dict.get(config.SHEETS.volunteer.fields.id.name)
+    if not volunteer_id:
+        logging.warning('tasks.new_volunteer_mail: volunteer has no ID; email will not be de-duplicated')
+
+    # Sent via the outbox. If this fails, the task will be retried, and the message
+    # keys prevent duplicates.
+    emailer.enqueue((volunteer_email, volunteer_name), subject, body_html, body_text,
+                    key=f'new-volunteer:{volunteer_id}' if volunteer_id else None)
+    logging.info(f'enqueued new-volunteer email to {volunteer_email}')
 
     #
     # Send email to volunteer-interest-area reps
@@ -172,15 +170,9 @@ def new_volunteer_mail():
     interest_reps = gapps.get_volunteer_interest_reps_for_member(volunteer_dict)
 
     if interest_reps:
-        subject = flask.render_template(
-            'tasks/email-volunteer-interest-rep-subject.jinja',
-            app_config=config,
-            join_type='volunteer').strip()
-
         for interest, reps in interest_reps.items():
-            body_html = flask.render_template(
-                'tasks/email-volunteer-interest-rep.jinja',
-                app_config=config,
+            subject, body_html, body_text = email_templates.render(
+                email_templates.VOLUNTEER_INTEREST_REP,
                 join_type='volunteer',
                 interest=interest,
                 member_name=volunteer_name,
@@ -189,13 +181,24 @@ def new_volunteer_mail():
             for rep in reps:
                 rep_email = rep.get(config.SHEETS.volunteer_interest.fields.email.name)
                 rep_name = rep.get(config.SHEETS.volunteer_interest.fields.name.name)
-                ok = emailer.send(
-                        (rep_email, rep_name),
-                        subject, body_html, None)
-                if not ok:
-                    logging.error(f'failed to send new-volunteer-volunteer-interest email to {rep_email}')
-                else:
-                    logging.info(f'sent new-volunteer-volunteer-interest email to {rep_email}')
+                emailer.enqueue((rep_email, rep_name), subject, body_html, body_text,
+                                key=f'new-volunteer-volunteer-interest:{volunteer_id}:{interest}:{rep_email}' if volunteer_id else None)
+                logging.info(f'enqueued new-volunteer-volunteer-interest email to {rep_email}')
+
+    return flask.make_response('', 200)
+
+
+@tasks.route('/tasks/geocode-enrichment', methods=['POST'])
+def geocode_enrichment():
+    """Queue task invoked after a member or volunteer row has been written without
+    its geocoded fields. Fills them in. See config.GEOCODE_DEFERRED.
+    """
+    logging.debug('tasks.geocode_enrichment: hit')
+
+    params = gapps.validate_queue_task(flask.request)
+    logging.debug('tasks.geocode_enrichment: params: %s', params)
+
+    gapps.enrich_record_geocoding(params.get('sheet'), params.get('id'))
 
     return flask.make_response('', 200)
 
@@ -233,11 +236,11 @@ class Settings(ndb.Model):
 
     @classmethod
     def singleton(cls):
-        with cls._ndb_client.context():
+        with instrumentation.ndb_context(cls._ndb_client):
             return cls.get_or_insert(cls.SINGLETON_DATASTORE_KEY)
 
     def update(self):
-        with self._ndb_client.context():
+        with instrumentation.ndb_context(self._ndb_client):
             self.put()
 
 
@@ -260,10 +263,122 @@ def member_sheet_archive():
     return flask.make_response('', 200)
 
 
+@tasks.route('/tasks/member-sheet-snapshot', methods=['POST'])
+def member_sheet_snapshot():
+    """Queue task that writes a snapshot of the members sheet to Drive. Requested from
+    the admin site.
+    """
+    logging.debug('tasks.member_sheet_snapshot: hit')
+    gapps.validate_queue_task(flask.request)
+
+    today = datetime.date.today().isoformat()
+    gapps.snapshot_members_sheet(
+        f'Snapshot: Members {today}.csv.gz',
+        f'Snapshot of the Members spreadsheet on {today}')
+
+    return flask.make_response('', 200)
+
+
+class GeocodeBackfillCheckpoint(ndb.Model):
+    """Progress of the geocode backfill job between runs.
+    """
+    SINGLETON_DATASTORE_KEY = 'SINGLETON'
+
+    _ndb_client = ndb.Client()
+
+    failed_ids = ndb.TextProperty(
+        repeated=True,
+        verbose_name='IDs of rows that could not be geocoded in the current backfill pass. These are skipped until the pass completes.')
+
+    @classmethod
+    def singleton(cls):
+        with instrumentation.ndb_context(cls._ndb_client):
+            return cls.get_or_insert(cls.SINGLETON_DATASTORE_KEY)
+
+    def update(self):
+        with instrumentation.ndb_context(self._ndb_client):
+            self.put()
+
+
+@tasks.route('/tasks/geocode-backfill', methods=['GET', 'POST'])
+def geocode_backfill():
+    """Geocodes member and volunteer rows that are missing Address LatLong.
+    This gets called both as a cron job and a task queue job. If a run doesn't get
+    through all of the rows in time, it enqueues a task to continue.
+    """
+    if flask.request.method == 'GET':
+        # cron job
+        logging.debug('tasks.geocode_backfill: hit from cron')
+        gapps.validate_cron_task(flask.request)
+    else:
+        # task queue job
+        logging.debug('tasks.geocode_backfill: hit from task queue')
+        gapps.validate_queue_task(flask.request)
+
+    deadline = time.monotonic() + config.GEOCODE_BACKFILL_TIME_BUDGET_SECS
+    checkpoint = GeocodeBackfillCheckpoint.singleton()
+
+    complete, failed_ids = gapps.backfill_geocoding(checkpoint.failed_ids, deadline)
+    logging.info('tasks.geocode_backfill: complete: %s; failed: %s', complete, failed_ids)
+
+    if complete:
+        # The pass is done. Rows that failed will be tried again on the next pass.
+        checkpoint.failed_ids = []
+        checkpoint.update()
+    else:
+        checkpoint.failed_ids = checkpoint.failed_ids + failed_ids
+        checkpoint.update()
+        gapps.enqueue_task('/tasks/geocode-backfill', {})
+
+    return flask.make_response('', 200)
+
+
+class RenewalReminderSent(ndb.Model):
+    """Records that a renewal reminder has been sent to a member for a particular
+    renewal, so that retried shards don't send it again. Keyed by member ID and the
+    member's Renewed date.
+    """
+    # Indexed, for clearing out old records.
+    sent = ndb.DateTimeProperty(auto_now_add=True)
+
+    _ndb_client = ndb.Client()
+
+    @staticmethod
+    def key_for(member_dict: dict) -> str:
+        return '%s:%s' % (member_dict.get(config.SHEETS.member.fields.id.name),
+                          member_dict.get(config.SHEETS.member.fields.renewed.name))
+
+    @classmethod
+    def get_sent(cls, member_dicts: List[dict]) -> Set[str]:
+        """Returns the keys of the given members who have already been sent a reminder.
+        """
+        with instrumentation.ndb_context(cls._ndb_client):
+            entities = ndb.get_multi([ndb.Key(cls, cls.key_for(d)) for d in member_dicts])
+            return {e.key.id() for e in entities if e}
+
+    @classmethod
+    def record_sent(cls, member_dicts: List[dict]):
+        with instrumentation.ndb_context(cls._ndb_client):
+            ndb.put_multi([cls(id=cls.key_for(d)) for d in member_dicts])
+
+    @classmethod
+    def clear_olds(cls) -> int:
+        """Remove records older than config.RENEWAL_REMINDER_SENT_RETENTION_DAYS.
+        Returns the count of records removed.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=config.RENEWAL_REMINDER_SENT_RETENTION_DAYS)
+        with instrumentation.ndb_context(cls._ndb_client):
+            olds = cls.query(cls.sent < cutoff).fetch(keys_only=True)
+            if not olds:
+                return 0
+            ndb.delete_multi(olds)
+            return len(olds)
+
+
 @tasks.route('/tasks/renewal-reminder-emails', methods=['GET'])
 def renewal_reminder_emails():
     """Sends renewal reminder emails to members who are nearing their renewal
-    date.
+    date. The sending is fanned out to shard tasks.
     """
     logging.debug('tasks.renewal_reminder_emails: hit')
     gapps.validate_cron_task(flask.request)
@@ -275,17 +390,49 @@ def renewal_reminder_emails():
 
     logging.debug('tasks.renewal_reminder_emails: found %d expiring members', len(expiring_rows))
 
-    with open('templates/tasks/email-renewal-reminder-subject.txt', 'r') as subject_file:
-        subject_noauto = subject_file.read().strip()
+    _enqueue_renewal_reminder_shards(expiring_rows)
+
+    num_cleared = RenewalReminderSent.clear_olds()
+    logging.debug('tasks.renewal_reminder_emails: cleared %d old reminder records', num_cleared)
+
+    return flask.make_response('', 200)
+
+
+def _enqueue_renewal_reminder_shards(expiring_rows: List[sheetdata.Row]):
+    """Fan out the sending of renewal reminders to the given members to shard tasks.
+    """
+    # The task names prevent the shards being enqueued twice if this cron request is
+    # retried. (And if they were, the sent-log would prevent duplicate emails.)
+    today = datetime.date.today().strftime('%Y%m%d')
+    shard_size = config.RENEWAL_REMINDER_SHARD_SIZE
+    gapps.enqueue_tasks([
+        ('/tasks/renewal-reminder-shard',
+         {'members': [row.dict for row in expiring_rows[i:i+shard_size]]},
+         f'renewal-reminder-{today}-{i // shard_size}')
+        for i in range(0, len(expiring_rows), shard_size)])
+
+
+@tasks.route('/tasks/renewal-reminder-shard', methods=['POST'])
+def renewal_reminder_shard():
+    """Queue task that enqueues renewal reminder emails in the outbox for a shard of the
+    members who are nearing their renewal date. Members who have already been sent a
+    reminder are skipped, so a shard can safely be retried.
+    """
+    logging.debug('tasks.renewal_reminder_shard: hit')
+
+    params = gapps.validate_queue_task(flask.request)
+
+    member_dicts = params['members']
+    already_sent = RenewalReminderSent.get_sent(member_dicts)
+    member_dicts = [d for d in member_dicts if RenewalReminderSent.key_for(d) not in already_sent]
 
-    with open('templates/tasks/email-renewal-reminder-auto-subject.txt', 'r') as subject_file:
-        subject_auto = subject_file.read().strip()
+    logging.info('tasks.renewal_reminder_shard: %d to send; %d already sent', len(member_dicts), len(already_sent))
 
-    for row in expiring_rows:
-        member_first_name = row.dict.get(config.SHEETS.member.fields.first_name.name)
+    for member_dict in member_dicts:
+        member_first_name = member_dict.get(config.SHEETS.member.fields.first_name.name)
         member_name = '%s %s' % (member_first_name,
-                                 row.dict.get(config.SHEETS.member.fields.last_name.name))
-        member_email = row.dict.get(config.SHEETS.member.fields.email.name)
+                                 member_dict.get(config.SHEETS.member.fields.last_name.name))
+        member_email = member_dict.get(config.SHEETS.member.fields.email.name)
 
         # Right now we use a Paypal button that does one-time purchases;
         # that is, members pay for a year and then need to manually pay
@@ -293,27 +440,46 @@ def renewal_reminder_emails():
         # Paypal button, so there are still some members who automatically
         # pay each year. These two groups will get different reminder
         # emails.
-        auto_renewing = str(row.dict.get(config.SHEETS.member.fields.paypal_auto_renewing.name))
+        auto_renewing = str(member_dict.get(config.SHEETS.member.fields.paypal_auto_renewing.name))
         if auto_renewing.lower().startswith('y'):
             # Member is auto-renewing (i.e., is a Paypal "subscriber")
-            subject = subject_auto
-            body_html = flask.render_template(
-                'tasks/email-renewal-reminder-auto.jinja',
-                app_config=config,
-                member_first_name=row.dict.get(config.SHEETS.member.fields.first_name.name))
-            logging.info('tasks.renewal_reminder_emails: sending auto-renewing reminder to %s', member_email)
+            subject, body_html, body_text = email_templates.render(
+                email_templates.RENEWAL_REMINDER_AUTO,
+                member_first_name=member_first_name)
+            logging.info('tasks.renewal_reminder_shard: enqueuing auto-renewing reminder to %s', member_email)
 
         else:
             # Member is year-to-year
-            subject = subject_noauto
-            body_html = flask.render_template(
-                'tasks/email-renewal-reminder.jinja',
-                app_config=config,
-                member_first_name=row.dict.get(config.SHEETS.member.fields.first_name.name))
-            logging.info('tasks.renewal_reminder_emails: sending non-auto-renewing reminder to %s', member_email)
+            subject, body_html, body_text = email_templates.render(
+                email_templates.RENEWAL_REMINDER,
+                member_first_name=member_first_name)
+            logging.info('tasks.renewal_reminder_shard: enqueuing non-auto-renewing reminder to %s', member_email)
+
+        # Sent via the outbox, so that all of the shards together stay within the SMTP
+        # provider's rate limit. If this fails, the task will be retried, and the
+        # message keys prevent duplicates.
+        emailer.enqueue((member_email, member_name), subject, body_html, body_text,
+                        key=f'renewal-reminder:{RenewalReminderSent.key_for(member_dict)}')
+
+    RenewalReminderSent.record_sent(member_dicts)
+
+    return flask.make_response('', 200)
 
-        emailer.send((member_email, member_name),
-                     subject, body_html, None)
+
+@tasks.route('/tasks/email-outbox-drain', methods=['GET'])
+def email_outbox_drain():
+    """Cron task that sends the emails waiting in the outbox.
+    Cron doesn't start a run of this until the previous one has finished, which is
+    important, as concurrent drains could send messages twice.
+    """
+    logging.debug('tasks.email_outbox_drain: hit')
+    gapps.validate_cron_task(flask.request)
+
+    deadline = time.monotonic() + config.EMAIL_OUTBOX_DRAIN_TIME_BUDGET_SECS
+    complete = emailer.drain_outbox(deadline)
+    if not complete:
+        # The next cron run will pick up the rest
+        logging.warning('tasks.email_outbox_drain: did not get through all due messages')
 
     return flask.make_response('', 200)
 
@@ -321,7 +487,8 @@ def renewal_reminder_emails():
 @tasks.route('/tasks/process-mailchimp-updates', methods=['GET', 'POST'])
 def process_mailchimp_updates():
     """Updates MailChimp with changed members and volunteers.
-    This gets called both as a cron job and a task queue job.
+    This gets called both as a cron job and a task queue job. If a run doesn't get
+    through all of the rows in time, it enqueues a task to continue.
     """
     if flask.request.method == 'GET':
         # cron job
@@ -335,5 +502,137 @@ def process_mailchimp_updates():
     if not config.MAILCHIMP_ENABLED:
         return flask.make_response('', 200)
 
-    gapps.process_mailchimp_updates()
+    deadline = time.monotonic() + config.MAILCHIMP_SYNC_TIME_BUDGET_SECS
+    complete, failed_count = gapps.process_mailchimp_updates(deadline)
+
+    if not complete:
+        # Rows that have been synced are already stamped, so the continuation will
+        # pick up the rest, including any that failed. We must not also fail this
+        # run: its retry would enqueue another continuation, and the chains would
+        # multiply.
+        gapps.enqueue_task('/tasks/process-mailchimp-updates', {})
+        if failed_count:
+            logging.warning('tasks.process_mailchimp_updates: %d MailChimp updates failed; left to continuation', failed_count)
+        return flask.make_response('', 200)
+
+    if failed_count:
+        # The successful rows have been recorded; the failed ones will be retried.
+        flask.abort(500, description=f'{failed_count} MailChimp updates failed')
+
+    return flask.make_response('', 200)
+
+
+@tasks.route('/tasks/local-queue-stats', methods=['GET'])
+def local_queue_stats():
+    """Development-only endpoint with the depth and latency stats of the in-process task
+    queue (see local_tasks.py), for watching it during load tests. Only available with
+    DEBUG on and the 'local' task queue backend.
+    """
+    if not config.DEBUG or config.TASK_QUEUE_BACKEND != 'local':
+        flask.abort(404)
+
+    return flask.jsonify(local_tasks.stats())
+
+
+@tasks.route('/tasks/daily-maintenance', methods=['GET'])
+def daily_maintenance():
+    """Cron task that runs the daily maintenance jobs -- renewal reminders, culling,
+    MailChimp updates, and member candidate expiry -- as one pipeline. The members and
+    volunteers sheets are fetched once, and every stage works from that snapshot.
+    The stages' sheet writes are applied together at the end: the MailChimp stamps as
+    batched cell updates, then the culled rows as one batched delete (last, as deleting
+    shifts the row numbers the stamps rely on).
+    A stage that fails is logged and the rest still run, except that stages needing the
+    snapshot are skipped if it couldn't be fetched.
+    """
+    logging.debug('tasks.daily_maintenance: hit')
+    gapps.validate_cron_task(flask.request)
+
+    # The MailChimp time budget is measured from here, rather than from the start of its
+    # stage, so that the stages before it count against it. Otherwise the whole job could
+    # overrun the request deadline, and the stages after it not run.
+    request_started = time.monotonic()
+
+    stage_secs = {}
+    failed_stages = []
+
+    @contextlib.contextmanager
+    def stage(name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            logging.exception('tasks.daily_maintenance: stage %s failed', name)
+            failed_stages.append(name)
+        finally:
+            stage_secs[name] = round(time.perf_counter() - started, 3)
+            logging.info('tasks.daily_maintenance: stage %s took %.3fs', name, stage_secs[name])
+
+    sheet_rows = None
+    with stage('snapshot'):
+        sheet_rows = {
+            config.SHEETS.member: sheetdata.find_rows(config.SHEETS.member, matcher=None),
+            config.SHEETS.volunteer: sheetdata.find_rows(config.SHEETS.volunteer, matcher=None),
+        }
+
+    mailchimp_complete, mailchimp_failed_count = True, 0
+
+    if sheet_rows:
+        with stage('renewal_reminders'):
+            expiring_rows = gapps.get_members_expiring_soon(sheet_rows[config.SHEETS.member])
+            logging.info('tasks.daily_maintenance: %d expiring members', len(expiring_rows))
+            _enqueue_renewal_reminder_shards(expiring_rows)
+
+        cull_rows = []
+        if config.MEMBER_SHEET_CULL_ENABLED:
+            with stage('cull_selection'):
+                cull_rows = gapps.get_members_to_cull(sheet_rows[config.SHEETS.member])
+                logging.info('tasks.daily_maintenance: %d members to cull', len(cull_rows))
+
+        if config.MAILCHIMP_ENABLED:
+            with stage('mailchimp'):
+                # Don't bother syncing members who are about to be culled
+                cull_nums = {row.num for row in cull_rows}
+                mailchimp_rows = dict(sheet_rows)
+                mailchimp_rows[config.SHEETS.member] = [row for row in sheet_rows[config.SHEETS.member] if row.num not in cull_nums]
+
+                deadline = request_started + config.MAILCHIMP_SYNC_TIME_BUDGET_SECS
+                mailchimp_complete, mailchimp_failed_count = gapps.process_mailchimp_updates(deadline, mailchimp_rows)
+
+        if cull_rows:
+            with stage('cull'):
+                gapps.cull_members_sheet(cull_rows)
+
+    if not mailchimp_complete:
+        # Only enqueued now that the cull is done, so the continuation can't stamp rows
+        # by numbers that the delete is shifting. It fetches the sheets afresh.
+        gapps.enqueue_task('/tasks/process-mailchimp-updates', {})
+
+    with stage('expire_member_candidates'):
+        num_expired = self_serve.MemberCandidate.clear_expireds()
+        logging.info('tasks.daily_maintenance: expired %d member candidates', num_expired)
+
+    with stage('clear_renewal_reminder_records'):
+        num_cleared = RenewalReminderSent.clear_olds()
+        logging.info('tasks.daily_maintenance: cleared %d old reminder records', num_cleared)
+
+    with stage('clear_synced_submission_records'):
+        num_cleared = gapps.SyncedSubmission.clear_olds()
+        logging.info('tasks.daily_maintenance: cleared %d old synced submission records', num_cleared)
+
+    logging.info('tasks.daily_maintenance: stage timings: %s', stage_secs)
+
+    if mailchimp_failed_count:
+        logging.warning('tasks.daily_maintenance: %d MailChimp updates failed', mailchimp_failed_count)
+
+    if not mailchimp_complete:
+        # A retry of this run would enqueue another continuation, so don't fail it.
+        # The failures have been logged, and the continuation retries the failed rows.
+        if failed_stages:
+            logging.error('tasks.daily_maintenance: stages failed: %s', failed_stages)
+        return flask.make_response('', 200)
+
+    if failed_stages or mailchimp_failed_count:
+        flask.abort(500, description=f'failed stages: {failed_stages}; {mailchimp_failed_count} MailChimp updates failed')
+
     return flask.make_response('', 200)
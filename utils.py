@@ -12,6 +12,8 @@ import re
 import errno
 import datetime
 import logging
+import threading
+import time
 
 import dateutil.parser
 import dateutil.tz
@@ -19,6 +21,9 @@ import dateutil.tz
 import config
 
 
+_EMAIL_RE = re.compile(r'[^@]+@[^@]+\.[^@]+')
+
+
 def basic_validator(val, required):
     if required and not val:
         return False
@@ -39,7 +44,7 @@ def email_validator(val, required):
     if not val:
         return True
 
-    if not re.fullmatch(r'[^@]+@[^@]+\.[^@]+', val):
+    if not _EMAIL_RE.fullmatch(val):
         return False
 
     return True
@@ -74,6 +79,13 @@ def current_datetime():
     return datetime.datetime.now(dateutil.tz.gettz(config.TIMEZONE)).strftime('%Y-%m-%d')
 
 
+def date_from_timestamp(timestamp: float) -> str:
+    """Returns string of the date at the given POSIX timestamp, in the same form as
+    `current_datetime()`.
+    """
+    return datetime.datetime.fromtimestamp(timestamp, dateutil.tz.gettz(config.TIMEZONE)).strftime('%Y-%m-%d')
+
+
 def days_ago(datestring):
     """Returns and integer of the number of days ago the given date was.
     """
@@ -81,3 +93,21 @@ def days_ago(datestring):
     date = dateutil.parser.parse(datestring)
     delta = datetime.datetime.now() - date
     return delta.days
+
+
+class RateLimiter(object):
+    """Limits the rate at which something happens, across threads.
+    Call `wait()` before each occurrence; it blocks until the next one is allowed.
+    """
+    def __init__(self, max_per_second: float):
+        self._interval = 1.0 / max_per_second
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if wait_time > 0:
+            time.sleep(wait_time)